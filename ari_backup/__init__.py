@@ -1,9 +1,28 @@
+import catalog
+import gzip
 import os
+import pipes
+import Queue
 import settings
-import subprocess
 import shlex
+import threading
+import time
 
+from contextlib import closing
+from cStringIO import StringIO
+
+from budget import get_io_priority, io_priority_args
+from command import StreamingCommand
+from compression import RECENT_RUNS, choose_compression
+from dumps import find_expired_dumps, get_dump_dir, get_dump_filename
 from logger import Logger
+from filelist import get_compiled_filelist
+from history import expected_duration, load_history
+from hooks import HookGroup
+from metrics import JobMetrics, parse_rdiff_backup_statistics
+from stores import begin_write, end_write, get_store, lock_label
+from snapshot_sizing import LVS_COMMAND, SnapshotMonitor, choose_snapshot_size, load_usage, parse_lvs, record_usage
+from ssh import SSHConnectionPool
 
 '''Wrapper around rdiff-backup
 
@@ -22,6 +41,29 @@ manage the setup and tear down of LVM snapshots for backup.
 
 '''
 
+# When the scheduler loads job scripts it sets this to a list, and
+# run_backup() registers the job there instead of running it.
+_job_collector = None
+
+# Marks the lines in the output of a batched snapshot script that report the
+# status of a step.
+BATCH_STEP_MARKER = 'ari-backup-step'
+
+# How each step of a batched snapshot script changes the snapshot's
+# bookkeeping when it succeeds.
+BATCH_STEP_UPDATES = {
+    'create': ('created', True),
+    'mkdir': ('mount_point_created', True),
+    'mount': ('mounted', True),
+    'umount': ('mounted', False),
+    'rmdir': ('mount_point_created', False),
+    'lvremove': ('created', False),
+}
+
+def _hook_name(hook):
+    return getattr(hook, '__name__', repr(hook))
+
+
 class ARIBackup(object):
     '''Base class includes core features and basic rdiff-backup functionality
 
@@ -42,9 +84,37 @@ class ARIBackup(object):
         # that the end-user is welcome to override.
         self.remote_user = settings.remote_user
 
+        # The KB/s this job's transfer may use, or None for no limit. The
+        # scheduler sets this from its shared bandwidth budget.
+        self.bandwidth_limit = None
+
+        # nice/ionice settings for the commands we run on the source host
+        self.io_priority = get_io_priority(source_hostname)
+
+        # Set this to True or False to pin whether the transfer is
+        # compressed. With None and settings.adaptive_compression turned on,
+        # we pick whatever has been faster for this job; otherwise
+        # settings.ssh_compression (or, for rsync, rsync_options) decides.
+        self.compression = None
+
+        # How long, in seconds, our commands may run for before they're
+        # stopped and the job fails; 0 means no limit. The transfers
+        # (rdiff-backup, rsync) have their own limits, and are also stopped
+        # if they go transfer_stall_timeout seconds without output or I/O.
+        self.command_timeout = settings.command_timeout
+        self.transfer_timeout = settings.transfer_timeout
+        self.transfer_stall_timeout = settings.transfer_stall_timeout
+
         # setup logging
         self.logger = Logger('ARIBackup ({label})'.format(label=label), settings.debug_logging)
 
+        # Remote commands share multiplexed SSH connections from this pool.
+        # If nobody hands us a pool (the scheduler does), we make our own the
+        # first time we need one and close it when the job is done.
+        self.ssh_pool = None
+        self._owns_ssh_pool = False
+        self._ssh_pool_lock = threading.Lock()
+
         # Include nothing by default
         self.include_dir_list = []
         self.include_file_list = []
@@ -53,12 +123,38 @@ class ARIBackup(object):
         self.exclude_dir_list = []
         self.exclude_file_list = []
 
+        # timing and transfer statistics for the current run
+        self.metrics = JobMetrics(self)
+
+        # The commands running for this job right now, so that cancel() can
+        # stop them, and the most recent one, for its output.
+        self._commands = set()
+        self._commands_lock = threading.Lock()
+        self._last_command = None
+        # cancel() only stops the pre-job hooks and the backup itself; the
+        # post-job hooks always get to run.
+        self.cancelled = False
+        self._cancellable = False
+
         # initialize hook lists
         self.pre_job_hook_list = []
         self.post_job_hook_list = []
 
+        # Post-job work happens in two phases. The hooks in post_job_hook_list
+        # run first and release what the job holds on the source host, like
+        # LVM snapshots. Then the hooks in maintenance_hook_list do backup
+        # store housekeeping, like pruning old increments, so we never keep
+        # snapshots around while the store is being pruned.
+        self.maintenance_hook_list = []
+
+        # If True, run_backup() leaves the maintenance hooks for a later call
+        # to run_maintenance(). The scheduler uses this to run maintenance
+        # from its own queue with its own concurrency limit.
+        self.defer_maintenance = False
+        self._maintenance_error_case = True
+
         if remove_older_than_timespec != None:
-            self.post_job_hook_list.append((
+            self.maintenance_hook_list.append((
                 self._remove_older_than,
                 {'timespec': remove_older_than_timespec}))
 
@@ -69,7 +165,7 @@ class ARIBackup(object):
             # Let's do some assignments for readability
             hook = task[0]
             kwargs = task[1]
-            hook(**kwargs)
+            self._run_hook(hook, kwargs, 'pre', cancellable=True)
 
 
     def _process_post_job_hooks(self, error_case):
@@ -78,24 +174,76 @@ class ARIBackup(object):
         else:
             self.logger.info('processing post-job hooks...')
 
-        for task in self.post_job_hook_list:
+        self._process_error_case_hooks(self.post_job_hook_list, error_case, 'post')
+
+
+    def _process_maintenance_hooks(self, error_case):
+        if not self.maintenance_hook_list:
+            return
+
+        if error_case:
+            self.logger.error('processing store maintenance hooks for error case...')
+        else:
+            self.logger.info('processing store maintenance hooks...')
+
+        self._process_error_case_hooks(self.maintenance_hook_list, error_case, 'maintenance')
+
+
+    def _process_error_case_hooks(self, hook_list, error_case, phase):
+        '''Runs hooks that take an error_case argument, timing each one'''
+        for task in hook_list:
             # Let's do some assignments for readability
             hook = task[0]
             kwargs = task[1]
             kwargs.update({'error_case': error_case})
-            hook(**kwargs)
+            self._run_hook(hook, kwargs, phase)
 
 
-    def _run_command(self, command, host='localhost'):
+    def _run_hook(self, hook, kwargs, phase, cancellable=False, concurrent=False):
+        '''Runs one hook, or each hook in a HookGroup, timing each one
+
+        With concurrent, the hook is running alongside others in a group.
+
+        '''
+        if cancellable:
+            self._check_cancelled()
+        with self.metrics.phase(phase + ':' + _hook_name(hook), current=not concurrent):
+            if isinstance(hook, HookGroup):
+                hook.run(lambda member, member_kwargs: self._run_hook(member, member_kwargs, phase, cancellable,
+                    concurrent=True), kwargs)
+            else:
+                hook(**kwargs)
+
+
+    def _run_command(self, command, host='localhost', stdin_data=None, capture_output=True, timeout=None,
+                     stall_timeout=None, stdout_sink=None, recent_output=True):
         '''Runs an arbitrary command on host.
 
         Given an input string or list, we attempt to execute it on the host via
-        SSH unless host is "localhost".
+        SSH unless host is "localhost". If stdin_data is given, it's written to
+        the command's stdin.
+
+        Output is logged line by line as it arrives. Returns a tuple with
+        (stdout, stderr) if the exitcode is zero, otherwise an Exception is
+        raised. If capture_output is False, we only keep the last few lines of
+        stdout and of stderr, which are returned; use this for commands that
+        may produce a lot of output.
 
-        Returns a tuple with (stdout, stderr) if the exitcode is zero,
-        otherwise an Exception is raised.
+        The command is stopped, and an Exception raised, if it runs for more
+        than timeout seconds (self.command_timeout if it's None) or goes
+        stall_timeout seconds without output or I/O. 0 means no limit.
+
+        If stdout_sink is given, stdout is written to it as it arrives rather
+        than logged.
+
+        With recent_output=False, the command's output isn't what
+        get_recent_output() shows; use this for housekeeping that runs beside
+        the job's real work, like the snapshot monitor's checks.
 
         '''
+        if timeout is None:
+            timeout = self.command_timeout
+
         # make args a list if it's not already so
         if isinstance(command, basestring):
             args = shlex.split(command)
@@ -106,47 +254,128 @@ class ARIBackup(object):
 
         # add SSH arguments if this is a remote command
         if host != 'localhost':
-            ssh_args = shlex.split('%s %s@%s' % (settings.ssh_path, self.remote_user, host))
-            args = ssh_args + args
-
+            args = self._get_ssh_pool().ssh_args(self.remote_user, host) + args
+
+        self.logger.debug('_run_command %r' % args)
+        streaming_command = StreamingCommand(args, self.logger, stdin_data, capture_output, timeout, stall_timeout,
+            stdout_sink)
+        with self._commands_lock:
+            self._check_cancelled()
+            self._commands.add(streaming_command)
+            if recent_output:
+                self._last_command = streaming_command
         try:
-            self.logger.debug('_run_command %r' % args)
-            p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            # We really want to block until our subprocess exists or
-            # KeyboardInterrupt. If we don't, clean up tasks can likely fail.
-            try:
-                stdout, stderr = p.communicate()
-            except KeyboardInterrupt:
-                # TODO terminate() doesn't block, so we'll need to poll
-                p.terminate()
-                raise KeyboardInterrupt
-
-            if stdout:
-                self.logger.debug(stdout)
-            if stderr:
-                # Warning level should be fine here since we'll also look at
-                # the exitcode.
-                self.logger.warning(stderr)
-            exitcode = p.returncode
-        except IOError:
+            exitcode = streaming_command.run()
+        except (IOError, OSError):
             raise Exception('Unable to execute/find {args}'.format(args=args))
+        finally:
+            with self._commands_lock:
+                self._commands.discard(streaming_command)
 
-        if exitcode > 0:
-            error_message = ('[{host}] A command terminated with errors and likely requires intervention. The '
-                'command attempted was "{command}".').format(
-                    host=host, command=command)
+        if streaming_command.terminated:
+            self._check_cancelled()
+
+        # A negative exitcode means the command was killed by a signal.
+        if exitcode != 0:
+            if streaming_command.timed_out:
+                error_message = ('[{host}] A command {reason} and was stopped. The command attempted was '
+                    '"{command}".').format(host=host, reason=streaming_command.timed_out, command=command)
+            else:
+                error_message = ('[{host}] A command terminated with errors and likely requires intervention. The '
+                    'command attempted was "{command}".').format(
+                        host=host, command=command)
+            tail = streaming_command.get_tail()
+            if tail:
+                error_message += ' The last lines of output were:\n' + tail
             raise Exception(error_message)
 
-        return (stdout, stderr)
+        return streaming_command.get_output()
+
+
+    def _check_cancelled(self):
+        if self.cancelled and self._cancellable:
+            raise Exception('backup job cancelled')
+
+
+    def cancel(self):
+        '''Stops the running backup, which then cleans up as if it failed
+
+        The post-job hooks still run, with error_case set. Returns False if
+        the job isn't at a point where it can be cancelled.
+
+        '''
+        with self._commands_lock:
+            if not self._cancellable:
+                return False
+            self.cancelled = True
+            commands = list(self._commands)
+
+        self.logger.error('cancelling backup job...')
+        for command in commands:
+            command.terminate()
+        return True
+
+
+    def get_recent_output(self):
+        '''Returns the last lines of output of the most recent command'''
+        if self._last_command is None:
+            return ''
+        return self._last_command.get_tail()
+
+
+    def _get_ssh_pool(self):
+        # Hooks in a HookGroup may get here at the same time.
+        with self._ssh_pool_lock:
+            if self.ssh_pool is None:
+                self.ssh_pool = SSHConnectionPool(self.logger)
+                self._owns_ssh_pool = True
+            return self.ssh_pool
+
+
+    def _close_ssh_pool(self):
+        if self._owns_ssh_pool:
+            self.ssh_pool.close()
+            self.ssh_pool = None
+            self._owns_ssh_pool = False
+
+
+    def _get_backup_store(self):
+        '''Returns the backup store this job writes to
+
+        The scheduler uses this to limit how many jobs write to the same store
+        at once.
+
+        '''
+        return get_store(self.label)
 
 
     def run_backup(self):
+        '''Runs the backup job and returns True if it succeeded'''
+        if _job_collector is not None:
+            _job_collector.append(self)
+            return
+
+        settings.check_unrecognized()
+        self.metrics = JobMetrics(self)
+        self.metrics.start = time.time()
+        self.metrics.compression = self._choose_compression()
+        self.cancelled = False
+        self._cancellable = True
         self.logger.info('started')
+        repository_lock = None
+        store = None
         try:
             error_case = False
+            # Keep our repository from being moved to another store while
+            # we're using it.
+            repository_lock = lock_label(self.label)
+            store = self._get_backup_store()
+            begin_write(store)
             self._process_pre_job_hooks()
+            self._check_cancelled()
             self.logger.info('data backup started...')
-            self._run_backup()
+            with self.metrics.phase('backup'):
+                self._run_backup()
             self.logger.info('data backup complete')
         except Exception, e:
             error_case = True
@@ -159,9 +388,61 @@ class ARIBackup(object):
             self.logger.error('backup job cancelled by user')
             self.logger.error("let's try to clean up...")
         finally:
-            self._process_post_job_hooks(error_case)
+            with self._commands_lock:
+                self._cancellable = False
+            cleanup_succeeded = False
+            self._maintenance_error_case = True
+            try:
+                self._process_post_job_hooks(error_case)
+                if self.defer_maintenance:
+                    self._maintenance_error_case = error_case
+                else:
+                    self._process_maintenance_hooks(error_case)
+                cleanup_succeeded = True
+            finally:
+                if store is not None:
+                    end_write(store)
+                if repository_lock is not None:
+                    repository_lock.close()
+                self._close_ssh_pool()
+                self._finish_metrics(not error_case and cleanup_succeeded)
+                self._update_catalog(record_run=True)
             self.logger.info('stopped')
 
+        return not error_case
+
+
+    def run_maintenance(self):
+        '''Runs the maintenance hooks that run_backup() deferred
+
+        Returns True if they succeeded.
+
+        '''
+        start = time.time()
+        repository_lock = None
+        try:
+            repository_lock = lock_label(self.label)
+            self._process_maintenance_hooks(self._maintenance_error_case)
+        except Exception, e:
+            self.logger.error(str(e))
+            return False
+        finally:
+            if repository_lock is not None:
+                repository_lock.close()
+            self._close_ssh_pool()
+            self.logger.info('store maintenance took {duration:.1f}s'.format(duration=time.time() - start))
+
+        return True
+
+
+    def _finish_metrics(self, success):
+        self.metrics.finish = time.time()
+        self.metrics.success = success
+        self.metrics.write()
+        self.logger.info('run took {duration:.1f}s: {phases}'.format(
+            duration=self.metrics.finish - self.metrics.start,
+            phases=', '.join(['{name} {seconds:.1f}s'.format(**phase) for phase in self.metrics.phases])))
+
 
     def _run_backup(self, top_level_src_dir='/'):
         '''Run rdiff-backup job.
@@ -175,7 +456,19 @@ class ARIBackup(object):
 
         '''
         self.logger.debug('_run_backup started')
+        transfer = self._rdiff_backup(top_level_src_dir, self._get_repository_path(),
+            self.include_dir_list, self.exclude_dir_list, self.include_file_list, self.exclude_file_list)
+        self.metrics.transfer.update(transfer)
+        self.logger.debug('_run_backup completed')
+
+
+    def _rdiff_backup(self, top_level_src_dir, destination, include_dir_list, exclude_dir_list,
+                      include_file_list=(), exclude_file_list=()):
+        '''Runs one rdiff-backup of top_level_src_dir into destination
+
+        Returns the transfer statistics rdiff-backup reported.
 
+        '''
         # Init our arguments list with the path to rdiff-backup.
         # This will be in the format we'd normally pass to the command-line
         # e.g. [ '--include', '/dir/to/include', '--exclude', '/dir/to/exclude']
@@ -190,26 +483,37 @@ class ARIBackup(object):
         # Bring the terminal verbosity down so that we only see errors
         arg_list += ['--terminal-verbosity', '1']
 
+        # Have rdiff-backup report what it did so we can record it in our
+        # metrics.
+        arg_list.append('--print-statistics')
+
         # This conditional reads strangely, but that's because rdiff-backup
         # not only defaults to having SSH compression enabled, it also doesn't
         # have an option to explicitly enable it -- only one to disable it.
-        if not settings.ssh_compression:
+        if not self._get_compression():
             arg_list.append('--ssh-no-compression')
 
-        # Populate self.argument list
-        for exclude_dir in self.exclude_dir_list:
-            arg_list.append('--exclude')
-            arg_list.append(exclude_dir)
+        if self.source_hostname != 'localhost':
+            remote_schema = self._get_remote_schema()
+            if remote_schema:
+                arg_list += ['--remote-schema', remote_schema]
 
-        for exclude_file in self.exclude_file_list:
+        # Populate self.argument list. Every exclude has to come before every
+        # include. The exclude filelists are excludes only, so they can go
+        # first, then our own rules, compiled into one filelist.
+        for exclude_file in exclude_file_list:
             arg_list.append('--exclude-filelist')
             arg_list.append(exclude_file)
 
-        for include_dir in self.include_dir_list:
-            arg_list.append('--include')
-            arg_list.append(include_dir)
+        if include_dir_list or exclude_dir_list:
+            filelist_path, filelist_stats = get_compiled_filelist(include_dir_list, exclude_dir_list,
+                bool(include_file_list))
+            self.logger.debug('kept {output_rules} of {input_rules} include and exclude rules'.format(
+                **filelist_stats))
+            arg_list.append('--include-globbing-filelist')
+            arg_list.append(filelist_path)
 
-        for include_file in self.include_file_list:
+        for include_file in include_file_list:
             arg_list.append('--include-filelist')
             arg_list.append(include_file)
 
@@ -230,16 +534,119 @@ class ARIBackup(object):
             )
 
         # Add a destination argument
-        arg_list.append(
-            '{backup_store_path}/{label}'.format(
-                backup_store_path=settings.backup_store_path,
-                label=self.label
-            )
-        )
+        arg_list.append(destination)
+
+        # When the source is local, our I/O priority applies to rdiff-backup
+        # itself.
+        if self.source_hostname == 'localhost':
+            arg_list = io_priority_args(self.io_priority) + arg_list
 
         # Rdiff-backup GO!
-        self._run_command(arg_list)
-        self.logger.debug('_run_backup completed')
+        (stdout, stderr) = self._run_command(arg_list, capture_output=False, timeout=self.transfer_timeout,
+            stall_timeout=self.transfer_stall_timeout)
+        return parse_rdiff_backup_statistics(stdout)
+
+
+    def _get_remote_schema(self):
+        '''Returns an rdiff-backup --remote-schema that applies our budget
+
+        The remote rdiff-backup runs under our I/O priority, and our end of
+        the ssh connection runs under trickle to enforce bandwidth_limit.
+        Returns None if there's nothing to apply, so rdiff-backup uses its
+        default schema.
+
+        '''
+        priority_args = io_priority_args(self.io_priority)
+        trickle_args = []
+        if self.bandwidth_limit:
+            if settings.trickle_path:
+                limit = str(self.bandwidth_limit)
+                trickle_args = [settings.trickle_path, '-s', '-d', limit, '-u', limit]
+            else:
+                self.logger.debug('trickle_path is not set, so rdiff-backup will not be bandwidth limited')
+
+        if not priority_args and not trickle_args:
+            return None
+
+        # rdiff-backup puts user@host where the %s is. Since we're building
+        # the schema anyway, we use our multiplexed connection too, unless
+        # trickle is limiting it or we're compressing: the master would carry
+        # the bytes, out of trickle's reach, and compresses them only if it
+        # was started with -C.
+        compress = self._get_compression()
+        ssh_args = self._get_ssh_pool().ssh_args(self.remote_user, self.source_hostname,
+            multiplexed=not trickle_args and not compress)[:-1]
+        if compress:
+            ssh_args.append('-C')
+
+        schema_args = [pipes.quote(arg) for arg in trickle_args + ssh_args]
+        schema_args.append('%s')
+        schema_args += [pipes.quote(arg) for arg in priority_args + ['rdiff-backup', '--server']]
+        return ' '.join(schema_args)
+
+
+    def _transfer_is_remote(self):
+        '''Returns True if our transfer crosses the network'''
+        return self.source_hostname != 'localhost'
+
+
+    def _choose_compression(self):
+        '''Returns whether this run compresses its transfer
+
+        Returns None if it's up to the transfer's own options.
+
+        '''
+        if self.compression is not None:
+            return bool(self.compression)
+        if not settings.adaptive_compression or not self._transfer_is_remote():
+            return None
+
+        try:
+            records = load_history(recent_runs=RECENT_RUNS).get(self.label, [])
+        except (IOError, OSError), e:
+            self.logger.warning('unable to read the job history: {error}'.format(error=e))
+            return None
+        compress, reason = choose_compression(records, settings.ssh_compression)
+        self.logger.info('compression {state}: {reason}'.format(state=compress and 'on' or 'off', reason=reason))
+        return compress
+
+
+    def _get_compression(self):
+        '''Returns whether rdiff-backup's ssh connection is compressed'''
+        if self.metrics.compression is None:
+            return settings.ssh_compression
+        return self.metrics.compression
+
+
+    def _update_catalog(self, record_run=False):
+        '''Catches the catalog up with our repositories' sessions
+
+        With record_run, the outcome of this run is recorded too. Failing to
+        update the catalog doesn't fail the job.
+
+        '''
+        try:
+            with closing(catalog.connect()) as connection:
+                for repository_path in self._get_repository_paths():
+                    catalog.update_repository(connection, self.label, repository_path)
+                if record_run:
+                    catalog.record_run(connection, self.label, self.metrics.start, self.metrics.finish,
+                        self.metrics.success)
+        except Exception, e:
+            self.logger.warning('unable to update the catalog: {error}'.format(error=e))
+
+
+    def _get_repository_path(self):
+        '''Returns the path of this job's rdiff-backup repository'''
+        return '{backup_store_path}/{label}'.format(
+            backup_store_path=get_store(self.label),
+            label=self.label
+        )
+
+
+    def _get_repository_paths(self):
+        '''Returns the paths of all the repositories this job writes to'''
+        return [self._get_repository_path()]
 
 
     def _remove_older_than(self, timespec, error_case):
@@ -252,16 +659,73 @@ class ARIBackup(object):
         if not error_case:
             self.logger.info('remove_older_than %s started' % timespec)
 
-            arg_list = [settings.rdiff_backup_path]
-            arg_list.append('--force')
-            arg_list.append('--remove-older-than')
-            arg_list.append(timespec)
-            arg_list.append('%s/%s' % (settings.backup_store_path, self.label))
-
-            self._run_command(arg_list)
+            for repository_path in self._get_repository_paths():
+                arg_list = [settings.rdiff_backup_path]
+                arg_list.append('--force')
+                arg_list.append('--remove-older-than')
+                arg_list.append(timespec)
+                arg_list.append(repository_path)
+
+                self._run_command(arg_list, capture_output=False, timeout=self.transfer_timeout,
+                    stall_timeout=self.transfer_stall_timeout)
+            self._update_catalog()
+            self._remove_dumps_older_than(timespec)
             self.logger.info('remove_older_than %s completed' % timespec)
 
 
+    def _get_dump_dir(self):
+        return get_dump_dir(get_store(self.label), self.label)
+
+
+    def _capture_dump(self, name, command, host=None):
+        '''Streams the output of a dump command into the backup store
+
+        Pre-job hook that runs command on host (source_hostname by default)
+        and writes its stdout, gzipped, to a file named for name and the
+        current time in this job's dump directory. See dumps.py.
+
+        '''
+        if host is None:
+            host = self.source_hostname
+        dump_dir = self._get_dump_dir()
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+        path = os.path.join(dump_dir, get_dump_filename(name, time.time()))
+        temp_path = path + '.tmp'
+
+        self.logger.info('capturing {name} dump...'.format(name=name))
+        succeeded = False
+        dump_file = gzip.open(temp_path, 'wb', settings.dump_compress_level)
+        try:
+            self._run_command(command, host, capture_output=False, timeout=self.transfer_timeout,
+                stall_timeout=self.transfer_stall_timeout, stdout_sink=dump_file)
+            succeeded = True
+        finally:
+            dump_file.close()
+            if not succeeded:
+                os.remove(temp_path)
+        os.rename(temp_path, path)
+        self.logger.info('captured {name} dump in {path} ({size} bytes)'.format(
+            name=name, path=path, size=os.path.getsize(path)))
+
+
+    def _remove_dumps_older_than(self, timespec):
+        '''Removes the captured dumps that timespec has expired'''
+        dump_dir = self._get_dump_dir()
+        if not os.path.isdir(dump_dir):
+            return
+
+        filenames = os.listdir(dump_dir)
+        for filename in find_expired_dumps(filenames, timespec):
+            os.remove(os.path.join(dump_dir, filename))
+            self.logger.info('{filename} removed'.format(filename=filename))
+        # We hold the lock on our label, so no dump is being written and
+        # these are left over from runs that died.
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                os.remove(os.path.join(dump_dir, filename))
+
+
 class LVMBackup(ARIBackup):
     def __init__(self, label, source_hostname, remove_older_than_timespec=None):
         super(LVMBackup, self).__init__(label, source_hostname, remove_older_than_timespec)
@@ -279,42 +743,212 @@ class LVMBackup(ARIBackup):
         # mount the snapshots in a directory named for this job's label
         self.snapshot_mount_point_base_path = os.path.join(settings.snapshot_mount_root, self.label)
 
+        # Send all the snapshot setup and all the teardown to the source host
+        # as one script each, rather than one command per step per volume.
+        self.batch_snapshot_commands = settings.lvm_batch_commands
+
+        # If this is more than zero, each entry in lv_list is backed up into
+        # its own repository under this job's repository, with up to this
+        # many rdiff-backup processes running at once. The repository layout
+        # is different, so only turn this on for a new label.
+        self.lv_streams = 0
+
+        # While the backup runs, we check how full the snapshots are this
+        # often (in seconds), and extend any that are past
+        # snapshot_extend_percent full. Set the interval to 0 to not check.
+        self.snapshot_monitor_interval = settings.snapshot_monitor_interval
+        self.snapshot_monitor = None
+
         # setup pre and post job hooks to manage snapshot work flow
         self.pre_job_hook_list.append((self._create_snapshots, {}))
         self.pre_job_hook_list.append((self._mount_snapshots, {}))
+        self.pre_job_hook_list.append((self._start_snapshot_monitor, {}))
+        self.post_job_hook_list.append((self._stop_snapshot_monitor, {}))
         self.post_job_hook_list.append((self._umount_snapshots, {}))
         self.post_job_hook_list.append((self._delete_snapshots, {}))
 
 
+    def _new_snapshot(self, volume):
+        '''Returns the bookkeeping dict for a snapshot of an lv_list entry'''
+        try:
+            lv_path, src_mount_path, mount_options = volume
+        except ValueError:
+            lv_path, src_mount_path = volume
+            mount_options = None
+
+        vg_name, lv_name = lv_path.split('/')
+        new_lv_name = lv_name + settings.snapshot_suffix
+        mount_path = '{snapshot_mount_point_base_path}{src_mount_path}'.format(
+            snapshot_mount_point_base_path=self.snapshot_mount_point_base_path,
+            src_mount_path=src_mount_path
+        )
+
+        return {
+            'origin_lv_path': lv_path,
+            'lv_path': vg_name + '/' + new_lv_name,
+            'src_mount_path': src_mount_path,
+            'mount_path': mount_path,
+            'mount_options': mount_options,
+            # in bytes, set by _size_snapshots()
+            'size': None,
+            'origin_size': None,
+            # the most copy-on-write space we've seen in use, in bytes
+            'peak_used': 0,
+            'created_time': None,
+            'created': False,
+            'mount_point_created': False,
+            'mounted': False,
+        }
+
+
+    def _lvcreate_command(self, snapshot):
+        return 'lvcreate -s -L %dm %s -n %s' % (
+            snapshot['size'] // (1024 * 1024), snapshot['origin_lv_path'], snapshot['lv_path'].split('/')[1])
+
+
+    def _get_usage_key(self, snapshot):
+        return '{host}:{origin_lv_path}'.format(host=self.source_hostname, origin_lv_path=snapshot['origin_lv_path'])
+
+
+    def _query_lvs(self, lv_paths, recent_output=True):
+        '''Returns a dict of vg/lv -> (size, data_percent) from the source host'''
+        stdout, stderr = self._run_command(LVS_COMMAND + ' ' + ' '.join(lv_paths), self.source_hostname,
+            recent_output=recent_output)
+        return parse_lvs(stdout)
+
+
+    def _size_snapshots(self):
+        '''Sets the size of each snapshot in self.lv_snapshots
+
+        Sizes come from the size of each origin and the copy-on-write usage
+        of its snapshots on earlier runs. If we can't ask lvs about the
+        origins, we size without them rather than give up on the backup.
+
+        '''
+        try:
+            volumes = self._query_lvs([snapshot['origin_lv_path'] for snapshot in self.lv_snapshots])
+        except Exception, e:
+            self.logger.warning('unable to get the size of the origin volumes: {error}'.format(error=e))
+            volumes = {}
+
+        usage = load_usage()
+        duration = expected_duration(load_history().get(self.label, []))
+        for snapshot in self.lv_snapshots:
+            origin_size = volumes.get(snapshot['origin_lv_path'], (None, None))[0]
+            size = choose_snapshot_size(origin_size, usage.get(self._get_usage_key(snapshot), []), duration)
+            snapshot.update({'size': size, 'origin_size': origin_size})
+            self.logger.debug('snapshot of {lv_path} will be {size} bytes'.format(
+                lv_path=snapshot['origin_lv_path'], size=size))
+
+
+    def _mount_command(self, snapshot):
+        device_path = '/dev/' + snapshot['lv_path']
+        mount_path = snapshot['mount_path']
+        mount_options = snapshot['mount_options']
+
+        # mount the LV, possibly with mount options
+        if mount_options:
+            return 'mount -o {mount_options} {device_path} {mount_path}'.format(
+                mount_options=mount_options,
+                device_path=device_path,
+                mount_path=mount_path
+            )
+        else:
+            return 'mount {device_path} {mount_path}'.format(
+                device_path=device_path,
+                mount_path=mount_path
+            )
+
+
     def _create_snapshots(self):
         '''Creates snapshots of all the volumns listed in self.lv_list'''
 
         self.logger.info('creating LVM snapshots...')
         for volume in self.lv_list:
-            try:
-                lv_path, src_mount_path, mount_options = volume
-            except ValueError:
-                lv_path, src_mount_path = volume
-                mount_options = None
-
-            vg_name, lv_name = lv_path.split('/')
-            new_lv_name = lv_name + settings.snapshot_suffix
-            mount_path = '{snapshot_mount_point_base_path}{src_mount_path}'.format(
-                snapshot_mount_point_base_path=self.snapshot_mount_point_base_path,
-                src_mount_path=src_mount_path
-            )
+            self.lv_snapshots.append(self._new_snapshot(volume))
+        self._size_snapshots()
+
+        if self.batch_snapshot_commands:
+            self._create_and_mount_snapshots_batched()
+            return
+
+        for snapshot in self.lv_snapshots:
+            self._run_command(self._lvcreate_command(snapshot), self.source_hostname)
+            snapshot.update({'created': True, 'created_time': time.time()})
 
-            # TODO Is it really OK to always make a 1GB exception table?
-            self._run_command('lvcreate -s -L 1G %s -n %s' % (lv_path, new_lv_name), self.source_hostname)
 
-            self.lv_snapshots.append({
-                'lv_path': vg_name + '/' + new_lv_name,
-                'mount_path': mount_path,
-                'mount_options': mount_options,
-                'created': True,
-                'mount_point_created': False,
-                'mounted': False,
-            })
+    def _sample_snapshots(self):
+        '''Records how full each snapshot is and extends those nearly full
+
+        This runs beside the backup, so its commands stay out of
+        get_recent_output().
+
+        '''
+        snapshots = [snapshot for snapshot in self.lv_snapshots if snapshot['created']]
+        if not snapshots:
+            return
+        volumes = self._query_lvs([snapshot['lv_path'] for snapshot in snapshots], recent_output=False)
+
+        for snapshot in snapshots:
+            size, data_percent = volumes.get(snapshot['lv_path'], (None, None))
+            if size is None or data_percent is None:
+                continue
+            used = int(size * data_percent / 100)
+            snapshot.update({'size': size, 'peak_used': max(snapshot['peak_used'], used)})
+
+            if data_percent >= settings.snapshot_extend_percent:
+                # Grow by half again, but not past the origin's size.
+                extend_by = size // 2
+                if snapshot['origin_size']:
+                    extend_by = min(extend_by, snapshot['origin_size'] - size)
+                if extend_by < 1024 * 1024:
+                    continue
+                self.logger.warning('snapshot {lv_path} is {percent}% full, extending it by {megabytes}MB'.format(
+                    lv_path=snapshot['lv_path'], percent=data_percent, megabytes=extend_by // (1024 * 1024)))
+                self._run_command('lvextend -L +%dm %s' % (extend_by // (1024 * 1024), snapshot['lv_path']),
+                    self.source_hostname, recent_output=False)
+                snapshot.update({'size': size + extend_by})
+
+
+    def _start_snapshot_monitor(self):
+        if self.snapshot_monitor_interval > 0:
+            self.snapshot_monitor = SnapshotMonitor(self._sample_snapshots, self.snapshot_monitor_interval,
+                self.logger)
+            self.snapshot_monitor.start()
+
+
+    def _stop_snapshot_monitor(self, error_case=None):
+        '''Stops the snapshot monitor and records each snapshot's peak usage
+
+        This method behaves the same in the normal and error cases.
+
+        '''
+        if self.snapshot_monitor is not None:
+            self.snapshot_monitor.stop()
+            self.snapshot_monitor = None
+
+        # Snapshots only fill up, so a last sample now gives us the peak.
+        try:
+            self._sample_snapshots()
+        except Exception, e:
+            self.logger.warning('unable to sample snapshot usage: {error}'.format(error=e))
+
+        now = time.time()
+        records = {}
+        for snapshot in self.lv_snapshots:
+            if snapshot['created'] and snapshot['peak_used']:
+                records[self._get_usage_key(snapshot)] = {
+                    'time': now,
+                    'origin_size': snapshot['origin_size'],
+                    'size': snapshot['size'],
+                    'peak_used': snapshot['peak_used'],
+                    'duration': now - snapshot['created_time'],
+                }
+        if records:
+            try:
+                record_usage(records)
+            except (IOError, OSError), e:
+                self.logger.warning('unable to record snapshot usage: {error}'.format(error=e))
 
 
     def _delete_snapshots(self, error_case=None):
@@ -335,10 +969,12 @@ class LVMBackup(ARIBackup):
     def _mount_snapshots(self):
         self.logger.info('mounting LVM snapshots...')
         for snapshot in self.lv_snapshots:
-            lv_path = snapshot['lv_path']
-            device_path = '/dev/' + lv_path
+            # In batched mode the snapshots were mounted when they were
+            # created.
+            if snapshot['mounted']:
+                continue
+
             mount_path = snapshot['mount_path']
-            mount_options = snapshot['mount_options']
 
             # mkdir the mount point
             self._run_command('mkdir -p %s' % mount_path, self.source_hostname)
@@ -349,20 +985,7 @@ class LVMBackup(ARIBackup):
             if os.path.ismount(mount_path):
                 raise Exception("{mount_path} is already a mount point".format(mount_path=mount_path))
 
-            # mount the LV, possibly with mount options
-            if mount_options:
-                command = 'mount -o {mount_options} {device_path} {mount_path}'.format(
-                    mount_options=mount_options,
-                    device_path=device_path,
-                    mount_path=mount_path
-                )
-            else:
-                command = 'mount {device_path} {mount_path}'.format(
-                    device_path=device_path,
-                    mount_path=mount_path
-                )
-
-            self._run_command(command, self.source_hostname)
+            self._run_command(self._mount_command(snapshot), self.source_hostname)
             snapshot.update({'mounted': True})
 
 
@@ -379,6 +1002,10 @@ class LVMBackup(ARIBackup):
         # Check out shutil.rmtree() to help resolve this issue.
 
         self.logger.info('umounting LVM snapshots...')
+        if self.batch_snapshot_commands:
+            self._umount_and_delete_snapshots_batched()
+            return
+
         # We need a local copy of the lv_snapshots list to muck with in
         # this method.
         local_lv_snapshots = self.lv_snapshots
@@ -395,34 +1022,274 @@ class LVMBackup(ARIBackup):
                 snapshot.update({'mount_point_created': False})
 
 
+    def _batch_step(self, index, step, command):
+        '''Returns shell lines that run command and report how it went
+
+        The script stops after the first step that fails, but always exits
+        zero so that we get to read the status lines.
+
+        '''
+        return (
+            '{command}\n'
+            'rc=$?\n'
+            'echo "{marker} {index} {step} $rc"\n'
+            '[ $rc -eq 0 ] || exit 0\n'
+        ).format(command=command, marker=BATCH_STEP_MARKER, index=index, step=step)
+
+
+    def _run_snapshot_batch(self, steps):
+        '''Runs a list of (index, step, command) on the source host in one go
+
+        index points into self.lv_snapshots. The snapshot bookkeeping is
+        updated for every step that reported back, even if the script itself
+        fails (say the ssh connection drops, or the job is cancelled), so that
+        teardown knows what to undo. Then an Exception is raised if the
+        script failed, a step failed or the script didn't get through all of
+        them.
+
+        '''
+        script = ''.join([self._batch_step(index, step, command) for index, step, command in steps])
+        # We read the status lines from what the script got to print, however
+        # the command ends.
+        stdout = StringIO()
+        try:
+            self._run_command(['sh', '-s'], self.source_hostname, stdin_data=script, stdout_sink=stdout)
+        finally:
+            completed, error_message = self._apply_batch_output(stdout.getvalue())
+
+        if error_message is not None:
+            raise Exception(error_message)
+        if completed < len(steps):
+            raise Exception('[{host}] batched snapshot script stopped after {completed} of {count} steps'.format(
+                host=self.source_hostname, completed=completed, count=len(steps)))
+
+
+    def _apply_batch_output(self, output):
+        '''Updates the snapshot bookkeeping from a batched script's status lines
+
+        Returns (completed, error_message): the number of steps that
+        succeeded, and what went wrong with the step that failed, or None.
+
+        '''
+        completed = 0
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) != 4 or fields[0] != BATCH_STEP_MARKER:
+                continue
+            index, step, exitcode = int(fields[1]), fields[2], int(fields[3])
+            snapshot = self.lv_snapshots[index]
+            if exitcode != 0:
+                if step == 'check_mount':
+                    return completed, "{mount_path} is already a mount point".format(
+                        mount_path=snapshot['mount_path'])
+                return completed, ('[{host}] the {step} step for {lv_path} failed with exit code '
+                    '{exitcode}').format(host=self.source_hostname, step=step,
+                        lv_path=snapshot['lv_path'], exitcode=exitcode)
+
+            if step in BATCH_STEP_UPDATES:
+                key, value = BATCH_STEP_UPDATES[step]
+                snapshot.update({key: value})
+            if step == 'create':
+                snapshot.update({'created_time': time.time()})
+            completed += 1
+
+        return completed, None
+
+
+    def _create_and_mount_snapshots_batched(self):
+        '''Creates and mounts all the snapshots with one remote script
+
+        All the snapshots are created back to back before any of them are
+        mounted, so they are as close to point-in-time consistent as we can
+        make them.
+
+        '''
+        steps = []
+        for index, snapshot in enumerate(self.lv_snapshots):
+            steps.append((index, 'create', self._lvcreate_command(snapshot)))
+
+        for index, snapshot in enumerate(self.lv_snapshots):
+            mount_path = pipes.quote(snapshot['mount_path'])
+            steps.append((index, 'mkdir', 'mkdir -p %s' % mount_path))
+            # If where we want to mount our LV is already a mount point then
+            # let's back out.
+            steps.append((index, 'check_mount', '! mountpoint -q %s' % mount_path))
+            steps.append((index, 'mount', self._mount_command(snapshot)))
+
+        self._run_snapshot_batch(steps)
+
+
+    def _umount_and_delete_snapshots_batched(self):
+        '''Umounts and deletes all the snapshots with one remote script'''
+        steps = []
+        indexes = range(len(self.lv_snapshots))
+        # Umount in reverse order so that we umount the deepest paths first.
+        for index in reversed(indexes):
+            snapshot = self.lv_snapshots[index]
+            mount_path = pipes.quote(snapshot['mount_path'])
+            if snapshot['mounted']:
+                steps.append((index, 'umount', 'umount %s' % mount_path))
+            if snapshot['mount_point_created']:
+                steps.append((index, 'rmdir', 'rmdir %s' % mount_path))
+
+        for index in indexes:
+            snapshot = self.lv_snapshots[index]
+            if snapshot['created']:
+                # -f makes lvremove not interactive
+                steps.append((index, 'lvremove', 'lvremove -f %s' % snapshot['lv_path']))
+
+        if steps:
+            self._run_snapshot_batch(steps)
+
+
     def _run_backup(self):
         '''Run backup of LVM snapshots'''
 
         self.logger.debug('LVMBackup._run_backup started')
 
+        if self.lv_streams > 0:
+            self._run_lv_streams()
+            self.logger.debug('LVMBackup._run_backup completed')
+            return
+
         # Cook the self.include_dir_list and self.exclude_dir_list so that the
         # src paths include the mount path for the LV(s).
-        local_include_dir_list = []
-        for include_dir in self.include_dir_list:
-            local_include_dir_list.append('{snapshot_mount_point_base_path}{include_dir}'.format(
-                snapshot_mount_point_base_path=snapshot_mount_point_base_path,
-                include_dir=include_dir
-            ))
-
-        local_exclude_dir_list = []
-        for exclude_dir in self.exclude_dir_list:
-            local_exclude_dir_list.append('{snapshot_mount_point_base_path}{exclude_dir}'.format(
-                snapshot_mount_point_base_path=snapshot_mount_point_base_path,
-                exclude_dir=exclude_dir
-            ))
-
-        self.include_dir_list = local_include_dir_list
-        self.exclude_dir_list = local_exclude_dir_list
+        local_include_dir_list = [self._snapshot_path(include_dir) for include_dir in self.include_dir_list]
+        local_exclude_dir_list = [self._snapshot_path(exclude_dir) for exclude_dir in self.exclude_dir_list]
 
         # We don't support include_file_list and exclude_file_list in this
         # class as it would take extra effort and it's not likely to be used.
 
-		# Have the base class perform an rdiff-backup
-        super(LVMBackup, self)._run_backup(self.snapshot_mount_point_base_path)
+        # Have the base class perform an rdiff-backup
+        transfer = self._rdiff_backup(self.snapshot_mount_point_base_path, self._get_repository_path(),
+            local_include_dir_list, local_exclude_dir_list)
+        self.metrics.transfer.update(transfer)
 
         self.logger.debug('LVMBackup._run_backup completed')
+
+
+    def _snapshot_path(self, path):
+        '''Returns where path on the source host is under our snapshot mounts'''
+        return '{snapshot_mount_point_base_path}{path}'.format(
+            snapshot_mount_point_base_path=self.snapshot_mount_point_base_path,
+            path=path
+        )
+
+
+    def _get_lv_repository_path(self, lv_path):
+        return '{repository_path}/{name}'.format(
+            repository_path=self._get_repository_path(),
+            name=lv_path.replace('/', '-')
+        )
+
+
+    def _get_repository_paths(self):
+        if self.lv_streams > 0:
+            # LVs with nothing included never get a repository.
+            repository_paths = [self._get_lv_repository_path(volume[0]) for volume in self.lv_list]
+            return [path for path in repository_paths if os.path.isdir(path)]
+        return super(LVMBackup, self)._get_repository_paths()
+
+
+    def _plan_lv_streams(self):
+        '''Works out one rdiff-backup run per mounted snapshot
+
+        Each stream gets the includes and excludes that fall inside its LV, and
+        excludes the mount points of any LVs mounted inside it, since those
+        have their own streams. Returns a list of (snapshot, include_dir_list,
+        exclude_dir_list) in snapshot mount path terms, leaving out snapshots
+        with nothing included.
+
+        '''
+        streams = []
+        for snapshot in self.lv_snapshots:
+            src_mount_path = snapshot['src_mount_path']
+            nested_mount_paths = [other_snapshot['src_mount_path'] for other_snapshot in self.lv_snapshots
+                if other_snapshot['src_mount_path'] != src_mount_path
+                and _is_under(other_snapshot['src_mount_path'], src_mount_path)]
+
+            def in_this_lv(path):
+                if not _is_under(path, src_mount_path):
+                    return False
+                for nested_mount_path in nested_mount_paths:
+                    if _is_under(path, nested_mount_path):
+                        return False
+                return True
+
+            include_dir_list = []
+            for include_dir in self.include_dir_list:
+                if in_this_lv(include_dir):
+                    include_dir_list.append(include_dir)
+                elif _is_under(src_mount_path, include_dir) and src_mount_path not in include_dir_list:
+                    # The whole LV is included.
+                    include_dir_list.append(src_mount_path)
+
+            if not include_dir_list:
+                self.logger.debug('nothing to back up from {lv_path}'.format(lv_path=snapshot['lv_path']))
+                continue
+
+            exclude_dir_list = [exclude_dir for exclude_dir in self.exclude_dir_list if in_this_lv(exclude_dir)]
+            exclude_dir_list += nested_mount_paths
+
+            streams.append((
+                snapshot,
+                [self._snapshot_path(include_dir) for include_dir in include_dir_list],
+                [self._snapshot_path(exclude_dir) for exclude_dir in exclude_dir_list],
+            ))
+
+        return streams
+
+
+    def _run_lv_streams(self):
+        '''Backs up each snapshot to its own repository, lv_streams at a time'''
+        streams = Queue.Queue()
+        for stream in self._plan_lv_streams():
+            streams.put(stream)
+
+        # lv_path -> transfer statistics
+        transfers = {}
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    snapshot, include_dir_list, exclude_dir_list = streams.get_nowait()
+                except Queue.Empty:
+                    return
+                lv_path = snapshot['lv_path']
+                try:
+                    self.logger.info('backing up {lv_path}...'.format(lv_path=lv_path))
+                    transfers[lv_path] = self._rdiff_backup(snapshot['mount_path'],
+                        self._get_lv_repository_path(snapshot['origin_lv_path']),
+                        include_dir_list, exclude_dir_list)
+                except Exception, e:
+                    errors.append('{lv_path}: {error}'.format(lv_path=lv_path, error=e))
+
+        workers = [threading.Thread(target=worker, name='ari-backup {label} stream {i}'.format(label=self.label, i=i))
+            for i in range(self.lv_streams)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        self.metrics.transfer.update(_sum_transfers(transfers))
+        if errors:
+            raise Exception('backups of {count} LVs failed: {errors}'.format(
+                count=len(errors), errors='; '.join(errors)))
+
+
+def _is_under(path, parent):
+    '''Returns True if path is parent or somewhere below it'''
+    path = os.path.normpath(path)
+    parent = os.path.normpath(parent)
+    return parent == '/' or path == parent or path.startswith(parent + '/')
+
+
+def _sum_transfers(transfers):
+    '''Adds up the transfer statistics of several rdiff-backup runs'''
+    total = {'streams': transfers}
+    for transfer in transfers.values():
+        for key, value in transfer.items():
+            if isinstance(value, (int, long, float)):
+                total[key] = total.get(key, 0) + value
+    return total
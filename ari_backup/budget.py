@@ -0,0 +1,93 @@
+from __future__ import with_statement
+
+import threading
+
+import settings
+
+'''Shared bandwidth and I/O budget for concurrent jobs
+
+The scheduler gives every job it starts a share of settings.bandwidth_limit
+(in KB/s), and jobs apply it to their transfers: rsync gets --bwlimit, and
+rdiff-backup's ssh is run under trickle when settings.trickle_path is set.
+Neither --bwlimit nor trickle's limit can be changed once a transfer is
+running, so a job keeps the share it started with until it finishes, and what
+a finished job gives back only goes to jobs started after it. Each job gets
+an even split of the cap across the jobs running or waiting when it starts,
+and the last job to start gets all that's left.
+
+Jobs also run their source-side commands under nice and ionice according to
+settings.io_priority, which maps source hostnames (or 'default') to a dict
+with any of 'nice', 'ionice_class' and 'ionice_level'.
+
+'''
+
+class BandwidthBudget(object):
+    '''Splits a total bandwidth cap fairly among running jobs
+
+    A new job gets an even split of the total across the slots we expect
+    to fill: the running jobs, itself and the jobs still waiting, but no more
+    than max_jobs. Once nothing is waiting, there's nobody left to save
+    bandwidth for, so a new job gets everything the running jobs don't hold.
+    Since the jobs we expect only ever get fewer, every share handed out
+    earlier is no bigger than the new one, and the shares of the running jobs
+    never add up to more than the total.
+
+    Shares are fixed when jobs start: releasing one doesn't raise the shares
+    of the jobs still running.
+
+    '''
+    def __init__(self, total, max_jobs):
+        self.total = total
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        # label -> KB/s
+        self._allocations = {}
+
+
+    def acquire(self, label, queued):
+        '''Returns the share in KB/s for a job about to start
+
+        queued is how many jobs are still waiting after this one.
+
+        '''
+        with self._lock:
+            running = len(self._allocations)
+            expected = running + 1 + queued
+            if self.max_jobs:
+                expected = min(expected, self.max_jobs)
+            remaining = self.total - sum(self._allocations.values())
+            if queued:
+                share = min(self.total // expected, remaining)
+            else:
+                share = remaining
+            # Jobs started outside of the scheduler's order could leave less
+            # than an even share. A share of 0 would mean no limit at all, so
+            # in the worst case a job gets 1 KB/s.
+            share = max(1, share)
+            self._allocations[label] = share
+            return share
+
+
+    def release(self, label):
+        with self._lock:
+            self._allocations.pop(label, None)
+
+
+def get_io_priority(hostname):
+    '''Returns the io_priority entry for hostname, or the default one'''
+    io_priority = settings.io_priority or {}
+    return io_priority.get(hostname, io_priority.get('default', {}))
+
+
+def io_priority_args(priority):
+    '''Returns the nice and ionice arguments to put in front of a command'''
+    args = []
+    if 'ionice_class' in priority or 'ionice_level' in priority:
+        args.append('ionice')
+        if 'ionice_class' in priority:
+            args += ['-c', str(priority['ionice_class'])]
+        if 'ionice_level' in priority:
+            args += ['-n', str(priority['ionice_level'])]
+    if 'nice' in priority:
+        args += ['nice', '-n', str(priority['nice'])]
+    return args
@@ -0,0 +1,291 @@
+from __future__ import with_statement
+
+import os
+import sqlite3
+import sys
+import time
+
+from contextlib import closing
+from optparse import OptionParser
+
+import settings
+import stores
+
+from metrics import parse_rdiff_backup_statistics
+
+'''A catalog of the sessions in every rdiff-backup repository
+
+rdiff-backup --list-increments walks a repository's rdiff-backup-data every
+time it's asked, which adds up to minutes across a whole store. So we keep an
+SQLite catalog in {state_dir}/catalog.sqlite with a row for every session
+(from its session_statistics file) and every run of every job. Jobs update
+it at the end of run_backup() and after pruning, reading only the
+session_statistics files that are new since the last update, and the
+command line answers from the catalog alone:
+
+    python -m ari_backup.catalog list
+    python -m ari_backup.catalog list LABEL
+    python -m ari_backup.catalog restore-plan LABEL 2013-01-01T12:00
+
+'''
+
+CATALOG_FILENAME = 'catalog.sqlite'
+
+SESSION_STATISTICS_PREFIX = 'session_statistics.'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    label TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    elapsed_time REAL,
+    source_files INTEGER,
+    source_file_size INTEGER,
+    increment_file_size INTEGER,
+    destination_size_change INTEGER,
+    errors INTEGER,
+    PRIMARY KEY (repository, filename)
+);
+CREATE INDEX IF NOT EXISTS sessions_by_label ON sessions (label, start_time);
+CREATE TABLE IF NOT EXISTS runs (
+    label TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    finish_time REAL,
+    success INTEGER,
+    PRIMARY KEY (label, start_time)
+);
+'''
+
+# Columns filled from each session statistic
+SESSION_STATISTICS = [
+    ('elapsed_time', 'ElapsedTime'),
+    ('source_files', 'SourceFiles'),
+    ('source_file_size', 'SourceFileSize'),
+    ('increment_file_size', 'IncrementFileSize'),
+    ('destination_size_change', 'TotalDestinationSizeChange'),
+    ('errors', 'Errors'),
+]
+
+
+def get_catalog_path():
+    return os.path.join(settings.state_dir, CATALOG_FILENAME)
+
+
+def connect(path=None):
+    '''Returns a connection to the catalog, creating it if need be'''
+    if path is None:
+        path = get_catalog_path()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Jobs running at the same time take turns writing.
+    connection = sqlite3.connect(path, timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def read_session_statistics(path):
+    '''Returns the raw statistics in a session_statistics file'''
+    with open(path, 'r') as statistics_file:
+        transfer = parse_rdiff_backup_statistics(statistics_file.read())
+    return transfer.get('rdiff_backup', {})
+
+
+def update_repository(connection, label, repository_path):
+    '''Brings the catalog's sessions for one repository up to date
+
+    Only session_statistics files we haven't seen are read, and rows for
+    files that are gone (pruned by --remove-older-than) are deleted. Returns
+    (added, removed).
+
+    '''
+    data_path = os.path.join(repository_path, 'rdiff-backup-data')
+    if os.path.isdir(data_path):
+        filenames = set([name for name in os.listdir(data_path) if name.startswith(SESSION_STATISTICS_PREFIX)])
+    else:
+        filenames = set()
+
+    known = set([row[0] for row in connection.execute(
+        'SELECT filename FROM sessions WHERE repository = ?', (repository_path,))])
+
+    added = 0
+    for filename in sorted(filenames - known):
+        try:
+            statistics = read_session_statistics(os.path.join(data_path, filename))
+        except IOError:
+            # Pruned while we were looking.
+            continue
+        if 'StartTime' not in statistics:
+            continue
+        columns = ['label', 'repository', 'filename', 'start_time']
+        values = [label, repository_path, filename, statistics['StartTime']]
+        for column, statistic in SESSION_STATISTICS:
+            columns.append(column)
+            values.append(statistics.get(statistic))
+        connection.execute('INSERT OR REPLACE INTO sessions ({columns}) VALUES ({placeholders})'.format(
+            columns=', '.join(columns), placeholders=', '.join(['?'] * len(columns))), values)
+        added += 1
+
+    removed = known - filenames
+    for filename in removed:
+        connection.execute('DELETE FROM sessions WHERE repository = ? AND filename = ?', (repository_path, filename))
+
+    connection.commit()
+    return added, len(removed)
+
+
+def record_run(connection, label, start_time, finish_time, success):
+    connection.execute('INSERT OR REPLACE INTO runs (label, start_time, finish_time, success) VALUES (?, ?, ?, ?)',
+        (label, start_time, finish_time, int(bool(success))))
+    connection.commit()
+
+
+def find_repositories():
+    '''Yields (label, repository path) for every repository in the stores
+
+    LVMBackup jobs with lv_streams keep a repository per LV one level down.
+
+    '''
+    for store_path in stores.get_store_paths():
+        if not os.path.isdir(store_path):
+            continue
+        for label in sorted(os.listdir(store_path)):
+            label_path = os.path.join(store_path, label)
+            if os.path.isdir(os.path.join(label_path, 'rdiff-backup-data')):
+                yield label, label_path
+            elif os.path.isdir(label_path):
+                for name in sorted(os.listdir(label_path)):
+                    path = os.path.join(label_path, name)
+                    if os.path.isdir(os.path.join(path, 'rdiff-backup-data')):
+                        yield label, path
+
+
+def list_labels(connection):
+    '''Returns (label, sessions, oldest, newest, increment bytes) per label'''
+    return connection.execute(
+        'SELECT label, COUNT(*), MIN(start_time), MAX(start_time), SUM(increment_file_size) '
+        'FROM sessions GROUP BY label ORDER BY label').fetchall()
+
+
+def list_sessions(connection, label):
+    '''Returns (repository, start time, increment bytes, errors, success)
+    for each of label's sessions, oldest first
+
+    success is the outcome of the run that made the session, if we know it.
+
+    '''
+    return connection.execute(
+        'SELECT repository, sessions.start_time, increment_file_size, errors, '
+        '(SELECT success FROM runs WHERE runs.label = sessions.label '
+        '    AND runs.start_time <= sessions.start_time AND runs.finish_time >= sessions.start_time '
+        '    ORDER BY runs.start_time DESC LIMIT 1) '
+        'FROM sessions WHERE label = ? ORDER BY repository, sessions.start_time', (label,)).fetchall()
+
+
+def plan_restore(connection, label, restore_time):
+    '''Works out how to restore label as it was at restore_time
+
+    Returns a list with a dict per repository: the session to restore from
+    (the newest one at or before restore_time), how many increments
+    rdiff-backup has to apply to the mirror to get there and their total
+    size. Repositories with no session that old are left out.
+
+    '''
+    plans = []
+    repositories = [row[0] for row in connection.execute(
+        'SELECT DISTINCT repository FROM sessions WHERE label = ? ORDER BY repository', (label,))]
+    for repository in repositories:
+        session = connection.execute(
+            'SELECT start_time FROM sessions WHERE repository = ? AND start_time <= ? '
+            'ORDER BY start_time DESC LIMIT 1', (repository, restore_time)).fetchone()
+        if session is None:
+            continue
+        # The newest session is the mirror itself; each session after the
+        # one we want is an increment to apply, newest to oldest.
+        increments, increment_bytes = connection.execute(
+            'SELECT COUNT(*), SUM(increment_file_size) FROM sessions WHERE repository = ? AND start_time > ?',
+            (repository, session[0])).fetchone()
+        plans.append({
+            'repository': repository,
+            'session_time': session[0],
+            'increments': increments,
+            'increment_bytes': increment_bytes or 0,
+        })
+    return plans
+
+
+def parse_time(value):
+    '''Parses seconds since the epoch or a local YYYY-MM-DD[THH:MM[:SS]] time'''
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise ValueError('unrecognized time {value!r}'.format(value=value))
+
+
+def _format_bytes(count):
+    count = float(count or 0)
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(count) < 1024:
+            return '{count:.1f} {unit}'.format(count=count, unit=unit)
+        count /= 1024
+    return '{count:.1f} TiB'.format(count=count)
+
+
+def _format_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog list [LABEL] | restore-plan LABEL TIME | rebuild')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('a command is required')
+
+    with closing(connect()) as connection:
+        if args[0] == 'list' and len(args) == 1:
+            for label, sessions, oldest, newest, increment_bytes in list_labels(connection):
+                print '{label}: {sessions} sessions from {oldest} to {newest}, increments {size}'.format(
+                    label=label, sessions=sessions, oldest=_format_time(oldest), newest=_format_time(newest),
+                    size=_format_bytes(increment_bytes))
+        elif args[0] == 'list' and len(args) == 2:
+            for repository, start_time, increment_bytes, errors, success in list_sessions(connection, args[1]):
+                outcome = {None: '', 0: ' (run failed)', 1: ''}[success]
+                print '{repository} {time} increment {size}, {errors} errors{outcome}'.format(
+                    repository=repository, time=_format_time(start_time), size=_format_bytes(increment_bytes),
+                    errors=errors, outcome=outcome)
+        elif args[0] == 'restore-plan' and len(args) == 3:
+            try:
+                restore_time = parse_time(args[2])
+            except ValueError, e:
+                parser.error(str(e))
+            plans = plan_restore(connection, args[1], restore_time)
+            if not plans:
+                print >> sys.stderr, 'no sessions of {label} at or before {time}'.format(
+                    label=args[1], time=_format_time(restore_time))
+                return 1
+            for plan in plans:
+                print ('{repository}: restore the {time} session, applying {increments} increments '
+                    '({size}):').format(repository=plan['repository'], time=_format_time(plan['session_time']),
+                    increments=plan['increments'], size=_format_bytes(plan['increment_bytes']))
+                print '  {rdiff_backup} -r {session_time} {repository} TARGET'.format(
+                    rdiff_backup=settings.rdiff_backup_path, session_time=int(plan['session_time']),
+                    repository=plan['repository'])
+        elif args[0] == 'rebuild' and len(args) == 1:
+            for label, repository_path in find_repositories():
+                added, removed = update_repository(connection, label, repository_path)
+                print '{repository}: {added} sessions added, {removed} removed'.format(
+                    repository=repository_path, added=added, removed=removed)
+        else:
+            parser.error('unknown command')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,443 @@
+import collections
+import errno
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+import settings
+
+'''Runs commands and streams their output
+
+Commands like rdiff-backup and rsync can produce a lot of output, so rather
+than collecting all of it with communicate() we read it as it's produced, log
+it line by line (dropping lines if there are too many to log) and keep only
+the most recent lines around for error reports. Callers that need the whole
+stdout, like the ZFS snapshot listing, can still ask for it.
+
+A command can also be given a deadline and a stall timeout. It is stalled
+when it has written no output and done no I/O (going by /proc/PID/io, where
+we can read it) for that long, which is how a transfer through a frozen SSH
+session or off a hung NFS mount looks from here. A command that runs out of
+time is sent SIGTERM, then SIGKILL if it hasn't exited
+settings.command_kill_grace seconds later, and it's always waited for so it
+doesn't linger as a zombie.
+
+'''
+
+# Lines longer than this are logged in pieces, so a command writing binary
+# data without newlines doesn't make us buffer it all.
+MAX_LINE_LENGTH = 64 * 1024
+
+# How much we read from a pipe at once.
+READ_SIZE = 64 * 1024
+
+
+def list_descendants(pid):
+    '''Returns the pids of pid's children, their children and so on
+
+    Returns an empty list where there's no /proc to look in.
+
+    '''
+    children = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return []
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{name}/stat'.format(name=name), 'r') as stat_file:
+                stat = stat_file.read()
+            # The command name in parentheses can contain spaces, so the
+            # fields we want are counted from the last ')'.
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+
+    descendants = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            descendants.append(child)
+            pending.append(child)
+    return descendants
+
+
+class LineLogger(object):
+    '''Logs lines at a level, at most lines_per_second of them
+
+    Lines over the limit are counted and a summary is logged when the next
+    second starts, so a command with thousands of errors can't flood syslog.
+
+    '''
+    def __init__(self, logger, level, lines_per_second):
+        self.logger = logger
+        self.level = level
+        self.lines_per_second = lines_per_second
+        self.enabled = logger.isEnabledFor(level)
+
+        self._window_start = 0
+        self._window_count = 0
+        self._suppressed = 0
+
+
+    def _flush_suppressed(self):
+        if self._suppressed:
+            self.logger.log(self.level, '({count} lines of output not logged)'.format(count=self._suppressed))
+            self._suppressed = 0
+
+
+    def log(self, line):
+        if not self.enabled:
+            return
+
+        now = time.time()
+        if now - self._window_start >= 1:
+            self._flush_suppressed()
+            self._window_start = now
+            self._window_count = 0
+
+        if self.lines_per_second and self._window_count >= self.lines_per_second:
+            self._suppressed += 1
+        else:
+            self._window_count += 1
+            self.logger.log(self.level, line)
+
+
+    def close(self):
+        if self.enabled:
+            self._flush_suppressed()
+
+
+class OutputStream(object):
+    '''Splits one of a command's output pipes into lines as data arrives'''
+    def __init__(self, line_logger, tail, capture):
+        self.line_logger = line_logger
+        # A ring buffer of recent lines shared by stdout and stderr, for error
+        # reports, and one of this stream's lines alone, for callers parsing
+        # the end of the output (like transfer statistics) without the other
+        # stream's lines getting in the way.
+        self.tail = tail
+        self.own_tail = collections.deque(maxlen=tail.maxlen)
+        self.capture = capture
+        self.chunks = []
+        self._partial = ''
+
+
+    def _emit(self, line):
+        self.tail.append(line)
+        self.own_tail.append(line)
+        self.line_logger.log(line)
+
+
+    def feed(self, data):
+        if self.capture:
+            self.chunks.append(data)
+
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._emit(line)
+
+        while len(self._partial) > MAX_LINE_LENGTH:
+            self._emit(self._partial[:MAX_LINE_LENGTH])
+            self._partial = self._partial[MAX_LINE_LENGTH:]
+
+
+    def close(self):
+        if self._partial:
+            self._emit(self._partial)
+            self._partial = ''
+        self.line_logger.close()
+
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+    def get_tail(self):
+        return '\n'.join(self.own_tail)
+
+
+class SinkStream(object):
+    '''Passes a command's output on to a file-like object as it arrives
+
+    None of it is logged or kept, so the output can be as big as it likes.
+
+    '''
+    def __init__(self, sink):
+        self.sink = sink
+        self.bytes_written = 0
+
+
+    def feed(self, data):
+        self.sink.write(data)
+        self.bytes_written += len(data)
+
+
+    def close(self):
+        pass
+
+
+    def getvalue(self):
+        return ''
+
+
+    def get_tail(self):
+        return ''
+
+
+class StreamingCommand(object):
+    '''Runs a command, logging its output as it arrives
+
+    stdout is logged at DEBUG and stderr at WARNING, as the output of
+    _run_command always has been. If capture_output is True, all of stdout
+    and stderr is also kept so it can be returned to the caller; otherwise
+    only the last settings.command_output_tail_lines lines are kept. If
+    stdout_sink is given, stdout is written to it instead, as is.
+
+    '''
+    def __init__(self, args, logger, stdin_data=None, capture_output=True, timeout=None, stall_timeout=None,
+                 stdout_sink=None):
+        self.args = args
+        self.logger = logger
+        self.stdin_data = stdin_data
+        self.capture_output = capture_output
+        # seconds the command may run for, and may go without output or I/O
+        # for; None or 0 for no limit
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        # seconds between SIGTERM and SIGKILL
+        self.kill_grace = settings.command_kill_grace
+
+        self.tail = collections.deque(maxlen=settings.command_output_tail_lines)
+        lines_per_second = settings.command_log_lines_per_second
+        if stdout_sink is not None:
+            self.stdout = SinkStream(stdout_sink)
+        else:
+            self.stdout = OutputStream(LineLogger(logger, logging.DEBUG, lines_per_second), self.tail, capture_output)
+        self.stderr = OutputStream(LineLogger(logger, logging.WARNING, lines_per_second), self.tail, capture_output)
+        self.process = None
+
+        # terminate() may be called from another thread, even before run()
+        # has started the process.
+        self._lock = threading.Lock()
+        self.terminated = False
+        # when we give up waiting for SIGTERM to work and send SIGKILL
+        self._kill_time = None
+        # why we stopped the command ourselves, if we did
+        self.timed_out = None
+        self._start_time = None
+        self._last_activity = None
+        self._last_io = None
+
+
+    def get_tail(self):
+        '''Returns the most recent lines of output as a string'''
+        return '\n'.join(self.tail)
+
+
+    def _read_io_counters(self):
+        '''Returns the characters the process and its descendants have read
+        and written so far
+
+        Commands like 'sh -c' or nice leave the work to a child, so the
+        process's own counters may never move. Returns None where /proc/PID/io
+        isn't there or we can't read it.
+
+        '''
+        total = None
+        for pid in [self.process.pid] + list_descendants(self.process.pid):
+            try:
+                with open('/proc/{pid}/io'.format(pid=pid), 'r') as io_file:
+                    counters = dict([line.split(':', 1) for line in io_file.read().splitlines() if ':' in line])
+                io = (int(counters['rchar']), int(counters['wchar']))
+            except (IOError, KeyError, ValueError):
+                # Gone already, or not ours to look at.
+                continue
+            if total is None:
+                total = io
+            else:
+                total = (total[0] + io[0], total[1] + io[1])
+        return total
+
+
+    def _check_limits(self, now):
+        '''Returns why the command has to stop, or None if it can carry on'''
+        if self.timeout and now - self._start_time >= self.timeout:
+            return 'timed out after {seconds:.0f}s'.format(seconds=now - self._start_time)
+
+        if self.stall_timeout:
+            # Output counts as activity as soon as it arrives, so we only
+            # need to look at the I/O counters when there hasn't been any.
+            if now - self._last_activity >= 1:
+                io = self._read_io_counters()
+                if io is not None and io != self._last_io:
+                    self._last_io = io
+                    self._last_activity = now
+            if now - self._last_activity >= self.stall_timeout:
+                return 'stalled with no output or I/O for {seconds:.0f}s'.format(seconds=now - self._last_activity)
+
+        return None
+
+
+    def _enforce_limits(self):
+        '''Stops the command if it ran out of time, killing it if it has to'''
+        now = time.time()
+        if not self.terminated:
+            reason = self._check_limits(now)
+            if reason is not None:
+                self.timed_out = reason
+                self.logger.error('command {reason}, stopping it: {args!r}'.format(reason=reason, args=self.args))
+                self.terminate()
+        elif self._kill_time is not None and now >= self._kill_time and self.process.poll() is None:
+            self.logger.error('command did not exit after SIGTERM, killing it: {args!r}'.format(args=self.args))
+            self._kill()
+
+
+    def _pump(self):
+        '''Moves data between our pipes and the process until it's done'''
+        p = self.process
+        readers = {p.stdout.fileno(): self.stdout, p.stderr.fileno(): self.stderr}
+
+        pending_input = self.stdin_data or ''
+        writers = []
+        if pending_input:
+            writers.append(p.stdin.fileno())
+        else:
+            p.stdin.close()
+
+        while readers or writers:
+            self._enforce_limits()
+
+            # Once we've been terminated and the process is gone, we stop
+            # waiting for its pipes to close; anything it left running in
+            # the background may hold them open much longer.
+            if self.terminated and p.poll() is not None:
+                for stream in readers.values():
+                    stream.close()
+                break
+
+            try:
+                # The timeout lets us notice terminate() being called.
+                readable, writable, ignored = select.select(readers.keys(), writers, [], 1)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in writable:
+                try:
+                    written = os.write(fd, pending_input[:select.PIPE_BUF])
+                except OSError, e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    # The command doesn't want the rest of its input.
+                    written = len(pending_input)
+                pending_input = pending_input[written:]
+                if not pending_input:
+                    writers.remove(fd)
+                    p.stdin.close()
+
+            for fd in readable:
+                data = os.read(fd, READ_SIZE)
+                if data:
+                    self._last_activity = time.time()
+                    readers[fd].feed(data)
+                else:
+                    readers.pop(fd).close()
+
+        self._close_pipes()
+        return self._reap()
+
+
+    def _close_pipes(self):
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            if not pipe.closed:
+                pipe.close()
+
+
+    def _reap(self):
+        '''Waits for the process to exit, killing it if it takes too long
+
+        Once it's been terminated, the process has until _kill_time to exit.
+
+        '''
+        p = self.process
+        while self._kill_time is not None and p.poll() is None:
+            if time.time() >= self._kill_time:
+                self._kill()
+                break
+            time.sleep(0.1)
+        return p.wait()
+
+
+    def run(self):
+        '''Runs the command and returns its exit code
+
+        The exit code is negative if the command was killed by a signal, as
+        it is when terminate() is called.
+
+        '''
+        with self._lock:
+            if self.terminated:
+                return -signal.SIGTERM
+            self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+        self._start_time = self._last_activity = time.time()
+        # We really want to block until our subprocess exits or
+        # KeyboardInterrupt. If we don't, clean up tasks can likely fail.
+        try:
+            return self._pump()
+        except KeyboardInterrupt:
+            # Make sure the command is gone before the clean up tasks run.
+            self.terminate()
+            self._close_pipes()
+            self._reap()
+            raise KeyboardInterrupt
+
+
+    def terminate(self):
+        '''Asks the command to stop; run() returns once it has
+
+        If it's still running kill_grace seconds later, it's killed.
+
+        '''
+        with self._lock:
+            if not self.terminated:
+                self.terminated = True
+                self._kill_time = time.time() + self.kill_grace
+            self._signal(signal.SIGTERM)
+
+
+    def _kill(self):
+        with self._lock:
+            self._signal(signal.SIGKILL)
+
+
+    def _signal(self, signum):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.send_signal(signum)
+            except OSError, e:
+                # It already exited and was reaped.
+                if e.errno != errno.ESRCH:
+                    raise
+
+
+    def get_output(self):
+        '''Returns (stdout, stderr) as _run_command does
+
+        These are the whole output if we captured it, otherwise the last
+        lines of each.
+
+        '''
+        if self.capture_output:
+            return (self.stdout.getvalue(), self.stderr.getvalue())
+        return (self.stdout.get_tail(), self.stderr.get_tail())
@@ -0,0 +1,75 @@
+from history import _median
+
+'''Chooses whether each job compresses its transfer
+
+Compression pays for hosts on slow links with compressible data, and costs
+hosts on fast links whose data is already compressed, since the transfer
+then runs no faster than one core can compress. Rather than one setting for
+everybody, each run records in the metrics log whether it compressed, and
+with settings.adaptive_compression we compare how fast the job's recent
+runs went each way and pick the faster one for the next run.
+
+Throughput here is the bytes the job changed per second of its backup phase,
+so it counts what compression saves on the wire. A job needs a few runs each
+way before we trust the comparison; until then it tries the way it has run
+the least. The way we stop using drops out of the recent runs after a while,
+so it gets tried again, which lets a job follow a host that moves to another
+link or starts holding different data.
+
+adaptive_compression is off by default: once it's on, our choice overrides
+any --compress or --no-compress in a ZFS job's rsync_options.
+
+'''
+
+# How many of a job's most recent runs we compare
+RECENT_RUNS = 10
+
+# How many measured runs each way we want before we compare them
+MIN_SAMPLES = 2
+
+# Runs that changed less than this, in bytes, spend most of their time
+# comparing files, so they say little about the link.
+MIN_BYTES = 16 * 1024 * 1024
+
+
+def get_throughput(record):
+    '''Returns the bytes changed per second of a run's backup phase
+
+    Returns None for failed runs and runs too small to tell us anything.
+
+    '''
+    if not record.get('success'):
+        return None
+    bytes_changed = record.get('transfer', {}).get('bytes_changed')
+    if not bytes_changed or bytes_changed < MIN_BYTES:
+        return None
+    seconds = sum([phase['seconds'] for phase in record.get('phases', []) if phase.get('name') == 'backup'])
+    if seconds <= 0:
+        return None
+    return bytes_changed / float(seconds)
+
+
+def choose_compression(records, default):
+    '''Returns (compress, reason) for a job's next run
+
+    records are the job's recent metrics records, oldest first. default is
+    how the job runs when we know nothing about it.
+
+    '''
+    samples = {True: [], False: []}
+    for record in records:
+        compression = record.get('compression')
+        throughput = get_throughput(record)
+        if compression in (True, False) and throughput is not None:
+            samples[bool(compression)].append(throughput)
+
+    for compress in (bool(default), not default):
+        if len(samples[compress]) < MIN_SAMPLES:
+            return compress, 'measuring throughput with compression {state}'.format(
+                state=compress and 'on' or 'off')
+
+    compressed = _median(samples[True])
+    uncompressed = _median(samples[False])
+    return compressed > uncompressed, ('median throughput {compressed:.1f} MiB/s compressed, '
+        '{uncompressed:.1f} MiB/s uncompressed').format(
+            compressed=compressed / 1024 ** 2, uncompressed=uncompressed / 1024 ** 2)
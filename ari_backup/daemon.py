@@ -0,0 +1,327 @@
+from __future__ import with_statement
+
+import datetime
+import json
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+
+from ari_backup import settings
+from ari_backup.logger import Logger
+from ari_backup.scheduler import Scheduler, list_job_paths, load_jobs
+
+settings.register('daemon_socket_path', '/var/run/ari-backup.sock')
+settings.register('daemon_run_times', ['01:00'])
+
+'''Runs the backup jobs from a long-lived process with a control socket
+
+Rather than cron starting a new process every night, the daemon stays up,
+loads the job scripts at each of settings.daemon_run_times (HH:MM, local
+time) and runs them through the scheduler. While it's up it answers
+requests on a Unix socket, so you can see which jobs are queued, which
+phase each running job is in, how long it has been at it and its latest
+output, and cancel or re-prioritise jobs. SIGTERM stops it the way Ctrl-C
+does: the running jobs are cancelled, and it exits once they've cleaned up.
+
+Requests and replies are one line of JSON each, like
+
+    {"command": "cancel", "label": "db1"}
+
+and the same module is the client:
+
+    python -m ari_backup.daemon serve /etc/ari-backup/jobs.d
+    python -m ari_backup.daemon status
+    python -m ari_backup.daemon cancel db1
+
+'''
+
+# The most we read from a client before giving up on it
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+def _is_listening(socket_path):
+    '''Returns True if something accepts connections on socket_path'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def parse_run_times(run_times):
+    '''Turns a list of 'HH:MM' strings into a sorted list of datetime.time'''
+    parsed = []
+    for run_time in run_times:
+        try:
+            hour, minute = [int(field) for field in str(run_time).split(':')]
+            parsed.append(datetime.time(hour, minute))
+        except ValueError:
+            raise Exception('daemon_run_times entries must be HH:MM, not {run_time!r}'.format(run_time=run_time))
+    return sorted(parsed)
+
+
+def next_run_time(run_times, now):
+    '''Returns the first datetime after now at one of run_times'''
+    for day in (now.date(), now.date() + datetime.timedelta(days=1)):
+        for run_time in run_times:
+            candidate = datetime.datetime.combine(day, run_time)
+            if candidate > now:
+                return candidate
+    return None
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+        if not line:
+            # They hung up without asking anything, like _is_listening().
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a JSON object')
+            reply = self.server.daemon.handle_request(request)
+        except ValueError, e:
+            reply = {'ok': False, 'error': 'bad request: {error}'.format(error=e)}
+        except Exception, e:
+            reply = {'ok': False, 'error': str(e)}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        if os.path.exists(socket_path):
+            if _is_listening(socket_path):
+                raise Exception('another daemon is already listening on {socket_path}'.format(
+                    socket_path=socket_path))
+            # A socket left behind by a daemon that died would stop us binding.
+            os.unlink(socket_path)
+        # Only root gets to cancel backups, so nobody else may connect, even
+        # for a moment after we bind.
+        old_umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+
+class Daemon(object):
+    '''Runs the jobs in jobs_dir at run_times and serves the control socket'''
+    def __init__(self, jobs_dir, socket_path=None, run_times=None):
+        if socket_path is None:
+            socket_path = settings.daemon_socket_path
+        if run_times is None:
+            run_times = settings.daemon_run_times
+        self.jobs_dir = jobs_dir
+        self.socket_path = socket_path
+        self.run_times = parse_run_times(run_times)
+
+        self.logger = Logger('ARIBackup (daemon)', settings.debug_logging)
+
+        self._condition = threading.Condition()
+        self._run_requested = False
+        self._next_run = None
+        # the scheduler for the run in progress, if there is one
+        self.scheduler = None
+        self.last_run = None
+
+
+    def handle_request(self, request):
+        '''Carries out a request from the control socket and returns the reply'''
+        command = request.get('command')
+        with self._condition:
+            scheduler = self.scheduler
+
+        if command == 'status':
+            reply = {'ok': True, 'running': scheduler is not None, 'last_run': self.last_run,
+                'next_run': self._next_run and time.mktime(self._next_run.timetuple()), 'jobs': []}
+            if scheduler is not None:
+                reply['jobs'] = scheduler.status()
+            return reply
+
+        if command == 'run':
+            with self._condition:
+                if scheduler is not None:
+                    return {'ok': False, 'error': 'the jobs are already running'}
+                self._run_requested = True
+                self._condition.notify_all()
+            return {'ok': True, 'result': 'starting the jobs'}
+
+        if command in ('cancel', 'prioritise'):
+            label = request.get('label')
+            if not label:
+                return {'ok': False, 'error': '{command} needs a label'.format(command=command)}
+            if scheduler is None:
+                return {'ok': False, 'error': 'no jobs are running'}
+            if command == 'cancel':
+                result = scheduler.cancel(label)
+            else:
+                result = scheduler.prioritise(label) and 'moved to the front of the queue'
+            if not result:
+                return {'ok': False, 'error': 'no {label} job to {command}'.format(label=label, command=command)}
+            return {'ok': True, 'result': result}
+
+        return {'ok': False, 'error': 'unknown command {command!r}'.format(command=command)}
+
+
+    def _wait_for_next_run(self):
+        with self._condition:
+            self._next_run = next_run_time(self.run_times, datetime.datetime.now())
+            while not self._run_requested:
+                remaining = (self._next_run - datetime.datetime.now()).total_seconds()
+                if remaining <= 0:
+                    break
+                # Wake up now and then, so the clock changing under us (or a
+                # KeyboardInterrupt) doesn't go unnoticed for long.
+                self._condition.wait(min(remaining, 60))
+            self._run_requested = False
+            self._next_run = None
+
+
+    def _run_jobs(self):
+        # Pick up changes to the config file and the job scripts.
+        settings.reload()
+        try:
+            jobs = load_jobs(list_job_paths(self.jobs_dir))
+        except Exception, e:
+            self.logger.error('unable to load the jobs in {jobs_dir}: {error}'.format(jobs_dir=self.jobs_dir, error=e))
+            return
+
+        scheduler = Scheduler(jobs)
+        with self._condition:
+            self.scheduler = scheduler
+        try:
+            scheduler.run()
+        finally:
+            with self._condition:
+                self.scheduler = None
+                self.last_run = time.time()
+
+        # The scheduler handles KeyboardInterrupt by letting the running jobs
+        # clean up; once they have, it's our turn to stop.
+        if scheduler.interrupted:
+            raise KeyboardInterrupt
+
+
+    def serve_forever(self):
+        server = ControlServer(self.socket_path, self)
+        server_thread = threading.Thread(target=server.serve_forever, name='ari-backup control socket')
+        server_thread.daemon = True
+        server_thread.start()
+        self.logger.info('listening on {socket_path}'.format(socket_path=self.socket_path))
+
+        # We stop for SIGTERM as for Ctrl-C, which the scheduler handles by
+        # cancelling the running jobs and waiting for their clean up.
+        old_handler = signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        try:
+            while True:
+                self._wait_for_next_run()
+                self._run_jobs()
+        except KeyboardInterrupt:
+            self.logger.info('stopping')
+        finally:
+            signal.signal(signal.SIGTERM, old_handler)
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def send_request(socket_path, request):
+    '''Sends a request to a running daemon and returns its reply'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request) + '\n')
+        chunks = []
+        while True:
+            data = client.recv(64 * 1024)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        client.close()
+    return json.loads(''.join(chunks))
+
+
+def format_status(reply, show_output=False):
+    '''Formats a status reply for people'''
+    lines = []
+    if reply['running']:
+        lines.append('jobs are running')
+    elif reply.get('next_run'):
+        lines.append('next run at {next_run}'.format(next_run=time.ctime(reply['next_run'])))
+    if reply.get('last_run'):
+        lines.append('last run finished at {last_run}'.format(last_run=time.ctime(reply['last_run'])))
+
+    for job in reply['jobs']:
+        line = '{label:<24} {state:<20}'.format(label=job['label'], state=job['state'])
+        if job['state'] == 'running':
+            line += ' {elapsed:>8.0f}s {phase}'.format(elapsed=job['elapsed'], phase=job['phase'] or '')
+        lines.append(line)
+        if show_output and job.get('output'):
+            lines += ['    ' + output_line for output_line in job['output'].splitlines()]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] serve JOBS_DIR | status | run | cancel LABEL | prioritise LABEL')
+    parser.add_option('-s', '--socket', default=None,
+        help='path of the control socket (default settings.daemon_socket_path)')
+    parser.add_option('-o', '--output', action='store_true', default=False,
+        help="with status, show each running job's latest output")
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('a command is required')
+
+    socket_path = options.socket or settings.daemon_socket_path
+    command, args = args[0], args[1:]
+    if command == 'serve':
+        if len(args) != 1:
+            parser.error('serve needs a jobs directory')
+        Daemon(args[0], socket_path).serve_forever()
+        return 0
+
+    request = {'command': command}
+    if command in ('cancel', 'prioritise'):
+        if len(args) != 1:
+            parser.error('{command} needs a label'.format(command=command))
+        request['label'] = args[0]
+    elif command not in ('status', 'run'):
+        parser.error('unknown command {command}'.format(command=command))
+
+    try:
+        reply = send_request(socket_path, request)
+    except socket.error, e:
+        print >> sys.stderr, 'unable to reach the daemon at {socket_path}: {error}'.format(
+            socket_path=socket_path, error=e)
+        return 1
+
+    if not reply['ok']:
+        print >> sys.stderr, reply['error']
+        return 1
+    if command == 'status':
+        print format_status(reply, options.output)
+    else:
+        print reply['result']
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import os
+import re
+import time
+
+import catalog
+
+'''Database dumps streamed into the backup store
+
+A pre-job hook that dumps a database to a file on the source host, for
+rdiff-backup to pick up, needs free space there the size of the dump and
+reads it all back a second time. ARIBackup._capture_dump() runs the dump
+command instead and streams its stdout through gzip into
+
+    {store}/.dumps/{label}/{name}.{YYYY-MM-DDTHH:MM:SS}.gz
+
+a chunk at a time, so it takes the same memory however big the dump is.
+A dump only gets its name once it's complete.
+
+_remove_older_than() prunes the dumps with the same timespec it gives
+rdiff-backup --remove-older-than, which we understand as rdiff-backup does:
+an interval like '30D' or '2W3D' (s, m, h, D, W, M and Y, where a month is
+30 days and a year 365), a count of dumps to keep like '10B', or a time. The
+newest dump of each name is always kept, as rdiff-backup always keeps the
+mirror.
+
+'''
+
+DUMPS_DIRNAME = '.dumps'
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+DUMP_FILENAME_RE = re.compile(r'^(?P<name>.+)\.(?P<time>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)\.gz$')
+
+INTERVAL_RE = re.compile(r'^(\d+[smhDWMY])+$')
+
+INTERVAL_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'D': 24 * 60 * 60,
+    'W': 7 * 24 * 60 * 60,
+    'M': 30 * 24 * 60 * 60,
+    'Y': 365 * 24 * 60 * 60,
+}
+
+
+def get_dump_dir(store_path, label):
+    return os.path.join(store_path, DUMPS_DIRNAME, label)
+
+
+def get_dump_filename(name, timestamp):
+    if not name or '/' in name or name.startswith('.'):
+        raise Exception('{name!r} is not a usable dump name'.format(name=name))
+    return '{name}.{time}.gz'.format(name=name, time=time.strftime(TIMESTAMP_FORMAT, time.localtime(timestamp)))
+
+
+def parse_dump_filename(filename):
+    '''Returns (name, timestamp) for a finished dump's file, otherwise None'''
+    match = DUMP_FILENAME_RE.match(filename)
+    if match is None:
+        return None
+    return match.group('name'), time.mktime(time.strptime(match.group('time'), TIMESTAMP_FORMAT))
+
+
+def parse_timespec(timespec, now=None):
+    '''Parses an rdiff-backup --remove-older-than timespec
+
+    Returns ('count', n) for a count of backups to keep, otherwise ('time',
+    cutoff), where cutoff is seconds since the epoch. Raises ValueError if we
+    can't make sense of it.
+
+    '''
+    if now is None:
+        now = time.time()
+    timespec = str(timespec).strip()
+
+    if re.match(r'^\d+B$', timespec):
+        return 'count', int(timespec[:-1])
+    if timespec == 'now':
+        return 'time', now
+    if INTERVAL_RE.match(timespec):
+        seconds = 0
+        for count, unit in re.findall(r'(\d+)([smhDWMY])', timespec):
+            seconds += int(count) * INTERVAL_UNITS[unit]
+        return 'time', now - seconds
+    # Any UTC offset is ignored, so the time is taken as local time.
+    return 'time', catalog.parse_time(re.sub(r'([+-]\d\d:\d\d|Z)$', '', timespec))
+
+
+def find_expired_dumps(filenames, timespec, now=None):
+    '''Returns the filenames of the dumps timespec says we can remove'''
+    kind, limit = parse_timespec(timespec, now)
+
+    # name -> list of (timestamp, filename), newest first
+    dumps = {}
+    for filename in filenames:
+        parsed = parse_dump_filename(filename)
+        if parsed is not None:
+            dumps.setdefault(parsed[0], []).append((parsed[1], filename))
+
+    expired = []
+    for name, name_dumps in dumps.items():
+        name_dumps.sort(reverse=True)
+        if kind == 'count':
+            older = name_dumps[max(limit, 1):]
+        else:
+            older = [dump for dump in name_dumps[1:] if dump[0] < limit]
+        expired += [filename for timestamp, filename in older]
+    return sorted(expired)
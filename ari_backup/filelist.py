@@ -0,0 +1,240 @@
+from __future__ import with_statement
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import settings
+
+'''Compiles a job's include and exclude lists into one globbing filelist
+
+Passing every entry of include_dir_list and exclude_dir_list as its own
+--include or --exclude argument runs into ARG_MAX on jobs with thousands of
+generated excludes, and rdiff-backup tries every rule on every file. Instead
+we normalise the rules, drop duplicates and rules a broader rule already
+covers, and write what's left to a file for --include-globbing-filelist:
+the excludes, as "- " lines, then the includes, as "+ " lines. The first
+rule that matches a file decides, so this selects the same files the
+arguments did, since those also put every exclude before every include.
+
+Compiled filelists are cached under {state_dir}/filelists by a hash of the
+rules, so an unchanged job doesn't recompile them every night. Run this
+module on a jobs directory to see how many rules each job's filelist kept:
+
+    python -m ari_backup.filelist /etc/ari-backup/jobs.d
+
+'''
+
+# Bump this when compile_selection() changes, so cached filelists compiled
+# the old way aren't used.
+COMPILER_VERSION = 1
+
+# Cached filelists that haven't been used for this many days are removed.
+CACHE_MAX_AGE_DAYS = 30
+
+GLOB_CHARS = '*?['
+
+
+def get_cache_dir():
+    return os.path.join(settings.state_dir, 'filelists')
+
+
+def normalise_rule(rule):
+    '''Returns rule without redundant slashes, dots or trailing slashes'''
+    rule = rule.strip()
+    if not rule:
+        return None
+    return os.path.normpath(rule).replace('//', '/')
+
+
+def _dedupe(rules):
+    seen = set()
+    unique = []
+    for rule in rules:
+        rule = normalise_rule(rule)
+        if rule is not None and rule not in seen:
+            seen.add(rule)
+            unique.append(rule)
+    return unique
+
+
+def _components(rule):
+    return tuple([component for component in rule.split('/') if component])
+
+
+def _prefixes(components, strict=True):
+    '''Returns the leading parts of a tuple of components
+
+    With strict, components itself isn't one of them.
+
+    '''
+    length = len(components)
+    if not strict:
+        length += 1
+    return [components[:i] for i in range(length)]
+
+
+def _has_glob(rule):
+    for char in GLOB_CHARS:
+        if char in rule:
+            return True
+    return False
+
+
+def _drop_covered(rules):
+    '''Drops the rules that a broader rule in the list covers
+
+    A rule covers another when its path components are a leading part of the
+    other's. A component with glob characters matches at least what the same
+    component does in the narrower rule, but '**' can span components, so a
+    rule with '**' in it never covers another.
+
+    '''
+    covering = set([_components(rule) for rule in rules if '**' not in rule])
+    return [rule for rule in rules
+        if not [prefix for prefix in _prefixes(_components(rule)) if prefix in covering]]
+
+
+def compile_selection(include_dir_list, exclude_dir_list, include_filelists=False):
+    '''Returns (includes, excludes) with the redundant rules taken out
+
+    Excludes are checked before includes, so:
+      an include or exclude covered by a broader one of its own kind goes,
+      an include covered by an exclude would never match, so it goes,
+      an exclude that doesn't overlap any include can only match files the
+        final '--exclude **' excludes anyway, so it goes too.
+
+    The last one is only safe when we know all of the includes, so it's
+    skipped if there are include filelists or includes with glob characters,
+    and excludes with glob characters are always kept.
+
+    '''
+    excludes = _drop_covered(_dedupe(exclude_dir_list))
+    includes = _drop_covered(_dedupe(include_dir_list))
+
+    covering_excludes = set([_components(exclude) for exclude in excludes if '**' not in exclude])
+    includes = [include for include in includes if not [prefix
+        for prefix in _prefixes(_components(include), strict=False) if prefix in covering_excludes]]
+
+    if not include_filelists and not [include for include in includes if _has_glob(include)]:
+        include_components = set([_components(include) for include in includes])
+        # An exclude above an include matters too: it stops rdiff-backup
+        # descending to the include at all.
+        above_includes = set()
+        for components in include_components:
+            above_includes.update(_prefixes(components))
+        excludes = [exclude for exclude in excludes
+            if _has_glob(exclude) or _components(exclude) in above_includes
+            or [prefix for prefix in _prefixes(_components(exclude)) if prefix in include_components]]
+
+    return includes, excludes
+
+
+def format_filelist(includes, excludes):
+    lines = ['- ' + exclude for exclude in excludes]
+    lines += ['+ ' + include for include in includes]
+    return ''.join([line + '\n' for line in lines])
+
+
+def _prune_cache(cache_dir):
+    cutoff = time.time() - CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Someone else got to it first.
+            pass
+
+
+def _write_file(path, data):
+    # Write a new file and rename it over the old one, so nobody reads half
+    # a file. Jobs run as threads, so each writer needs its own temp file.
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+        dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(data)
+        # mkstemp makes the file readable only by us.
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def get_compiled_filelist(include_dir_list, exclude_dir_list, include_filelists=False):
+    '''Returns the path of the compiled filelist for these rules and its stats
+
+    The stats are a dict with the number of rules given and kept. Jobs with
+    the same rules share a filelist.
+
+    '''
+    key = hashlib.sha1(json.dumps(
+        [COMPILER_VERSION, list(include_dir_list), list(exclude_dir_list), bool(include_filelists)])).hexdigest()
+    cache_dir = get_cache_dir()
+    path = os.path.join(cache_dir, key + '.filelist')
+    stats_path = os.path.join(cache_dir, key + '.json')
+
+    try:
+        with open(stats_path, 'r') as stats_file:
+            stats = json.load(stats_file)
+        if os.path.exists(path):
+            # Mark them used, so _prune_cache() leaves them alone.
+            os.utime(path, None)
+            os.utime(stats_path, None)
+            return path, stats
+    except (IOError, ValueError):
+        pass
+
+    includes, excludes = compile_selection(include_dir_list, exclude_dir_list, include_filelists)
+    stats = {
+        'input_rules': len(include_dir_list) + len(exclude_dir_list),
+        'output_rules': len(includes) + len(excludes),
+        'includes': len(includes),
+        'excludes': len(excludes),
+    }
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another job may have just made it.
+            if not os.path.isdir(cache_dir):
+                raise
+    else:
+        _prune_cache(cache_dir)
+    _write_file(path, format_filelist(includes, excludes))
+    _write_file(stats_path, json.dumps(stats))
+
+    return path, stats
+
+
+def main(argv=None):
+    # The scheduler imports ari_backup, which imports us, so we import it
+    # here rather than at the top.
+    from ari_backup.scheduler import list_job_paths, load_jobs
+
+    parser = OptionParser(usage='%prog JOBS_DIR')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('a jobs directory is required')
+
+    for job in load_jobs(list_job_paths(args[0])):
+        if not hasattr(job, 'include_dir_list'):
+            continue
+        path, stats = get_compiled_filelist(job.include_dir_list, job.exclude_dir_list,
+            bool(job.include_file_list))
+        print '{label}: kept {output_rules} of {input_rules} rules ({includes} includes, {excludes} excludes)'.format(
+            label=job.label, **stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
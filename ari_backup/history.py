@@ -0,0 +1,108 @@
+from __future__ import with_statement
+
+import json
+import os
+
+import metrics
+
+'''Job history from the metrics log
+
+Every run of a job appends a record to the metrics log (see metrics.py) with
+its duration and what it transferred. This module reads those records back
+so the scheduler can estimate how long each job will take tonight, order the
+queue to finish the whole night as early as possible, and compare what it
+predicted with what actually happened.
+
+'''
+
+# How many of a job's most recent runs we base its estimates on
+RECENT_RUNS = 7
+
+
+def load_history(path=None, recent_runs=RECENT_RUNS):
+    '''Returns a dict of label -> list of that job's most recent records
+
+    Records are oldest first. Besides path, we read the records it held
+    before it was last rotated. Lines we can't parse are skipped.
+
+    '''
+    if path is None:
+        path = metrics.get_metrics_path()
+
+    history = {}
+    for metrics_path in (metrics.get_rotated_path(path), path):
+        if not os.path.exists(metrics_path):
+            continue
+        with open(metrics_path, 'r') as metrics_file:
+            for line in metrics_file:
+                try:
+                    record = json.loads(line)
+                    label = record['label']
+                except (ValueError, KeyError, TypeError):
+                    continue
+                records = history.setdefault(label, [])
+                records.append(record)
+                if len(records) > recent_runs:
+                    del records[0]
+
+    return history
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def expected_duration(records):
+    '''Returns the median duration of the successful runs in records
+
+    Failed runs usually stop early, so they would make a job look shorter
+    than it is. Returns None if there's nothing to go on.
+
+    '''
+    return _median([record['duration'] for record in records if record.get('success') and 'duration' in record])
+
+
+def expected_bytes(records):
+    '''Returns the median bytes changed per successful run, or None'''
+    return _median([record['transfer']['bytes_changed'] for record in records
+        if record.get('success') and 'bytes_changed' in record.get('transfer', {})])
+
+
+def expected_durations(labels, history):
+    '''Returns a dict of label -> expected duration in seconds
+
+    Jobs we know nothing about get the longest duration we know of, so they
+    are started early rather than risking a long unknown job starting last.
+
+    '''
+    known = {}
+    for label in labels:
+        duration = expected_duration(history.get(label, []))
+        if duration is not None:
+            known[label] = duration
+
+    fallback = 0
+    if known:
+        fallback = max(known.values())
+
+    durations = {}
+    for label in labels:
+        durations[label] = known.get(label, fallback)
+    return durations
+
+
+def format_offset(seconds):
+    '''Formats seconds since the start of the night as +HH:MM:SS'''
+    sign = '+'
+    if seconds < 0:
+        sign = '-'
+        seconds = -seconds
+    seconds = int(round(seconds))
+    return '{sign}{hours:02d}:{minutes:02d}:{seconds:02d}'.format(
+        sign=sign, hours=seconds // 3600, minutes=seconds % 3600 // 60, seconds=seconds % 60)
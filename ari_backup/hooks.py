@@ -0,0 +1,111 @@
+from __future__ import with_statement
+
+import sys
+import threading
+
+import settings
+
+'''Hooks that run alongside each other
+
+Each entry in a job's hook lists runs after the one before it has finished,
+so a job that dumps three databases before its transfer waits for all three
+dumps in turn. A HookGroup is one entry that runs several hooks at once:
+
+    self.pre_job_hook_list.append((HookGroup([
+        (self._dump_database, {'host': 'db1'}),
+        (self._dump_database, {'host': 'db2'}),
+        [(self._stop_app, {'host': 'app1'}), (self._dump_app, {'host': 'app1'})],
+    ], name='dumps'), {}))
+
+A member is either a (hook, kwargs) tuple or a list of them, which run one
+after another, so hooks that depend on each other can share a member. The
+group behaves like any other hook when it fails: once a member fails no more
+are started, the ones already running are waited for, and the first failure
+is raised, so the job goes on to its error-case post-job hooks.
+
+Members run in threads rather than on an event loop; the commands they run
+through _run_command are already safe to run from several threads at once.
+
+'''
+
+
+class HookGroup(object):
+    '''A hook list entry whose members run at the same time
+
+    At most max_concurrency members (settings.max_concurrent_hooks if it's
+    None) run at once.
+
+    '''
+    def __init__(self, members, max_concurrency=None, name='hook_group'):
+        self.members = list(members)
+        self.max_concurrency = max_concurrency
+        # ARIBackup names each hook's metrics phase after its __name__.
+        self.__name__ = name
+
+
+    def _get_tasks(self, member):
+        if isinstance(member, list):
+            return member
+        return [member]
+
+
+    def run(self, run_hook, extra_kwargs=None):
+        '''Runs the members and returns once all of those started are done
+
+        run_hook(hook, kwargs) is called for each hook, with extra_kwargs
+        (like error_case) added to the hook's own kwargs.
+
+        '''
+        max_concurrency = self.max_concurrency or settings.max_concurrent_hooks
+        pending = list(self.members)
+        # the sys.exc_info() of each member that failed
+        failures = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if failures or not pending:
+                        return
+                    member = pending.pop(0)
+                try:
+                    for hook, kwargs in self._get_tasks(member):
+                        with lock:
+                            if failures:
+                                return
+                        kwargs = dict(kwargs)
+                        kwargs.update(extra_kwargs or {})
+                        run_hook(hook, kwargs)
+                except Exception:
+                    with lock:
+                        failures.append(sys.exc_info())
+
+        threads = []
+        for i in range(min(max_concurrency, len(pending))):
+            thread = threading.Thread(target=worker, name='{name} {number}'.format(name=self.__name__, number=i))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for thread in threads:
+                # We wait with a timeout so that KeyboardInterrupt reaches us.
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            # The members' commands got the interrupt too, so the running
+            # members will stop soon. Start no more and wait for them, so
+            # clean up doesn't start while they're still going.
+            with lock:
+                del pending[:]
+            for thread in threads:
+                thread.join()
+            raise
+
+        if failures:
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+
+    def __call__(self, **kwargs):
+        self.run(lambda hook, hook_kwargs: hook(**hook_kwargs), kwargs)
@@ -1,8 +1,139 @@
+import atexit
 import logging
+import Queue
+import socket
 import sys
+import threading
 
 from logging.handlers import SysLogHandler
 
+# All Logger instances in a process hand their records to one queue, and a
+# single background thread writes them out through one set of handlers. That
+# way logging never blocks a backup job on syslog, and running many jobs in
+# one process doesn't mean one syslog socket per job.
+
+# How many records may wait for the writer before we start dropping them.
+# Errors are written straight away instead.
+MAX_QUEUED_RECORDS = 10000
+
+_lock = threading.Lock()
+_writer = None
+
+
+class _LogWriter(threading.Thread):
+    '''Background thread that writes queued records to the shared handlers'''
+    def __init__(self):
+        threading.Thread.__init__(self, name='ari-backup log writer')
+        self.daemon = True
+        self.queue = Queue.Queue(MAX_QUEUED_RECORDS)
+        self.dropped = 0
+        # Once flushed, we write records as they come instead: the exit
+        # handlers that run after ours (closing SSH pools, say) still log.
+        self.stopped = False
+        self._put_lock = threading.Lock()
+
+        formatter = logging.Formatter('%(name)s [%(levelname)s] %(message)s')
+        self.handlers = []
+
+        # Emit to sys.stderr, ERROR and above
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setLevel(logging.ERROR)
+        stream_handler.setFormatter(formatter)
+        self.handlers.append(stream_handler)
+
+        # Emit to syslog. Each Logger decides whether that's INFO and above or
+        # DEBUG and above.
+        try:
+            syslog_handler = SysLogHandler('/dev/log')
+        except socket.error:
+            # No syslog here (in a container, say); stderr will have to do.
+            syslog_handler = None
+        if syslog_handler is not None:
+            syslog_handler.setLevel(logging.DEBUG)
+            syslog_handler.setFormatter(formatter)
+            self.handlers.append(syslog_handler)
+
+
+    def put(self, record):
+        with self._put_lock:
+            if not self.stopped:
+                try:
+                    self.queue.put_nowait(record)
+                    return
+                except Queue.Full:
+                    # Dropping a record is better than stalling a backup on
+                    # logging, but not an error, which may be all anyone ever
+                    # hears about a failed backup.
+                    if record.levelno < logging.ERROR:
+                        self.dropped += 1
+                        return
+        self._write(record)
+
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+    def _report_dropped(self):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self._write(logging.makeLogRecord({
+                'name': 'ARIBackup (logger)',
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': '{count} log records were dropped'.format(count=dropped),
+            }))
+
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            self._report_dropped()
+            if record is None:
+                return
+            self._write(record)
+
+
+    def flush(self):
+        '''Writes out everything queued and stops the thread
+
+        Records put after this are written straight away.
+
+        '''
+        with self._put_lock:
+            self.stopped = True
+            # Everything queued before we stopped comes before this.
+            self.queue.put(None)
+        self.join()
+        for handler in self.handlers:
+            handler.flush()
+
+
+def _get_writer():
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = _LogWriter()
+            _writer.start()
+            atexit.register(_writer.flush)
+    return _writer
+
+
+class QueueHandler(logging.Handler):
+    '''Hands records to the shared background writer'''
+    def emit(self, record):
+        # Format the message now, while its arguments still hold the values
+        # they had when it was logged.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        _get_writer().put(record)
+
+
 class Logger(logging.Logger):
     '''
     Subclass of the normal logger, to set up desired logging behavior
@@ -10,25 +141,18 @@ class Logger(logging.Logger):
     Specifically:
       ERROR and above go to stderr
       INFO and above go to syslog, unless debug is True then DEBUG and above
+
+    Records are written by a background thread shared by all instances. The
+    name still identifies the job that logged them.
     '''
     def __init__(self, name, debug=False):
         logging.Logger.__init__(self, name)
 
-        # Set the name, much like logging.getLogger(name) would
-        formatter = logging.Formatter('%(name)s [%(levelname)s] %(message)s')
-
-        # Emit to sys.stderr, ERROR and above
-        stream_handler = logging.StreamHandler(sys.stderr)
-        stream_handler.setLevel(logging.ERROR)
-        stream_handler.setFormatter(formatter)
-        self.addHandler(stream_handler)
-
-        # Emit to syslog, INFO and above, or DEBUG if debug
-        syslog_handler = SysLogHandler('/dev/log')
         if debug:
-            syslog_handler.setLevel(logging.DEBUG)
+            self.setLevel(logging.DEBUG)
         else:
-            syslog_handler.setLevel(logging.INFO)
-        syslog_handler.setFormatter(formatter)
-        self.addHandler(syslog_handler)
+            self.setLevel(logging.INFO)
+        self.addHandler(_queue_handler)
+
 
+_queue_handler = QueueHandler()
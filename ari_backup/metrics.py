@@ -0,0 +1,192 @@
+from __future__ import with_statement
+
+import errno
+import json
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+import settings
+
+'''Per-run timing and transfer metrics for backup jobs
+
+Every run of a job records how long each hook and the data backup took, plus
+what the transfer reported (files scanned, bytes changed and so on). At the
+end of the run the record is appended as one JSON line to metrics.jsonl in
+settings.state_dir so it can be charted, or used to plan the next night.
+Once the file grows past MAX_METRICS_BYTES it's renamed to metrics.jsonl.1,
+replacing the one before, so reading the history back never costs more than
+two files' worth.
+
+'''
+
+# Jobs in the same process append to the metrics file from several threads.
+_write_lock = threading.Lock()
+
+# How big the metrics file may get before it's rotated. A few thousand
+# records: at least a week's runs of a few hundred jobs.
+MAX_METRICS_BYTES = 4 * 1024 ** 2
+
+# rdiff-backup --print-statistics lines look like
+# "SourceFileSize 1234 (1.21 KB)" or "StartTime 1357016400.00 (Tue Jan 1 ...)"
+RDIFF_BACKUP_STATISTIC_RE = re.compile(r'^(\w+) (-?[\d.]+)( \(.*\))?$')
+
+# rsync --stats lines look like "Number of files: 1,234 (reg: 1,000, dir: 234)"
+# or "Total transferred file size: 1,234 bytes"
+RSYNC_STATISTIC_RE = re.compile(r'^([A-Za-z][A-Za-z ]+): ([\d,.]+)')
+
+
+def get_metrics_path():
+    return os.path.join(settings.state_dir, 'metrics.jsonl')
+
+
+def get_rotated_path(path):
+    '''Returns where the records from before path was last rotated are'''
+    return path + '.1'
+
+
+def _rotate(path):
+    try:
+        if os.path.getsize(path) < MAX_METRICS_BYTES:
+            return
+        os.rename(path, get_rotated_path(path))
+    except OSError, e:
+        # Another process may have just rotated it.
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _number(value):
+    value = value.replace(',', '')
+    if '.' in value:
+        return float(value)
+    return int(value)
+
+
+def parse_rdiff_backup_statistics(output):
+    '''Parses rdiff-backup --print-statistics output
+
+    Returns a dict with files_scanned, files_changed, bytes_changed and
+    destination_size_change, plus every statistic rdiff-backup reported under
+    its own name. Anything we don't recognize is ignored.
+
+    '''
+    stats = {}
+    for line in output.splitlines():
+        match = RDIFF_BACKUP_STATISTIC_RE.match(line.strip())
+        if match:
+            stats[match.group(1)] = _number(match.group(2))
+
+    if 'SourceFiles' not in stats:
+        return {}
+
+    transfer = {'rdiff_backup': stats}
+    transfer['files_scanned'] = stats.get('SourceFiles', 0)
+    transfer['files_changed'] = (stats.get('NewFiles', 0) + stats.get('ChangedFiles', 0) +
+        stats.get('DeletedFiles', 0))
+    transfer['bytes_changed'] = stats.get('NewFileSize', 0) + stats.get('ChangedSourceSize', 0)
+    transfer['destination_size_change'] = stats.get('TotalDestinationSizeChange', 0)
+    return transfer
+
+
+def parse_rsync_statistics(output):
+    '''Parses rsync --stats output
+
+    Returns a dict with files_scanned, files_changed, bytes_changed,
+    bytes_sent and bytes_received, plus every statistic rsync reported keyed
+    by its lower-cased name.
+
+    '''
+    stats = {}
+    for line in output.splitlines():
+        match = RSYNC_STATISTIC_RE.match(line.strip())
+        if match:
+            stats[match.group(1).lower().replace(' ', '_')] = _number(match.group(2))
+
+    if 'number_of_files' not in stats:
+        return {}
+
+    transfer = {'rsync': stats}
+    transfer['files_scanned'] = stats['number_of_files']
+    # rsync 3.1 reports regular files, older versions report all files.
+    transfer['files_changed'] = stats.get('number_of_regular_files_transferred',
+        stats.get('number_of_files_transferred', 0)) + stats.get('number_of_deleted_files', 0)
+    transfer['bytes_changed'] = stats.get('total_transferred_file_size', 0)
+    transfer['bytes_sent'] = stats.get('total_bytes_sent', 0)
+    transfer['bytes_received'] = stats.get('total_bytes_received', 0)
+    # How much smaller compression made the data rsync had to send
+    if transfer['bytes_sent'] and 'literal_data' in stats:
+        transfer['compression_ratio'] = round(stats['literal_data'] / float(transfer['bytes_sent']), 2)
+    return transfer
+
+
+class JobMetrics(object):
+    '''Collects the metrics for one run of a backup job'''
+    def __init__(self, job):
+        self.job = job
+        self.start = None
+        self.finish = None
+        self.success = None
+        self.current_phase = None
+        # whether the transfer was compressed, or None if we left it to the
+        # transfer's own options
+        self.compression = None
+        # list of dicts with the name, duration and outcome of each phase
+        self.phases = []
+        # statistics reported by the transfer
+        self.transfer = {}
+
+
+    @contextmanager
+    def phase(self, name, current=True):
+        '''Times the code in the with block as the phase name
+
+        With current False, current_phase is left alone; use that for phases
+        that run alongside others.
+
+        '''
+        if current:
+            self.current_phase = name
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.phases.append({'name': name, 'seconds': round(time.time() - start, 3), 'ok': ok})
+            if current:
+                self.current_phase = None
+
+
+    def to_record(self):
+        return {
+            'label': self.job.label,
+            'class': self.job.__class__.__name__,
+            'source_hostname': self.job.source_hostname,
+            'start': self.start,
+            'finish': self.finish,
+            'duration': round(self.finish - self.start, 3),
+            'success': self.success,
+            'phases': self.phases,
+            'transfer': self.transfer,
+            'compression': self.compression,
+        }
+
+
+    def write(self):
+        '''Appends our record to the metrics file as one JSON line'''
+        path = get_metrics_path()
+        line = json.dumps(self.to_record(), sort_keys=True) + '\n'
+        try:
+            with _write_lock:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                _rotate(path)
+                with open(path, 'a') as metrics_file:
+                    metrics_file.write(line)
+        except (IOError, OSError), e:
+            # Losing a metrics record shouldn't fail the backup.
+            self.job.logger.warning('unable to write metrics to {path}: {error}'.format(path=path, error=e))
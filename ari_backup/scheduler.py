@@ -0,0 +1,620 @@
+from __future__ import with_statement
+
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+
+import ari_backup
+from ari_backup import settings
+from ari_backup.budget import BandwidthBudget
+from ari_backup.history import expected_durations, format_offset, load_history
+from ari_backup.logger import Logger
+from ari_backup.ssh import SSHConnectionPool
+
+'''Runs a set of backup jobs concurrently within one process
+
+The scheduler loads the job scripts in a jobs directory (usually
+/etc/ari-backup/jobs.d) as ARIBackup instances and runs them on a pool of
+worker threads. Concurrency is bounded globally, per source host and per
+backup store so that raising the number of concurrent jobs doesn't put two
+heavy jobs on the same hypervisor or the same backup disk.
+
+Job scripts are written as they always have been: they build an ARIBackup
+(or subclass) instance and call run_backup() on it. While the scheduler loads
+a script, run_backup() only registers the job; the scheduler runs it later.
+
+'''
+
+# run-parts only considers file names made of these characters when it's
+# running in LSB mode, so we do the same.
+JOB_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+$')
+
+
+class ExternalJob(object):
+    '''Wraps a job script that isn't a Python ari-backup job
+
+    These are run as a subprocess, just like run-parts would. We don't know
+    which host or store they touch, so only the global limit applies to them.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.label = os.path.basename(path)
+        self.source_hostname = None
+        self.logger = Logger('ARIBackup ({label})'.format(label=self.label), settings.debug_logging)
+        self.process = None
+
+
+    def _get_backup_store(self):
+        return None
+
+
+    def cancel(self):
+        '''Terminates the script; it has to clean up after itself'''
+        if self.process is None or self.process.returncode is not None:
+            return False
+        self.logger.error('cancelling {path}...'.format(path=self.path))
+        self.process.terminate()
+        return True
+
+
+    def run_backup(self):
+        self.logger.info('started')
+        # The script and anything it leaves running get none of the other
+        # jobs' pipes.
+        self.process = subprocess.Popen([self.path], close_fds=True)
+        exitcode = self.process.wait()
+        if exitcode != 0:
+            self.logger.error('{path} exited with {exitcode}'.format(path=self.path, exitcode=exitcode))
+        self.logger.info('stopped')
+        return exitcode == 0
+
+
+class BrokenJob(object):
+    '''Stands in for a job script we couldn't load
+
+    Running it only fails, so the script is counted with the failed jobs
+    while the other scripts run as usual.
+
+    '''
+    def __init__(self, path, error):
+        self.path = path
+        self.error = error
+        self.label = os.path.basename(path)
+        self.source_hostname = None
+        self.logger = Logger('ARIBackup ({label})'.format(label=self.label), settings.debug_logging)
+        self.logger.error('unable to load {path}: {error}'.format(path=path, error=error))
+
+
+    def _get_backup_store(self):
+        return None
+
+
+    def run_backup(self):
+        self.logger.error('not run, since {path} could not be loaded'.format(path=self.path))
+        return False
+
+
+def list_job_paths(jobs_dir):
+    '''Returns the paths of the job scripts in jobs_dir, like run-parts --list'''
+    paths = []
+    for name in sorted(os.listdir(jobs_dir)):
+        path = os.path.join(jobs_dir, name)
+        if not JOB_NAME_RE.match(name):
+            continue
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            paths.append(path)
+
+    return paths
+
+
+def _is_python_script(path):
+    if path.endswith('.py'):
+        return True
+    with open(path, 'r') as job_file:
+        first_line = job_file.readline()
+
+    return first_line.startswith('#!') and 'python' in first_line
+
+
+def load_jobs(paths):
+    '''Loads job scripts and returns the jobs they define
+
+    Python job scripts are executed as if they were run directly, except that
+    calls to run_backup() only register the job. Any other executable is
+    wrapped in an ExternalJob.
+
+    A script that raises an exception (including a SyntaxError), or exits
+    non-zero without registering a job, becomes a BrokenJob, so it fails on
+    its own rather than stopping the rest from loading. The jobs it
+    registered before it raised are dropped, since it didn't finish setting
+    them up. Scripts often end with sys.exit(), and the exit code of one that
+    registered jobs doesn't mean anything here, so we ignore it.
+
+    '''
+    jobs = []
+    for path in paths:
+        try:
+            if not _is_python_script(path):
+                jobs.append(ExternalJob(path))
+                continue
+        except IOError, e:
+            jobs.append(BrokenJob(path, e))
+            continue
+
+        collected = []
+        ari_backup._job_collector = collected
+        try:
+            execfile(path, {'__name__': '__main__', '__file__': path})
+        except SystemExit, e:
+            if not collected and e.code not in (None, 0):
+                jobs.append(BrokenJob(path, 'exited with {code} without defining a job'.format(code=e.code)))
+        except Exception, e:
+            collected = []
+            jobs.append(BrokenJob(path, '{type}: {error}'.format(type=type(e).__name__, error=e)))
+        finally:
+            ari_backup._job_collector = None
+        jobs += collected
+
+    return jobs
+
+
+class Scheduler(object):
+    '''Runs jobs on a bounded pool of worker threads
+
+    A job is started only when a worker is free, its source host is running
+    fewer than max_jobs_per_host jobs, and its backup store is used by fewer
+    than max_jobs_per_store jobs. A limit of 0 means no limit. Jobs are
+    considered in queue order; a job that can't start yet doesn't hold up
+    the ones behind it.
+
+    With order_by_history, the queue is ordered longest expected job first,
+    based on the durations of earlier runs in the metrics log, so a long job
+    doesn't start last and push the end of the night out. The scheduler
+    predicts when each job will finish and reports how that compared with
+    what actually happened.
+
+    '''
+    def __init__(self, jobs, max_jobs=None, max_jobs_per_host=None, max_jobs_per_store=None,
+                 defer_maintenance=None, max_maintenance_jobs=None, order_by_history=None):
+        self.jobs = list(jobs)
+
+        if max_jobs is None:
+            max_jobs = settings.max_concurrent_jobs
+        if max_jobs_per_host is None:
+            max_jobs_per_host = settings.max_jobs_per_host
+        if max_jobs_per_store is None:
+            max_jobs_per_store = settings.max_jobs_per_store
+        self.max_jobs = max_jobs
+        self.max_jobs_per_host = max_jobs_per_host
+        self.max_jobs_per_store = max_jobs_per_store
+
+        # With deferred maintenance, store maintenance (like pruning old
+        # increments) is taken out of the jobs and run from a separate queue
+        # with its own limit once each job's backup is done.
+        if defer_maintenance is None:
+            defer_maintenance = settings.defer_maintenance
+        if max_maintenance_jobs is None:
+            max_maintenance_jobs = settings.max_concurrent_maintenance
+        self.defer_maintenance = defer_maintenance
+        self.max_maintenance_jobs = max_maintenance_jobs
+
+        if order_by_history is None:
+            order_by_history = settings.order_jobs_by_history
+        self.order_by_history = order_by_history
+        # label -> predicted finish, in seconds from the start of the run
+        self.predicted_finish = {}
+
+        # Running jobs share settings.bandwidth_limit between them.
+        self.budget = None
+        if settings.bandwidth_limit:
+            self.budget = BandwidthBudget(settings.bandwidth_limit, self.max_jobs)
+
+        self.logger = Logger('ARIBackup (scheduler)', settings.debug_logging)
+
+        self._condition = threading.Condition()
+        self._running = []
+        self._host_counts = {}
+        self._store_counts = {}
+        # label -> the job's backup store. Finding it reads stores.json, and
+        # places a new label on a store, so we only do that once per job.
+        self._stores = {}
+        self._stopping = False
+        # labels of the running jobs we've cancelled since we started stopping
+        self._cancelled = set()
+        # True if the run was cut short by KeyboardInterrupt
+        self.interrupted = False
+        # jobs waiting to start, in the order we'll try them
+        self._queue = []
+        # label -> time the job started
+        self._started = {}
+        self._maintenance_queue = []
+        self._maintenance_running = []
+
+        # label -> (start time, finish time, success)
+        self.results = {}
+        # label -> success of the deferred maintenance
+        self.maintenance_results = {}
+
+        # All jobs share one pool of SSH master connections for the whole run,
+        # so consecutive jobs on a host reuse the same connection.
+        self.ssh_pool = SSHConnectionPool(self.logger)
+        for job in self.jobs:
+            if hasattr(job, 'ssh_pool'):
+                job.ssh_pool = self.ssh_pool
+            if self.defer_maintenance and hasattr(job, 'run_maintenance'):
+                job.defer_maintenance = True
+
+
+    def _under_limit(self, counts, key, limit):
+        if key is None or not limit:
+            return True
+        return counts.get(key, 0) < limit
+
+
+    def _get_store(self, job):
+        if job.label not in self._stores:
+            try:
+                self._stores[job.label] = job._get_backup_store()
+            except Exception, e:
+                # The job will fail on it too, and say why; until then only
+                # the other limits apply to it.
+                self.logger.error('{label}: unable to find its backup store: {error}'.format(
+                    label=job.label, error=e))
+                self._stores[job.label] = None
+        return self._stores[job.label]
+
+
+    def _can_start(self, job, running_count, host_counts, store_counts):
+        if self.max_jobs and running_count >= self.max_jobs:
+            return False
+        if not self._under_limit(host_counts, job.source_hostname, self.max_jobs_per_host):
+            return False
+        if not self._under_limit(store_counts, self._get_store(job), self.max_jobs_per_store):
+            return False
+        return True
+
+
+    def _adjust_counts(self, job, delta, host_counts, store_counts):
+        for counts, key in ((host_counts, job.source_hostname),
+                            (store_counts, self._get_store(job))):
+            if key is not None:
+                counts[key] = counts.get(key, 0) + delta
+
+
+    def _simulate(self, queue, durations):
+        '''Plays the queue through our limits with the given job durations
+
+        Returns a dict of label -> finish time in seconds from the start.
+
+        '''
+        queue = list(queue)
+        # list of (finish time, job)
+        running = []
+        host_counts = {}
+        store_counts = {}
+        now = 0
+        finish_times = {}
+        while queue:
+            started = True
+            while started:
+                started = False
+                for job in queue:
+                    if self._can_start(job, len(running), host_counts, store_counts):
+                        queue.remove(job)
+                        self._adjust_counts(job, 1, host_counts, store_counts)
+                        running.append((now + durations[job.label], job))
+                        started = True
+                        break
+
+            if not running:
+                break
+            running.sort(key=lambda item: item[0])
+            now, job = running.pop(0)
+            finish_times[job.label] = now
+            self._adjust_counts(job, -1, host_counts, store_counts)
+
+        for finish_time, job in running:
+            finish_times[job.label] = finish_time
+
+        return finish_times
+
+
+    def _order_queue(self, queue):
+        '''Orders the queue longest expected job first and predicts the night'''
+        durations = expected_durations([job.label for job in queue], load_history())
+        # sorted() is stable, so jobs we expect to take as long stay in the
+        # order they were given.
+        queue = sorted(queue, key=lambda job: -durations[job.label])
+        self.predicted_finish = self._simulate(queue, durations)
+        if self.predicted_finish:
+            self.logger.info('expecting the jobs to finish at {makespan}'.format(
+                makespan=format_offset(max(self.predicted_finish.values()))))
+        return queue
+
+
+    def _report(self, start):
+        '''Logs and saves predicted versus actual finish times for the run'''
+        lines = []
+        for label, result in sorted(self.results.items(), key=lambda item: item[1][1]):
+            actual = result[1] - start
+            if label in self.predicted_finish:
+                predicted = self.predicted_finish[label]
+                lines.append('{label}: predicted {predicted}, finished {actual} ({difference})'.format(
+                    label=label, predicted=format_offset(predicted), actual=format_offset(actual),
+                    difference=format_offset(actual - predicted)))
+            else:
+                lines.append('{label}: finished {actual}'.format(label=label, actual=format_offset(actual)))
+
+        for line in lines:
+            self.logger.info(line)
+
+        report_path = os.path.join(settings.state_dir, 'schedule-report.txt')
+        try:
+            if not os.path.isdir(settings.state_dir):
+                os.makedirs(settings.state_dir)
+            with open(report_path, 'w') as report_file:
+                report_file.write('run started {start}\n'.format(start=time.ctime(start)))
+                report_file.write('\n'.join(lines) + '\n')
+        except (IOError, OSError), e:
+            self.logger.warning('unable to write {path}: {error}'.format(path=report_path, error=e))
+
+
+    def _run_job(self, job):
+        start = time.time()
+        success = False
+        try:
+            success = job.run_backup()
+        except Exception, e:
+            # run_backup() handles its own errors, so this is unexpected.
+            self.logger.error('{label}: {error}'.format(label=job.label, error=e))
+        finally:
+            with self._condition:
+                self.results[job.label] = (start, time.time(), success)
+                self._running.remove(job)
+                self._started.pop(job.label, None)
+                self._adjust_counts(job, -1, self._host_counts, self._store_counts)
+                if self.budget is not None:
+                    self.budget.release(job.label)
+                if getattr(job, 'defer_maintenance', False) and not self._stopping:
+                    self._maintenance_queue.append(job)
+                self._condition.notify_all()
+
+
+    def _run_maintenance(self, job):
+        success = False
+        try:
+            success = job.run_maintenance()
+        except Exception, e:
+            self.logger.error('{label}: {error}'.format(label=job.label, error=e))
+        finally:
+            with self._condition:
+                self.maintenance_results[job.label] = success
+                self._maintenance_running.remove(job)
+                self._condition.notify_all()
+
+
+    def _start_next_maintenance(self):
+        if not self._maintenance_queue:
+            return False
+        if self.max_maintenance_jobs and len(self._maintenance_running) >= self.max_maintenance_jobs:
+            return False
+
+        job = self._maintenance_queue.pop(0)
+        self._maintenance_running.append(job)
+        self.logger.info('starting store maintenance for {label}'.format(label=job.label))
+        worker = threading.Thread(target=self._run_maintenance, args=(job,),
+            name='ari-backup maintenance {label}'.format(label=job.label))
+        worker.start()
+        return True
+
+
+    def _start_next(self, queue):
+        for job in queue:
+            if self._can_start(job, len(self._running), self._host_counts, self._store_counts):
+                queue.remove(job)
+                self._running.append(job)
+                self._started[job.label] = time.time()
+                self._adjust_counts(job, 1, self._host_counts, self._store_counts)
+                if self.budget is not None and hasattr(job, 'bandwidth_limit'):
+                    job.bandwidth_limit = self.budget.acquire(job.label, len(queue))
+                    self.logger.info('starting {label} with {limit} KB/s'.format(
+                        label=job.label, limit=job.bandwidth_limit))
+                else:
+                    self.logger.info('starting {label}'.format(label=job.label))
+                worker = threading.Thread(target=self._run_job, args=(job,),
+                    name='ari-backup {label}'.format(label=job.label))
+                worker.start()
+                return True
+
+        return False
+
+
+    def status(self):
+        '''Returns a list of dicts describing the running and queued jobs
+
+        Each has the job's label and state ('running', 'queued', 'maintenance'
+        or 'maintenance queued'). Running jobs also have their current phase,
+        the seconds since they started and the last lines of their output.
+
+        '''
+        now = time.time()
+        with self._condition:
+            statuses = []
+            for job in self._running:
+                metrics = getattr(job, 'metrics', None)
+                status = {
+                    'label': job.label,
+                    'state': 'running',
+                    'phase': metrics and metrics.current_phase,
+                    'elapsed': now - self._started.get(job.label, now),
+                }
+                if hasattr(job, 'get_recent_output'):
+                    status['output'] = job.get_recent_output()
+                statuses.append(status)
+            for job in self._queue:
+                statuses.append({'label': job.label, 'state': 'queued',
+                    'predicted_finish': self.predicted_finish.get(job.label)})
+            for job in self._maintenance_running:
+                statuses.append({'label': job.label, 'state': 'maintenance'})
+            for job in self._maintenance_queue:
+                statuses.append({'label': job.label, 'state': 'maintenance queued'})
+        return statuses
+
+
+    def _find_job(self, jobs, label):
+        for job in jobs:
+            if job.label == label:
+                return job
+        return None
+
+
+    def cancel(self, label):
+        '''Cancels a job
+
+        A queued job is taken off the queue and counted as failed. A running
+        job is stopped and cleans up as if it had failed. Returns a short
+        description of what we did, or None if there's no such job.
+
+        '''
+        with self._condition:
+            job = self._find_job(self._queue, label)
+            if job is not None:
+                self._queue.remove(job)
+                now = time.time()
+                self.results[label] = (now, now, False)
+                self.logger.error('{label} cancelled before it started'.format(label=label))
+                self._condition.notify_all()
+                return 'removed from the queue'
+            job = self._find_job(self._running, label)
+
+        if job is None:
+            return None
+        if hasattr(job, 'cancel') and job.cancel():
+            return 'cancelling'
+        return 'unable to cancel at this point'
+
+
+    def prioritise(self, label):
+        '''Moves a queued job to the front of the queue
+
+        Returns False if there's no such job in the queue.
+
+        '''
+        with self._condition:
+            job = self._find_job(self._queue, label)
+            if job is None:
+                return False
+            self._queue.remove(job)
+            self._queue.insert(0, job)
+            self.logger.info('{label} moved to the front of the queue'.format(label=label))
+            self._condition.notify_all()
+        return True
+
+
+    def _cancel_running(self):
+        '''Cancels the running jobs that we haven't cancelled yet
+
+        A job that can't be cancelled at this point is tried again on the
+        next call.
+
+        '''
+        for job in list(self._running):
+            if job.label in self._cancelled or not hasattr(job, 'cancel'):
+                continue
+            if job.cancel():
+                self._cancelled.add(job.label)
+
+
+    def run(self):
+        '''Runs all jobs and returns the makespan in seconds'''
+        self.logger.info('running {count} jobs (max {max_jobs}, per host {per_host}, per store {per_store})'.format(
+            count=len(self.jobs), max_jobs=self.max_jobs or 'unlimited',
+            per_host=self.max_jobs_per_host or 'unlimited',
+            per_store=self.max_jobs_per_store or 'unlimited'))
+
+        start = time.time()
+        queue = list(self.jobs)
+        for job in queue:
+            self._get_store(job)
+        if self.order_by_history:
+            queue = self._order_queue(queue)
+        with self._condition:
+            self._queue = queue
+        try:
+            with self._condition:
+                while queue or self._running or self._maintenance_queue or self._maintenance_running:
+                    try:
+                        started = False
+                        if not self._stopping:
+                            started = self._start_next(queue) or self._start_next_maintenance()
+                        else:
+                            self._cancel_running()
+                        if not started:
+                            # We wait with a timeout so that KeyboardInterrupt
+                            # can still reach us.
+                            self._condition.wait(1)
+                    except KeyboardInterrupt:
+                        self.logger.error('scheduler cancelled by user, waiting for running jobs to clean up...')
+                        self._stopping = True
+                        self.interrupted = True
+                        del queue[:]
+                        del self._maintenance_queue[:]
+                        # Their commands may have had the interrupt too, but
+                        # cancelling makes sure they stop and run their
+                        # post-job hooks now rather than when they're done.
+                        self._cancel_running()
+        finally:
+            self.ssh_pool.close()
+
+        makespan = time.time() - start
+        failed = [label for label, result in self.results.items() if not result[2]]
+        self.logger.info('{count} jobs finished in {makespan:.1f}s, {failed} failed'.format(
+            count=len(self.results), makespan=makespan, failed=len(failed)))
+        for label in sorted(failed):
+            self.logger.error('{label} failed'.format(label=label))
+        for label, success in sorted(self.maintenance_results.items()):
+            if not success:
+                self.logger.error('store maintenance for {label} failed'.format(label=label))
+        self._report(start)
+
+        return makespan
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] JOBS_DIR')
+    parser.add_option('-j', '--max-jobs', type='int', default=None,
+        help='maximum number of concurrent jobs (0 for no limit)')
+    parser.add_option('--max-jobs-per-host', type='int', default=None,
+        help='maximum number of concurrent jobs per source host (0 for no limit)')
+    parser.add_option('--max-jobs-per-store', type='int', default=None,
+        help='maximum number of concurrent jobs per backup store (0 for no limit)')
+    parser.add_option('--no-history', action='store_false', dest='order_by_history', default=None,
+        help="run jobs in directory order instead of ordering them by earlier runs' durations")
+    parser.add_option('--defer-maintenance', action='store_true', default=None,
+        help='run store maintenance from its own queue once the backups are done')
+    parser.add_option('--max-maintenance-jobs', type='int', default=None,
+        help='maximum number of concurrent store maintenance jobs (0 for no limit)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('a jobs directory is required')
+
+    jobs = load_jobs(list_job_paths(args[0]))
+    scheduler = Scheduler(jobs, options.max_jobs, options.max_jobs_per_host, options.max_jobs_per_store,
+        options.defer_maintenance, options.max_maintenance_jobs, options.order_by_history)
+    scheduler.run()
+
+    failed = [result for result in scheduler.results.values() if not result[2]]
+    failed += [success for success in scheduler.maintenance_results.values() if not success]
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,42 +1,192 @@
 from __future__ import with_statement
 
+import os
+import sys
+import threading
+
 import yaml
 
 from logger import Logger
 
 # Reads and validates settings from /etc/ari-backup/ari-backup.conf.yaml and
-# makes them available as properties of this module.  
+# makes them available as attributes of this module.  The ARI_BACKUP_CONFIG
+# environment variable can point us at a different file.
+#
+# Nothing is read when the module is imported. The file is parsed the first
+# time a setting is used, with libyaml's safe loader when it's available, and
+# the result is cached until reload() finds that the file's mtime changed.
+# This module replaces itself in sys.modules with a Settings instance so that
+# settings.backup_store_path and friends keep working as they always have.
+#
+# Every setting has to be registered, with its default, before it can be used.
+# The core settings are registered below; extensions to ARIBackup register
+# their own when they are imported, e.g.
+#
+#   settings.register('zfs_snapshot_prefix', 'ari-backup-')
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+DEFAULT_CONF_PATH = '/etc/ari-backup/ari-backup.conf.yaml'
+
+# The default for settings that must be set in the config file
+REQUIRED = object()
+
+
+class Settings(object):
+    '''Lazily loaded, cached settings from the ari-backup config file'''
+    def __init__(self, module):
+        # Keep a reference to the module we replace, otherwise its globals
+        # would be cleared out from under us.
+        self._module = module
+
+        self._lock = threading.RLock()
+        # name -> default
+        self._registry = {}
+        # The parsed config file and the path and mtime it was parsed at
+        self._conf = None
+        self._conf_path = None
+        self._conf_mtime = None
+        self._unrecognized_checked = False
+        self._log = None
+
+
+    def _get_log(self):
+        if self._log is None:
+            self._log = Logger('ARIBackup (settings)')
+        return self._log
+
+
+    def get_conf_path(self):
+        return os.environ.get('ARI_BACKUP_CONFIG', DEFAULT_CONF_PATH)
+
+
+    def _get_mtime(self, conf_path):
+        try:
+            return os.stat(conf_path).st_mtime
+        except OSError:
+            return None
+
+
+    def _load(self):
+        '''Parses the config file, unless we already have it cached'''
+        conf_path = self.get_conf_path()
+        mtime = self._get_mtime(conf_path)
+        if self._conf is not None and conf_path == self._conf_path and mtime == self._conf_mtime:
+            return
+
+        if mtime is None:
+            # Without a config file we can still hand out defaults; anything
+            # that's required will complain when it's used.
+            conf = {}
+        else:
+            with open(conf_path, 'r') as conf_file:
+                conf = yaml.load(conf_file, Loader=SafeLoader) or {}
+            if not isinstance(conf, dict):
+                raise Exception('{conf_path} must contain a mapping of settings'.format(conf_path=conf_path))
+
+        self._conf = conf
+        self._conf_path = conf_path
+        self._conf_mtime = mtime
+        self._unrecognized_checked = False
+
+
+    def register(self, name, default=REQUIRED):
+        '''Declares a setting and its default
+
+        Settings registered without a default must be set in the config
+        file. Registering a setting again just replaces its default.
+
+        '''
+        with self._lock:
+            self._registry[name] = default
+
+
+    def reload(self):
+        '''Re-reads the config file if it, or ARI_BACKUP_CONFIG, changed since
+        we last read it'''
+        with self._lock:
+            self._load()
+
+
+    def check_unrecognized(self):
+        '''Logs a warning for every setting in the file nobody registered
+
+        This waits until the jobs are about to run, by which time all the
+        extensions that register settings have been imported.
+
+        '''
+        with self._lock:
+            self._load()
+            if self._unrecognized_checked:
+                return
+            self._unrecognized_checked = True
+            unrecognized = [(k, v) for k, v in self._conf.items() if k not in self._registry]
+
+        for k, v in sorted(unrecognized):
+            self._get_log().warning('{key}:{value} is not a recognized setting'.format(key=k, value=v))
+
+
+    def __getattr__(self, name):
+        # Only called for names that aren't regular attributes.
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        with self._lock:
+            if name not in self._registry:
+                raise AttributeError('{name} is not a registered setting'.format(name=name))
+            if self._conf is None:
+                self._load()
+            if name in self._conf:
+                return self._conf[name]
+            default = self._registry[name]
+
+        if default is REQUIRED:
+            raise Exception('{name} must be set in {conf_path}'.format(
+                name=name, conf_path=self.get_conf_path()))
+        return default
+
+
+settings = Settings(sys.modules[__name__])
 
 # let's set some sane defaults
-rdiff_backup_path = '/usr/bin/rdiff-backup'
-remote_user = 'root'
-ssh_path = '/usr/bin/ssh'
-ssh_compression = False
-snapshot_suffix = '-ari_backup'
-rsync_path = '/usr/bin/rsync'
-zfs_snapshot_prefix = 'ari-backup-'
-debug_logging = False
-
-# setup logging
-log = Logger('ARIBackup (settings)')
-
-with open('/etc/ari-backup/ari-backup.conf.yaml', 'r') as conf_file:
-    conf = yaml.load(conf_file)
-
-# Any supported settings should be included in this block, otherwise
-# they won't become attributes of the settings module.
-# TODO We need a way for extensions to ARIBackup to register settings
-for k, v in conf.iteritems():
-    if k == 'backup_store_path': backup_store_path = v
-    elif k == 'rdiff_backup_path': rdiff_backup_path = v
-    elif k == 'remote_user': remote_user = v
-    elif k == 'ssh_compression': ssh_compression = v
-    elif k == 'ssh_path': ssh_path = v
-    elif k == 'snapshot_mount_root': snapshot_mount_root = v
-    elif k == 'snapshot_suffix': snapshot_suffix = v
-    elif k == 'rsync_path': rsync_path = v
-    elif k == 'rsync_options': rsync_options = v
-    elif k == 'zfs_snapshot_prefix': zfs_snapshot_prefix = v
-    elif k == 'debug_logging': debug_logging = v
-    else:
-        log.warning('{key}:{value} is not a recognized setting'.format(key=k, value=v))
+# One of backup_store_path and backup_store_paths must be set; see stores.py
+settings.register('backup_store_path', None)
+settings.register('backup_store_paths', None)
+settings.register('snapshot_mount_root')
+settings.register('rdiff_backup_path', '/usr/bin/rdiff-backup')
+settings.register('remote_user', 'root')
+settings.register('ssh_path', '/usr/bin/ssh')
+settings.register('ssh_compression', False)
+settings.register('ssh_multiplexing', True)
+settings.register('snapshot_suffix', '-ari_backup')
+settings.register('lvm_batch_commands', False)
+settings.register('rsync_path', '/usr/bin/rsync')
+settings.register('debug_logging', False)
+settings.register('state_dir', '/var/lib/ari-backup')
+settings.register('command_output_tail_lines', 50)
+settings.register('command_log_lines_per_second', 100)
+settings.register('max_concurrent_jobs', 1)
+settings.register('max_jobs_per_host', 1)
+settings.register('max_jobs_per_store', 2)
+settings.register('defer_maintenance', False)
+settings.register('max_concurrent_maintenance', 1)
+settings.register('order_jobs_by_history', True)
+settings.register('bandwidth_limit', 0)
+settings.register('trickle_path', None)
+settings.register('io_priority', {})
+settings.register('snapshot_default_size', 1024 * 1024 * 1024)
+settings.register('snapshot_size_headroom', 1.5)
+settings.register('snapshot_monitor_interval', 60)
+settings.register('snapshot_extend_percent', 80)
+settings.register('command_timeout', 0)
+settings.register('transfer_timeout', 0)
+settings.register('transfer_stall_timeout', 3600)
+settings.register('command_kill_grace', 30)
+settings.register('max_concurrent_hooks', 4)
+settings.register('adaptive_compression', False)
+settings.register('dump_compress_level', 6)
+
+sys.modules[__name__] = settings
@@ -0,0 +1,164 @@
+from __future__ import with_statement
+
+import json
+import os
+import threading
+
+import settings
+
+'''Sizing LVM snapshots from the copy-on-write usage of earlier runs
+
+A snapshot fills up as its origin is written to while the backup runs, and
+once it's full LVM invalidates it and the backup is lost. So rather than
+giving every snapshot the same size, LVMBackup asks lvs how big each origin
+is and how full its snapshot got on earlier runs, samples data_percent while
+the backup runs, extends a snapshot that is close to full and records the
+peak for next time.
+
+The usage records live in {state_dir}/snapshot-usage.json, keyed by
+hostname:vg/lv so that they survive a job being relabelled.
+
+'''
+
+USAGE_FILENAME = 'snapshot-usage.json'
+
+# How many of a volume's most recent runs we size its snapshot from
+RECENT_RUNS = 7
+
+# Never make a snapshot smaller than this, in bytes
+MIN_SNAPSHOT_SIZE = 256 * 1024 * 1024
+
+# We size snapshots in whole MiB; LVM rounds up to its extent size anyway.
+MIB = 1024 * 1024
+
+# Reports the size of each volume and, for snapshots, how full they are
+LVS_COMMAND = 'lvs --noheadings --nosuffix --units b --separator , -o vg_name,lv_name,lv_size,data_percent'
+
+_usage_lock = threading.Lock()
+
+
+def get_usage_path():
+    return os.path.join(settings.state_dir, USAGE_FILENAME)
+
+
+def load_usage(path=None):
+    '''Returns a dict of hostname:vg/lv -> list of usage records, oldest first'''
+    if path is None:
+        path = get_usage_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as usage_file:
+            usage = json.load(usage_file)
+    except ValueError:
+        # A corrupt file only costs us our estimates.
+        return {}
+    if not isinstance(usage, dict):
+        return {}
+    return usage
+
+
+def record_usage(records, path=None):
+    '''Adds a dict of hostname:vg/lv -> usage record to the usage file'''
+    if path is None:
+        path = get_usage_path()
+    with _usage_lock:
+        usage = load_usage(path)
+        for key, record in records.items():
+            volume_records = usage.setdefault(key, [])
+            volume_records.append(record)
+            del volume_records[:-RECENT_RUNS]
+
+        state_dir = os.path.dirname(path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        # Write a new file and rename it over the old one, so a crash can't
+        # leave us with half a file.
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as usage_file:
+            json.dump(usage, usage_file, sort_keys=True)
+        os.rename(temp_path, path)
+
+
+def parse_lvs(output):
+    '''Parses LVS_COMMAND output into a dict of vg/lv -> (size, data_percent)
+
+    data_percent is None for volumes that aren't snapshots.
+
+    '''
+    volumes = {}
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) != 4:
+            continue
+        vg_name, lv_name, size, data_percent = fields
+        try:
+            size = int(size)
+            if data_percent:
+                data_percent = float(data_percent)
+            else:
+                data_percent = None
+        except ValueError:
+            continue
+        volumes[vg_name + '/' + lv_name] = (size, data_percent)
+    return volumes
+
+
+def choose_snapshot_size(origin_size, records, expected_duration=None):
+    '''Returns the size in bytes for a new snapshot of an origin
+
+    With no records to go on we use settings.snapshot_default_size. With
+    them, we take the most a snapshot of this origin has filled up, or the
+    fastest it has filled multiplied by how long we expect tonight's run to
+    take if that's more, and add settings.snapshot_size_headroom. A snapshot
+    never needs to be bigger than its origin.
+
+    '''
+    if not records:
+        size = settings.snapshot_default_size
+    else:
+        size = max([record['peak_used'] for record in records])
+        if expected_duration:
+            rates = [float(record['peak_used']) / record['duration']
+                for record in records if record.get('duration')]
+            if rates:
+                size = max(size, max(rates) * expected_duration)
+        size = size * settings.snapshot_size_headroom
+
+    size = max(size, MIN_SNAPSHOT_SIZE)
+    if origin_size:
+        size = min(size, origin_size)
+    # round up to a whole MiB
+    return int((size + MIB - 1) // MIB * MIB)
+
+
+class SnapshotMonitor(threading.Thread):
+    '''Calls sample every interval seconds until stop() is called
+
+    Exceptions from sample are logged rather than raised, since a missed
+    sample shouldn't take the backup down with it.
+
+    '''
+    def __init__(self, sample, interval, logger):
+        threading.Thread.__init__(self, name='ari-backup snapshot monitor')
+        self.daemon = True
+        self.sample = sample
+        self.interval = interval
+        self.logger = logger
+        self._stopped = threading.Event()
+
+
+    def run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.is_set():
+                return
+            try:
+                self.sample()
+            except Exception, e:
+                self.logger.warning('unable to sample snapshot usage: {error}'.format(error=e))
+
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,170 @@
+import atexit
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import weakref
+
+import settings
+
+'''Multiplexed SSH connections for remote commands
+
+Every remote command used to start a new ssh process with its own handshake.
+SSHConnectionPool keeps one OpenSSH master connection per (remote_user, host)
+and hands out ssh arguments that reuse it, so each command only costs a round
+trip over the existing connection.
+
+'''
+
+# The pools that haven't been closed. A pool is closed when its run is done,
+# and any still open when we exit are closed then, but we don't keep them
+# alive: the daemon makes a new pool for every run.
+_open_pools = weakref.WeakSet()
+_open_pools_lock = threading.Lock()
+
+
+def _close_open_pools():
+    with _open_pools_lock:
+        pools = list(_open_pools)
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(_close_open_pools)
+
+
+class SSHConnectionPool(object):
+    '''Keeps one multiplexed SSH master connection per (remote_user, host)
+
+    Masters are started on first use and live until close() is called. If a
+    master can't be started we log it and fall back to a separate connection
+    per command, which is how things worked before multiplexing.
+
+    '''
+    def __init__(self, logger):
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._control_dir = None
+        # (remote_user, host) -> control socket path, or None if we couldn't
+        # start a master for that destination.
+        self._masters = {}
+        # (remote_user, host) -> lock held while that master is started
+        self._key_locks = {}
+        self._closed = False
+
+        with _open_pools_lock:
+            _open_pools.add(self)
+
+
+    def _base_args(self):
+        return shlex.split(settings.ssh_path)
+
+
+    def _get_control_path(self, remote_user, host):
+        key = (remote_user, host)
+        with self._lock:
+            if self._closed:
+                raise Exception('SSHConnectionPool: the pool is closed')
+            if key in self._masters:
+                return self._masters[key]
+            if self._control_dir is None:
+                self._control_dir = tempfile.mkdtemp(prefix='ari-backup-ssh-')
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Someone else may have started the master while we waited.
+            with self._lock:
+                if key in self._masters:
+                    return self._masters[key]
+                # Socket paths are limited to ~100 characters, so we keep the
+                # names short.
+                control_path = os.path.join(self._control_dir, str(len(self._masters)))
+
+            control_path = self._start_master(remote_user, host, control_path)
+            with self._lock:
+                self._masters[key] = control_path
+
+        return control_path
+
+
+    def _start_master(self, remote_user, host, control_path):
+        args = self._base_args() + [
+            '-M', '-N', '-f',
+            '-o', 'ControlPath={control_path}'.format(control_path=control_path),
+            '-o', 'ServerAliveInterval=60',
+            '{remote_user}@{host}'.format(remote_user=remote_user, host=host),
+        ]
+        self.logger.debug('starting SSH master connection %r' % args)
+
+        # The backgrounded master keeps any pipes we give it open, so we send
+        # its output to /dev/null rather than waiting on it.
+        devnull = open(os.devnull, 'r+')
+        try:
+            exitcode = subprocess.call(args, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+
+        if exitcode != 0:
+            self.logger.warning(('unable to start an SSH master connection to {remote_user}@{host}, '
+                'using a separate connection per command').format(remote_user=remote_user, host=host))
+            return None
+
+        return control_path
+
+
+    def ssh_args(self, remote_user, host, multiplexed=True):
+        '''Returns the ssh argument list to run a command on host
+
+        With multiplexed=False the command gets a connection of its own, even
+        if the user's ssh_config asks for multiplexing. Anything that has to
+        act on the connection's traffic, like trickle, needs that, since a
+        multiplexed command's bytes are carried by the master.
+
+        '''
+        args = self._base_args()
+        if not multiplexed:
+            args += ['-o', 'ControlPath=none']
+        elif settings.ssh_multiplexing:
+            control_path = self._get_control_path(remote_user, host)
+            if control_path is not None:
+                args += [
+                    '-o', 'ControlPath={control_path}'.format(control_path=control_path),
+                    '-o', 'ControlMaster=no',
+                ]
+
+        args.append('{remote_user}@{host}'.format(remote_user=remote_user, host=host))
+        return args
+
+
+    def close(self):
+        '''Stops all master connections and removes their sockets'''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            masters = self._masters.items()
+            self._masters = {}
+        with _open_pools_lock:
+            _open_pools.discard(self)
+
+        devnull = open(os.devnull, 'r+')
+        try:
+            for (remote_user, host), control_path in masters:
+                if control_path is None:
+                    continue
+                args = self._base_args() + [
+                    '-o', 'ControlPath={control_path}'.format(control_path=control_path),
+                    '-O', 'exit',
+                    '{remote_user}@{host}'.format(remote_user=remote_user, host=host),
+                ]
+                self.logger.debug('stopping SSH master connection %r' % args)
+                subprocess.call(args, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+
+        if self._control_dir is not None:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
@@ -0,0 +1,248 @@
+from __future__ import with_statement
+
+import errno
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from optparse import OptionParser
+
+import settings
+
+from dumps import DUMPS_DIRNAME
+
+'''Spreads job repositories across several backup stores
+
+With settings.backup_store_paths listing more than one store, each label's
+repository lives in {store}/{label} on one of them, and which one is kept in
+{state_dir}/stores.json so the label stays put from run to run. A label we
+haven't seen before goes where a repository for it already exists, if
+anywhere, and otherwise to the store with the most free space per job
+currently writing to it. With only backup_store_path set, everything lives
+there as it always has.
+
+Repositories can be moved between stores with
+
+    python -m ari_backup.stores move LABEL STORE_PATH
+
+which copies the repository with rsync, points the label at its new home and
+removes the old copy. Jobs and moves take a per-label lock, so a repository
+is never moved while its job is running.
+
+'''
+
+STORE_MAP_FILENAME = 'stores.json'
+
+_lock = threading.RLock()
+# store path -> number of jobs in this process writing to it right now
+_active_writes = {}
+# store path -> number of labels we placed on it in this process
+_placed = {}
+
+
+def get_store_paths():
+    '''Returns the configured backup stores'''
+    if settings.backup_store_paths:
+        return list(settings.backup_store_paths)
+    if settings.backup_store_path:
+        return [settings.backup_store_path]
+    raise Exception('backup_store_path or backup_store_paths must be set in {conf_path}'.format(
+        conf_path=settings.get_conf_path()))
+
+
+def get_store_map_path():
+    return os.path.join(settings.state_dir, STORE_MAP_FILENAME)
+
+
+def load_store_map():
+    '''Returns the dict of label -> store path'''
+    path = get_store_map_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as map_file:
+        return json.load(map_file)
+
+
+def save_store_map(store_map):
+    path = get_store_map_path()
+    if not os.path.isdir(settings.state_dir):
+        os.makedirs(settings.state_dir)
+    # Write a new file and rename it over the old one, so a crash can't
+    # leave us with half a map.
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as map_file:
+        json.dump(store_map, map_file, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def get_free_bytes(store_path):
+    '''Returns the bytes available to us on store_path's filesystem'''
+    stat = os.statvfs(store_path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def choose_store(store_paths, free_bytes, loads):
+    '''Returns the store with the most free space per job writing to it
+
+    free_bytes and loads are dicts keyed by store path. Ties go to the store
+    listed first.
+
+    '''
+    best = None
+    best_score = None
+    for store_path in store_paths:
+        score = float(free_bytes[store_path]) / (1 + loads.get(store_path, 0))
+        if best_score is None or score > best_score:
+            best, best_score = store_path, score
+    return best
+
+
+def get_store(label):
+    '''Returns the backup store for label, placing it on one if it's new'''
+    store_paths = get_store_paths()
+    if len(store_paths) == 1:
+        return store_paths[0]
+
+    with _lock:
+        store_map = load_store_map()
+        store_path = store_map.get(label)
+        if store_path is not None:
+            if store_path not in store_paths:
+                # Placing the label again would quietly start a new
+                # repository from scratch.
+                raise Exception('{label} is kept on {store_path}, which is not in backup_store_paths'.format(
+                    label=label, store_path=store_path))
+            return store_path
+
+        existing = [path for path in store_paths if os.path.isdir(os.path.join(path, label))]
+        if existing:
+            store_path = existing[0]
+        else:
+            free_bytes = {}
+            for path in store_paths:
+                free_bytes[path] = get_free_bytes(path)
+            loads = {}
+            for path in store_paths:
+                loads[path] = _active_writes.get(path, 0) + _placed.get(path, 0)
+            store_path = choose_store(store_paths, free_bytes, loads)
+            _placed[store_path] = _placed.get(store_path, 0) + 1
+
+        store_map[label] = store_path
+        save_store_map(store_map)
+        return store_path
+
+
+def begin_write(store_path):
+    with _lock:
+        _active_writes[store_path] = _active_writes.get(store_path, 0) + 1
+
+
+def end_write(store_path):
+    with _lock:
+        _active_writes[store_path] -= 1
+
+
+def lock_label(label):
+    '''Takes the lock on label's repository, without waiting for it
+
+    Returns the lock file, which holds the lock until it's closed. Raises an
+    Exception if somebody else holds it.
+
+    '''
+    lock_dir = os.path.join(settings.state_dir, 'locks')
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    lock_file = open(os.path.join(lock_dir, label + '.lock'), 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        lock_file.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise Exception('the repository for {label} is in use, maybe by a move or another run'.format(
+                label=label))
+        raise
+    return lock_file
+
+
+def move_repository(label, new_store_path, keep_source=False):
+    '''Moves label's repository to new_store_path and remaps the label'''
+    store_paths = get_store_paths()
+    if new_store_path not in store_paths:
+        raise Exception('{store_path} is not in backup_store_paths'.format(store_path=new_store_path))
+
+    lock_file = lock_label(label)
+    try:
+        old_store_path = get_store(label)
+        if old_store_path == new_store_path:
+            return
+        source = os.path.join(old_store_path, label)
+        if not os.path.isdir(source):
+            raise Exception('{source} does not exist'.format(source=source))
+        # The label's captured dumps (see dumps.py) move with it.
+        moves = [(source, os.path.join(new_store_path, label))]
+        dump_dir = os.path.join(old_store_path, DUMPS_DIRNAME, label)
+        if os.path.isdir(dump_dir):
+            moves.append((dump_dir, os.path.join(new_store_path, DUMPS_DIRNAME, label)))
+        for move_source, destination in moves:
+            if os.path.exists(destination):
+                raise Exception('{destination} already exists'.format(destination=destination))
+
+        for move_source, destination in moves:
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            # Trailing slash so rsync copies the contents into destination.
+            try:
+                exitcode = subprocess.call([settings.rsync_path, '-aHAX', '--numeric-ids', move_source + '/',
+                    destination])
+            except OSError, e:
+                raise Exception('unable to run {rsync_path}: {error}'.format(rsync_path=settings.rsync_path, error=e))
+            if exitcode != 0:
+                raise Exception('copying {source} to {destination} failed with exit code {exitcode}'.format(
+                    source=move_source, destination=destination, exitcode=exitcode))
+
+        with _lock:
+            store_map = load_store_map()
+            store_map[label] = new_store_path
+            save_store_map(store_map)
+
+        if not keep_source:
+            for move_source, destination in moves:
+                subprocess.check_call(['rm', '-rf', '--one-file-system', move_source])
+    finally:
+        lock_file.close()
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] status | move LABEL STORE_PATH')
+    parser.add_option('--keep-source', action='store_true', default=False,
+        help='with move, leave the old copy of the repository where it is')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('a command is required')
+
+    if args[0] == 'status':
+        store_map = load_store_map()
+        for store_path in get_store_paths():
+            labels = sorted([label for label, path in store_map.items() if path == store_path])
+            print '{store_path}: {free:.1f} GiB free, {count} labels'.format(
+                store_path=store_path, free=get_free_bytes(store_path) / 1024.0 ** 3, count=len(labels))
+            for label in labels:
+                print '  ' + label
+    elif args[0] == 'move':
+        if len(args) != 3:
+            parser.error('move needs a label and a store path')
+        try:
+            move_repository(args[1], args[2], options.keep_source)
+        except Exception, e:
+            print >> sys.stderr, str(e)
+            return 1
+    else:
+        parser.error('unknown command {command}'.format(command=args[0]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
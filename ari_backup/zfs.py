@@ -1,6 +1,43 @@
-from datetime import datetime, timedelta
+from __future__ import with_statement
+
+import collections
+import json
+import os
+import pipes
+import re
+import threading
+import time
+
+from datetime import datetime
 
 from ari_backup import LVMBackup, settings
+from ari_backup.budget import io_priority_args
+from ari_backup.metrics import parse_rsync_statistics
+
+settings.register('rsync_options')
+settings.register('zfs_snapshot_prefix', 'ari-backup-')
+# The longest we go without a new snapshot when rsync finds nothing changed,
+# in seconds
+settings.register('zfs_snapshot_max_interval', 7 * 24 * 60 * 60)
+# Where to replicate our snapshots to with zfs send, if anywhere: a dataset
+# on zfs_hostname ('backup2/tank'), a dataset on another host reached by ssh
+# from zfs_hostname ('offsite:backup/tank') or a directory on zfs_hostname to
+# write the streams to as files ('file:/mnt/offsite')
+settings.register('zfs_replication_target', None)
+
+# The most snapshots or snapshot ranges we pass to a single zfs destroy, to
+# keep the command line reasonably short.
+MAX_DESTROY_SPECS = 100
+
+# Which snapshot of each dataset each replication target has, so the next
+# replication knows what to send an incremental stream from.
+REPLICATION_STATE_FILENAME = 'zfs-replication.json'
+
+_replication_lock = threading.Lock()
+
+# The lines --itemize-changes writes for items rsync created, updated, changed
+# the attributes of or deleted. Unchanged items get no line.
+ITEMIZED_CHANGE_RE = re.compile(r'^(\*deleting|[<>ch.][fdLDS][^ ]{7,9}) ')
 
 class ZFSLVMBackup(LVMBackup):
     def __init__(self, label, source_hostname, rsync_dst, zfs_hostname, dataset_name, snapshot_expiration_days):
@@ -12,6 +49,8 @@ class ZFSLVMBackup(LVMBackup):
         # bring in some overridable settings
         self.rsync_options = settings.rsync_options
         self.snapshot_prefix = settings.zfs_snapshot_prefix
+        self.snapshot_max_interval = settings.zfs_snapshot_max_interval
+        self.replication_target = settings.zfs_replication_target
 
         # the timestamp format we're going to use when naming our snapshots
         self.snapshot_timestamp_format = '%Y-%m-%d--%H%M'
@@ -20,11 +59,32 @@ class ZFSLVMBackup(LVMBackup):
         super(ZFSLVMBackup, self).__init__(label, source_hostname, None)
 
         self.post_job_hook_list.append((self._create_zfs_snapshot, {}))
-        self.post_job_hook_list.append(
+        # Replicate before expiring, so a snapshot that's about to become the
+        # replication base isn't destroyed first.
+        self.maintenance_hook_list.append((self._replicate_zfs_snapshot, {}))
+        self.maintenance_hook_list.append(
             (self._remove_zfs_snapshots_older_than, {'days': snapshot_expiration_days})
         )
 
 
+    def _get_backup_store(self):
+        # Our data lands in the pool holding dataset_name on zfs_hostname.
+        return '{zfs_hostname}:{pool}'.format(
+            zfs_hostname=self.zfs_hostname, pool=self.dataset_name.split('/')[0])
+
+
+    def _get_repository_paths(self):
+        # We keep no rdiff-backup repository, so there's nothing for the
+        # catalog, and asking for one would place our label on a store.
+        return []
+
+
+    def _transfer_is_remote(self):
+        # rsync runs on the source host, so it only crosses the network if
+        # rsync_dst is on another host.
+        return ':' in self.rsync_dst
+
+
     def _run_backup(self):
         # TODO Throw an exception if we see things in the include or exclude
         # lists since we don't use them in this class?
@@ -34,24 +94,62 @@ class ZFSLVMBackup(LVMBackup):
         # directory in our rsync options.
         rsync_options = self.rsync_options + " --exclude '/.zfs'"
 
+        # Have rsync report what it did so we can record it in our metrics,
+        # and list what it changed so we know whether to snapshot.
+        rsync_options += ' --stats --itemize-changes'
+
+        # Coming after rsync_options, these override any compression options
+        # there.
+        if self.metrics.compression is True:
+            rsync_options += ' --compress'
+        elif self.metrics.compression is False:
+            rsync_options += ' --no-compress'
+
+        if self.bandwidth_limit:
+            rsync_options += ' --bwlimit={limit}'.format(limit=self.bandwidth_limit)
+
         # We add a trailing slash to the src path otherwise rsync will make a
         # subdirectory at the destination, even if the destination is already
         # a directory.
         rsync_src = self.snapshot_mount_point_base_path + '/'
 
-        command = '{rsync_path} {rsync_options} {src} {dst}'.format(
+        command = '{priority}{rsync_path} {rsync_options} {src} {dst}'.format(
+            priority=''.join([arg + ' ' for arg in io_priority_args(self.io_priority)]),
             rsync_path=settings.rsync_path,
             rsync_options=rsync_options,
             src=rsync_src,
             dst=self.rsync_dst
         )
 
-        self._run_command(command, self.source_hostname)
+        # When the source is remote, rsync runs there and sends straight to
+        # rsync_dst, so none of its traffic passes through anything we can
+        # watch and it's silent until --stats; only the deadline applies.
+        stall_timeout = self.transfer_stall_timeout
+        if self.source_hostname != 'localhost':
+            stall_timeout = 0
+
+        # A big change lists a lot of items, so we count them as they go by
+        # rather than logging them.
+        rsync_output = RsyncOutput()
+        self._run_command(command, self.source_hostname, capture_output=False, timeout=self.transfer_timeout,
+            stall_timeout=stall_timeout, stdout_sink=rsync_output)
+        rsync_output.close()
+        self.metrics.transfer.update(parse_rsync_statistics(rsync_output.getvalue()))
+        self.metrics.transfer['items_changed'] = rsync_output.items_changed
         self.logger.debug('ZFSLVMBackup._run_backup completed')
 
 
     def _create_zfs_snapshot(self, error_case):
         if not error_case:
+            if not rsync_changed_anything(self.metrics.transfer):
+                newest = None
+                for name, creation in self._list_zfs_snapshots():
+                    if name.split('@')[0] == self.dataset_name and is_ari_backup_snapshot(name, self.snapshot_prefix):
+                        newest = creation
+                if newest is not None and time.time() - newest < self.snapshot_max_interval:
+                    self.logger.info('nothing changed since the last ZFS snapshot, not creating one')
+                    return
+
             self.logger.info('creating ZFS snapshot...')
             snapshot_name = self.snapshot_prefix + datetime.now().strftime(self.snapshot_timestamp_format)
             command = 'zfs snapshot {dataset_name}@{snapshot_name}'.format(
@@ -60,37 +158,279 @@ class ZFSLVMBackup(LVMBackup):
             self._run_command(command, self.zfs_hostname)
 
 
+    def _list_zfs_snapshots(self):
+        '''Lists every snapshot under dataset_name in one command
+
+        Returns a list of (name, creation) tuples in the order the snapshots
+        were created, where creation is in seconds since the epoch.
+
+        '''
+        command = 'zfs list -H -p -r -t snapshot -o name,creation -s createtxg {dataset_name}'.format(
+            dataset_name=self.dataset_name)
+        (stdout, stderr) = self._run_command(command, self.zfs_hostname)
+
+        snapshots = []
+        # Sometimes we get extra lines which are empty,
+        # so we'll strip the lines.
+        for line in stdout.strip().splitlines():
+            name, creation = line.split('\t')
+            snapshots.append((name, int(creation)))
+
+        return snapshots
+
+
+    def _replicate_zfs_snapshot(self, error_case):
+        '''Sends our newest snapshot to replication_target
+
+        The stream is incremental from the snapshot the target got last time,
+        or the whole snapshot the first time.
+
+        '''
+        if error_case or not self.replication_target:
+            return
+
+        snapshots = [name for name, creation in self._list_zfs_snapshots()
+            if name.split('@')[0] == self.dataset_name and is_ari_backup_snapshot(name, self.snapshot_prefix)]
+        if not snapshots:
+            self.logger.info('no ZFS snapshots to replicate')
+            return
+
+        newest = snapshots[-1]
+        base = load_replication_state().get(get_replication_key(self.dataset_name, self.replication_target))
+        if base == newest:
+            self.logger.info('{target} already has {snapshot}'.format(target=self.replication_target, snapshot=newest))
+            return
+        if base is not None and base not in snapshots:
+            # A full stream can't be received on top of what the target
+            # already has, so this needs someone to look at it.
+            raise Exception(('{base}, the last snapshot replicated to {target}, no longer exists, so there is '
+                'nothing to send an incremental stream from').format(base=base, target=self.replication_target))
+
+        self.logger.info('replicating {snapshot} to {target}{incremental}...'.format(snapshot=newest,
+            target=self.replication_target, incremental=base and ' from ' + base or ''))
+        script = build_replication_script(base, newest, self.replication_target)
+        self._run_command(['sh', '-s'], self.zfs_hostname, stdin_data=script, timeout=self.transfer_timeout)
+        record_replication(self.dataset_name, self.replication_target, newest)
+        self.logger.info('replicated {snapshot} to {target}'.format(snapshot=newest, target=self.replication_target))
+
+
     def _remove_zfs_snapshots_older_than(self, days, error_case):
         if not error_case:
             self.logger.info('looking for expired ZFS snapshots...')
-            expiration = datetime.now() - timedelta(days=days)
-
-            # Let's find all the snapshots for this dataset
-            command = 'zfs get -rH -o name,value type {dataset_name}'.format(dataset_name=self.dataset_name)
-            (stdout, stderr) = self._run_command(command, self.zfs_hostname)
-
-            snapshots = []
-            # Sometimes we get extra lines which are empty,
-            # so we'll strip the lines.
-            for line in stdout.strip().splitlines():
-                name, dataset_type = line.split('\t')
-                if dataset_type == 'snapshot':
-                    # Let's try to only consider destroying snapshots made by us ;)
-                    if name.split('@')[1].startswith(self.snapshot_prefix):
-                        snapshots.append(name)
-
-            # sentinel value used to log if we destroyed no snapshots
-            snapshots_destroyed = False
-
-            # destroy expired snapshots
-            for snapshot in snapshots:
-                command = 'zfs get -H -o value creation {snapshot}'.format(snapshot=snapshot)
-                (stdout, stderr) = self._run_command(command, self.zfs_hostname)
-                creation_time = datetime.strptime(stdout.strip(), '%a %b %d %H:%M %Y')
-                if creation_time <= expiration:
-                    self._run_command('zfs destroy {snapshot}'.format(snapshot=snapshot), self.zfs_hostname)
-                    snapshots_destroyed = True
-                    self.logger.info('{snapshot} destroyed'.format(snapshot=snapshot))
-
-            if not snapshots_destroyed:
+            expiration = time.time() - days * 24 * 60 * 60
+
+            snapshots = self._list_zfs_snapshots()
+            # The snapshots replication targets got last are the bases for
+            # their next incremental stream, so they have to stay.
+            replicated = [snapshot for key, snapshot in load_replication_state().items()
+                if snapshot.split('@')[0] == self.dataset_name]
+            expired = find_expired_snapshots(snapshots, expiration, self.snapshot_prefix, replicated)
+
+            if not expired:
                 self.logger.info('found no expired ZFS snapshots')
+                return
+
+            for destroy_arg in plan_zfs_snapshot_destroys([name for name, creation in snapshots], expired):
+                self._run_command('zfs destroy {destroy_arg}'.format(destroy_arg=destroy_arg), self.zfs_hostname)
+
+            for snapshot in expired:
+                self.logger.info('{snapshot} destroyed'.format(snapshot=snapshot))
+
+
+class RsyncOutput(object):
+    '''Counts the items in rsync's --itemize-changes output as it arrives
+
+    Only the last lines that aren't items, which hold the --stats output,
+    are kept.
+
+    '''
+    def __init__(self):
+        self.items_changed = 0
+        self._lines = collections.deque(maxlen=settings.command_output_tail_lines)
+        self._partial = ''
+
+
+    def _add_line(self, line):
+        if ITEMIZED_CHANGE_RE.match(line):
+            self.items_changed += 1
+        else:
+            self._lines.append(line)
+
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._add_line(line)
+
+
+    def close(self):
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ''
+
+
+    def getvalue(self):
+        return '\n'.join(self._lines)
+
+
+def is_ari_backup_snapshot(name, snapshot_prefix):
+    '''Returns True if the snapshot name looks like one made by us'''
+    return name.split('@')[1].startswith(snapshot_prefix)
+
+
+def rsync_changed_anything(transfer):
+    '''Returns False only if rsync says nothing changed
+
+    We go by the items --itemize-changes listed, which include deletions and
+    attribute changes. Without them we fall back on the statistics, which
+    count neither attribute changes nor, before rsync 3.1, deletions, so
+    unless they show deletions were counted we assume something changed.
+
+    '''
+    if 'items_changed' in transfer:
+        return bool(transfer['items_changed'])
+    stats = transfer.get('rsync', {})
+    if 'files_changed' not in transfer or 'number_of_deleted_files' not in stats:
+        return True
+    # Created directories and symlinks aren't counted as transferred files.
+    return bool(transfer['files_changed'] or stats.get('number_of_created_files'))
+
+
+def find_expired_snapshots(snapshots, expiration, snapshot_prefix, keep=()):
+    '''Returns the names of our snapshots created at or before expiration
+
+    snapshots is a list of (name, creation) in creation order. The newest of
+    our snapshots of each dataset is never expired, however old it is, since
+    we skip snapshots when nothing changed and it may be the only copy of the
+    dataset's current state. Neither is anything named in keep.
+
+    '''
+    ours = [(name, creation) for name, creation in snapshots if is_ari_backup_snapshot(name, snapshot_prefix)]
+
+    newest = {}
+    for name, creation in ours:
+        newest[name.split('@')[0]] = name
+
+    keep = set(newest.values()) | set(keep)
+    return [name for name, creation in ours if creation <= expiration and name not in keep]
+
+
+def get_replication_state_path():
+    return os.path.join(settings.state_dir, REPLICATION_STATE_FILENAME)
+
+
+def get_replication_key(dataset_name, target):
+    return '{dataset_name} -> {target}'.format(dataset_name=dataset_name, target=target)
+
+
+def load_replication_state(path=None):
+    '''Returns a dict of replication key -> the snapshot the target has'''
+    if path is None:
+        path = get_replication_state_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as state_file:
+        return json.load(state_file)
+
+
+def record_replication(dataset_name, target, snapshot, path=None):
+    '''Notes that target now has snapshot of dataset_name'''
+    if path is None:
+        path = get_replication_state_path()
+    with _replication_lock:
+        state = load_replication_state(path)
+        state[get_replication_key(dataset_name, target)] = snapshot
+
+        state_dir = os.path.dirname(path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        # Write a new file and rename it over the old one, so a crash can't
+        # leave us with half a file.
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file, indent=2, sort_keys=True)
+        os.rename(temp_path, path)
+
+
+def build_replication_script(base, snapshot, target):
+    '''Returns a shell script that sends snapshot to target
+
+    The stream is incremental from base, unless base is None. See the
+    zfs_replication_target setting for the kinds of target. A file target
+    gets one file per stream, named after the snapshot (and base), which only
+    appears once the whole stream is written.
+
+    '''
+    send_args = ['zfs', 'send']
+    if base is not None:
+        send_args += ['-i', base]
+    send_args.append(snapshot)
+    send = ' '.join([pipes.quote(arg) for arg in send_args])
+
+    lines = ['set -e']
+    if target.startswith('file:'):
+        directory = target[len('file:'):]
+        filename = snapshot.replace('/', '_')
+        if base is not None:
+            filename += '.from-' + base.split('@')[1]
+        path = pipes.quote(os.path.join(directory, filename + '.zfs'))
+        lines.append('mkdir -p {directory}'.format(directory=pipes.quote(directory)))
+        lines.append('{send} > {path}.tmp'.format(send=send, path=path))
+        lines.append('mv {path}.tmp {path}'.format(path=path))
+    else:
+        # -F rolls the target back to its newest snapshot first, in case
+        # anything touched it, and -u leaves it unmounted.
+        receive = 'zfs receive -F -u {dataset}'
+        if ':' in target:
+            host, dataset = target.split(':', 1)
+            receive = 'ssh {host} '.format(host=pipes.quote(host)) + pipes.quote(
+                receive.format(dataset=pipes.quote(dataset)))
+        else:
+            receive = receive.format(dataset=pipes.quote(target))
+        lines.append('{send} | {receive}'.format(send=send, receive=receive))
+
+    return ''.join([line + '\n' for line in lines])
+
+
+def plan_zfs_snapshot_destroys(snapshots, expired, max_specs=MAX_DESTROY_SPECS):
+    '''Returns the arguments for the zfs destroy commands that remove expired
+
+    snapshots is every snapshot name in creation order and expired is the
+    subset to destroy. Each argument covers one dataset. Runs of consecutive
+    expired snapshots become a snap%snap range, which zfs destroys in one go;
+    anything in between that we weren't asked to destroy (like snapshots
+    someone else made) breaks the run so it's never caught in a range.
+
+    '''
+    expired = set(expired)
+
+    # dataset -> list of runs, each run a list of snapshot names
+    runs = {}
+    datasets = []
+    previous_expired = {}
+    for name in snapshots:
+        dataset, snapshot_name = name.split('@')
+        if dataset not in runs:
+            runs[dataset] = []
+            datasets.append(dataset)
+        if name in expired:
+            if previous_expired.get(dataset):
+                runs[dataset][-1].append(snapshot_name)
+            else:
+                runs[dataset].append([snapshot_name])
+        previous_expired[dataset] = name in expired
+
+    destroy_args = []
+    for dataset in datasets:
+        specs = []
+        for run in runs[dataset]:
+            if len(run) == 1:
+                specs.append(run[0])
+            else:
+                specs.append('{first}%{last}'.format(first=run[0], last=run[-1]))
+
+        for i in range(0, len(specs), max_specs):
+            destroy_args.append('{dataset}@{specs}'.format(dataset=dataset, specs=','.join(specs[i:i + max_specs])))
+
+    return destroy_args
@@ -0,0 +1,194 @@
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+'''Benchmarks ari-backup's orchestration overhead
+
+Runs a synthetic fleet of ARIBackup, LVMBackup and ZFSLVMBackup jobs through
+the scheduler with ssh, rdiff-backup, rsync and the LVM, ZFS and mount
+commands replaced by tests/fakes/fake_command, so no real hosts or storage are
+touched. The fakes take a configurable time per call and print a configurable
+amount of output. We report how many times each command was run, the wall
+time and the peak RSS, which lets us check that batching, connection pooling
+and scheduling changes pay off as the fleet grows.
+
+Run it from the top of the source tree:
+
+    python -m tests.benchmark --jobs 20 --lvs 4 --snapshots 1000
+
+'''
+
+FAKE_COMMAND = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakes', 'fake_command')
+
+# The commands ari-backup runs that we replace with fakes
+FAKE_NAMES = [
+    'ssh', 'rdiff-backup', 'rsync', 'lvcreate', 'lvremove', 'lvextend', 'lvs',
+    'mount', 'umount', 'mkdir', 'rmdir', 'mountpoint', 'zfs',
+]
+
+JOB_KINDS = ['ARIBackup', 'LVMBackup', 'ZFSLVMBackup']
+
+
+def make_environment(options, work_dir):
+    '''Installs the fakes and a config file in work_dir and points us at them'''
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.mkdir(bin_dir)
+    for name in FAKE_NAMES:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as wrapper:
+            wrapper.write('#!/bin/sh\nARI_FAKE_NAME={name} exec {python} {fake_command} "$@"\n'.format(
+                name=name, python=sys.executable, fake_command=FAKE_COMMAND))
+        os.chmod(path, 0755)
+
+    # mkdir is one of the fakes, so the replication script can't make this.
+    os.mkdir(os.path.join(work_dir, 'replica'))
+
+    store_paths = []
+    for i in range(options.stores):
+        store_paths.append(os.path.join(work_dir, 'store{i}'.format(i=i)))
+        os.mkdir(store_paths[-1])
+
+    conf_path = os.path.join(work_dir, 'ari-backup.conf.yaml')
+    with open(conf_path, 'w') as conf_file:
+        conf_file.write('\n'.join([
+            'backup_store_paths: [{paths}]'.format(paths=', '.join(store_paths)),
+            'snapshot_mount_root: {path}'.format(path=os.path.join(work_dir, 'mnt')),
+            'state_dir: {path}'.format(path=os.path.join(work_dir, 'state')),
+            'ssh_path: {path}'.format(path=os.path.join(bin_dir, 'ssh')),
+            'rdiff_backup_path: {path}'.format(path=os.path.join(bin_dir, 'rdiff-backup')),
+            'rsync_path: {path}'.format(path=os.path.join(bin_dir, 'rsync')),
+            'rsync_options: -a',
+            'ssh_multiplexing: {value}'.format(value=str(not options.no_multiplexing).lower()),
+            'lvm_batch_commands: {value}'.format(value=str(options.batch).lower()),
+            'max_concurrent_jobs: {value}'.format(value=options.max_jobs),
+            'max_jobs_per_host: {value}'.format(value=options.max_jobs_per_host),
+            'max_jobs_per_store: {value}'.format(value=options.max_jobs_per_store),
+            'defer_maintenance: {value}'.format(value=str(options.defer_maintenance).lower()),
+            'bandwidth_limit: {value}'.format(value=options.bandwidth_limit),
+            'zfs_replication_target: {value}'.format(
+                value=options.replicate and 'file:' + os.path.join(work_dir, 'replica') or 'null'),
+            '',
+        ]))
+
+    log_path = os.path.join(work_dir, 'commands.log')
+    os.environ.update({
+        'ARI_BACKUP_CONFIG': conf_path,
+        'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        'ARI_FAKE_LOG': log_path,
+        'ARI_FAKE_LATENCY': str(options.latency),
+        'ARI_FAKE_SSH_HANDSHAKE': str(options.handshake),
+        'ARI_FAKE_OUTPUT_LINES': str(options.output_lines),
+        'ARI_FAKE_ZFS_SNAPSHOTS': str(options.snapshots),
+    })
+
+    return log_path
+
+
+def build_fleet(options):
+    '''Returns options.jobs jobs, cycling through the job kinds'''
+    # These can only be imported once make_environment() has pointed the
+    # settings at our config file.
+    from ari_backup import ARIBackup, LVMBackup
+    from ari_backup.zfs import ZFSLVMBackup
+
+    kinds = options.kinds.split(',')
+    jobs = []
+    for i in range(options.jobs):
+        kind = kinds[i % len(kinds)]
+        label = 'job{i}'.format(i=i)
+        host = 'host{i}'.format(i=i % options.hosts)
+
+        if kind == 'ARIBackup':
+            job = ARIBackup(label, host, '30D')
+        elif kind == 'LVMBackup':
+            job = LVMBackup(label, host, '30D')
+        elif kind == 'ZFSLVMBackup':
+            job = ZFSLVMBackup(label, host, 'backup:/tank/' + label, 'zfs0', 'tank/' + label, 30)
+        else:
+            raise Exception('unknown job kind {kind}'.format(kind=kind))
+
+        if kind != 'ARIBackup':
+            job.lv_list = [('vg0/lv{j}'.format(j=j), j and '/lv{j}'.format(j=j) or '/') for j in range(options.lvs)]
+        job.include_dir_list = ['/']
+        jobs.append(job)
+
+    return jobs
+
+
+def count_commands(log_path):
+    counts = {}
+    if os.path.exists(log_path):
+        with open(log_path) as log_file:
+            for line in log_file:
+                name = line.split(' ', 1)[0]
+                counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--jobs', type='int', default=6, help='number of jobs in the fleet')
+    parser.add_option('--kinds', default=','.join(JOB_KINDS),
+        help='comma separated job classes to cycle through (default %default)')
+    parser.add_option('--hosts', type='int', default=3, help='number of distinct source hosts')
+    parser.add_option('--lvs', type='int', default=4, help='logical volumes per LVM job')
+    parser.add_option('--snapshots', type='int', default=100, help='existing ZFS snapshots per dataset')
+    parser.add_option('--latency', type='float', default=0.0, help='seconds each fake command takes')
+    parser.add_option('--handshake', type='float', default=0.1,
+        help='extra seconds for an ssh call without a master connection')
+    parser.add_option('--output-lines', type='int', default=1000,
+        help='lines of output from each rdiff-backup and rsync run')
+    parser.add_option('--batch', action='store_true', default=False, help='batch LVM snapshot commands')
+    parser.add_option('--no-multiplexing', action='store_true', default=False,
+        help='use a new SSH connection for every command')
+    parser.add_option('--defer-maintenance', action='store_true', default=False,
+        help='run store maintenance from its own queue')
+    parser.add_option('--max-jobs', type='int', default=4, help='maximum concurrent jobs')
+    parser.add_option('--max-jobs-per-host', type='int', default=1, help='maximum concurrent jobs per host')
+    parser.add_option('--stores', type='int', default=1, help='number of backup stores')
+    parser.add_option('--max-jobs-per-store', type='int', default=0,
+        help='maximum concurrent jobs per backup store (default no limit)')
+    parser.add_option('--bandwidth-limit', type='int', default=0,
+        help='KB/s shared by all running jobs (default no limit)')
+    parser.add_option('--replicate', action='store_true', default=False,
+        help='replicate the ZFS snapshots to files with zfs send')
+    options, args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='ari-backup-benchmark-')
+    try:
+        log_path = make_environment(options, work_dir)
+        from ari_backup.scheduler import Scheduler
+
+        jobs = build_fleet(options)
+        start = time.time()
+        scheduler = Scheduler(jobs)
+        scheduler.run()
+        wall_time = time.time() - start
+
+        counts = count_commands(log_path)
+        failed = len([result for result in scheduler.results.values() if not result[2]])
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        print 'jobs:              {jobs} ({failed} failed)'.format(jobs=len(jobs), failed=failed)
+        print 'wall time:         {seconds:.2f}s'.format(seconds=wall_time)
+        print 'peak RSS:          {self_rss} KB (largest child {children_rss} KB)'.format(
+            self_rss=self_rss, children_rss=children_rss)
+        print 'commands:          {total}'.format(total=sum(counts.values()))
+        for name in sorted(counts):
+            print '  {name:<16} {count}'.format(name=name, count=counts[name])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,47 @@
+import datetime
+import gzip
+import logging
+import os
+import Queue
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import thread
+import threading
+import time
+import weakref
+
+from contextlib import closing
+
 import unittest2 as unittest
+import yaml
+
+from ari_backup import ARIBackup, LVMBackup, settings
+from ari_backup import catalog
+from ari_backup.budget import BandwidthBudget
+from ari_backup.command import LineLogger, StreamingCommand
+from ari_backup.compression import choose_compression
+from ari_backup.dumps import find_expired_dumps, get_dump_filename, parse_timespec
+from ari_backup.daemon import ControlServer, Daemon, next_run_time, parse_run_times, send_request
+from ari_backup.filelist import compile_selection, format_filelist, get_cache_dir, get_compiled_filelist
+from ari_backup.history import expected_durations, load_history
+from ari_backup.hooks import HookGroup
+from ari_backup import logger
+from ari_backup.logger import Logger
+from ari_backup import metrics
+from ari_backup.metrics import JobMetrics, parse_rdiff_backup_statistics, parse_rsync_statistics
+from ari_backup.scheduler import BrokenJob, ExternalJob, Scheduler, list_job_paths, load_jobs
+from ari_backup import stores
+from ari_backup.stores import choose_store
+from ari_backup import ssh
+from ari_backup.snapshot_sizing import MIN_SNAPSHOT_SIZE, choose_snapshot_size, parse_lvs
+from ari_backup.zfs import ZFSLVMBackup, build_replication_script, find_expired_snapshots, load_replication_state, \
+    RsyncOutput, plan_zfs_snapshot_destroys, record_replication, rsync_changed_anything
+
 
 class TestNothing(unittest.TestCase):
     def setUp(self):
@@ -7,5 +50,1490 @@ class TestNothing(unittest.TestCase):
     def test_nothing(self):
         pass
 
+
+class TempConfigTestCase(unittest.TestCase):
+    '''Runs each test against its own config file, backup store and state_dir'''
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='ari-backup-test-')
+        self.store_path = os.path.join(self.work_dir, 'store')
+        self.state_dir = os.path.join(self.work_dir, 'state')
+        os.mkdir(self.store_path)
+        self.conf_path = os.path.join(self.work_dir, 'ari-backup.conf.yaml')
+        self._conf_mtime = int(time.time())
+        self.write_conf()
+
+        self._old_conf_path = os.environ.get('ARI_BACKUP_CONFIG')
+        os.environ['ARI_BACKUP_CONFIG'] = self.conf_path
+        settings.reload()
+
+    def tearDown(self):
+        if self._old_conf_path is None:
+            del os.environ['ARI_BACKUP_CONFIG']
+        else:
+            os.environ['ARI_BACKUP_CONFIG'] = self._old_conf_path
+        settings.reload()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_conf(self, **extra):
+        conf = {
+            'backup_store_path': self.store_path,
+            'state_dir': self.state_dir,
+            'snapshot_mount_root': os.path.join(self.work_dir, 'mnt'),
+            'rsync_options': '-a',
+        }
+        conf.update(extra)
+        with open(self.conf_path, 'w') as conf_file:
+            yaml.safe_dump(conf, conf_file)
+        # A new mtime every time, so settings.reload() always notices.
+        self._conf_mtime += 1
+        os.utime(self.conf_path, (self._conf_mtime, self._conf_mtime))
+
+
+class RecordingLog(object):
+    def __init__(self):
+        self.warnings = []
+
+    def debug(self, message):
+        pass
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.flushed = False
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def flush(self):
+        self.flushed = True
+
+
+class TestLogWriter(unittest.TestCase):
+    def make_writer(self, max_queued=None):
+        writer = logger._LogWriter()
+        if max_queued is not None:
+            writer.queue = Queue.Queue(max_queued)
+        self.handler = RecordingHandler()
+        writer.handlers = [self.handler]
+        return writer
+
+    def make_record(self, message, levelno=logging.INFO):
+        return logging.makeLogRecord({'name': 'test', 'levelno': levelno,
+            'levelname': logging.getLevelName(levelno), 'msg': message})
+
+    def test_threads(self):
+        writer = self.make_writer()
+        writer.start()
+
+        def log(number):
+            for i in range(200):
+                writer.put(self.make_record('{number} {i}'.format(number=number, i=i)))
+
+        threads = [threading.Thread(target=log, args=(number,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.flush()
+
+        self.assertEqual(len(self.handler.messages), 8 * 200)
+        # Each thread's records come out in the order it logged them.
+        for number in range(8):
+            self.assertEqual([message for message in self.handler.messages if message.split()[0] == str(number)],
+                ['{number} {i}'.format(number=number, i=i) for i in range(200)])
+
+    def test_flush_drains_queue(self):
+        writer = self.make_writer()
+        # Everything queued before the exit handler runs gets written, even
+        # if the writer hasn't got to any of it yet.
+        for i in range(500):
+            writer.put(self.make_record(str(i)))
+        writer.start()
+        writer.flush()
+        self.assertEqual(self.handler.messages, [str(i) for i in range(500)])
+        self.assertTrue(self.handler.flushed)
+        self.assertFalse(writer.is_alive())
+
+    def test_dropped_records(self):
+        writer = self.make_writer(max_queued=2)
+        for message in ('one', 'two', 'three', 'four', 'five'):
+            writer.put(self.make_record(message))
+        self.assertEqual(writer.dropped, 3)
+        # The flush's own marker needs room in the queue, so start writing.
+        writer.start()
+        writer.flush()
+        self.assertEqual(self.handler.messages, ['3 log records were dropped', 'one', 'two'])
+
+    def test_errors_are_never_dropped(self):
+        writer = self.make_writer(max_queued=2)
+        writer.put(self.make_record('one'))
+        writer.put(self.make_record('two'))
+        writer.put(self.make_record('three', logging.ERROR))
+        writer.put(self.make_record('four'))
+        writer.put(self.make_record('five', logging.CRITICAL))
+        self.assertEqual(writer.dropped, 1)
+        # With the queue full, they're written right away instead.
+        self.assertEqual(self.handler.messages, ['three', 'five'])
+        writer.start()
+        writer.flush()
+        self.assertEqual(self.handler.messages, ['three', 'five', '1 log records were dropped', 'one', 'two'])
+
+    def test_records_after_flush(self):
+        writer = self.make_writer()
+        writer.start()
+        writer.put(self.make_record('before'))
+        writer.flush()
+        # Exit handlers that run after the writer's flush still get heard.
+        writer.put(self.make_record('after'))
+        self.assertEqual(self.handler.messages, ['before', 'after'])
+
+    def test_no_syslog(self):
+        def no_syslog(address):
+            raise socket.error('no such file or directory')
+
+        old_syslog_handler = logger.SysLogHandler
+        logger.SysLogHandler = no_syslog
+        try:
+            writer = logger._LogWriter()
+        finally:
+            logger.SysLogHandler = old_syslog_handler
+        self.assertEqual([type(handler) for handler in writer.handlers], [logging.StreamHandler])
+
+
+class TestSettings(TempConfigTestCase):
+    def test_defaults_and_required(self):
+        settings.register('test_setting_with_default', 42)
+        settings.register('test_required_setting')
+        self.assertEqual(settings.test_setting_with_default, 42)
+        self.assertRaises(Exception, getattr, settings, 'test_required_setting')
+        self.assertRaises(AttributeError, getattr, settings, 'test_unregistered_setting')
+
+        self.write_conf(test_setting_with_default=7, test_required_setting='set')
+        settings.reload()
+        self.assertEqual(settings.test_setting_with_default, 7)
+        self.assertEqual(settings.test_required_setting, 'set')
+
+    def test_reload_after_mtime_change(self):
+        self.assertEqual(settings.remote_user, 'root')
+        self.write_conf(remote_user='backup')
+        # Until reload() we keep what we parsed.
+        self.assertEqual(settings.remote_user, 'root')
+        settings.reload()
+        self.assertEqual(settings.remote_user, 'backup')
+
+    def test_unrecognized_setting(self):
+        log = RecordingLog()
+        old_log = settings._log
+        settings._log = log
+        try:
+            self.write_conf(no_such_setting=1)
+            settings.reload()
+            settings.check_unrecognized()
+            # Only once per parse of the file
+            settings.check_unrecognized()
+        finally:
+            settings._log = old_log
+        self.assertEqual(log.warnings, ['no_such_setting:1 is not a recognized setting'])
+
+
+class FakeJob(object):
+    def __init__(self, label, source_hostname, store, tracker):
+        self.label = label
+        self.source_hostname = source_hostname
+        self.store = store
+        self.tracker = tracker
+
+    def _get_backup_store(self):
+        return self.store
+
+    def run_backup(self):
+        self.tracker.enter(self)
+        time.sleep(0.05)
+        self.tracker.leave(self)
+        return True
+
+
+class FakeMaintenanceJob(FakeJob):
+    def __init__(self, *args):
+        FakeJob.__init__(self, *args)
+        self.defer_maintenance = False
+        self.maintained = False
+
+    def run_maintenance(self):
+        self.maintained = True
+        return True
+
+
+class ConcurrencyTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = []
+        self.peak_total = 0
+        self.peak_per_host = {}
+        self.peak_per_store = {}
+
+    def _peak(self, peaks, key):
+        count = len([job for job in self.running if key(job) == key(self.running[-1])])
+        peaks[key(self.running[-1])] = max(peaks.get(key(self.running[-1]), 0), count)
+
+    def enter(self, job):
+        with self.lock:
+            self.running.append(job)
+            self.peak_total = max(self.peak_total, len(self.running))
+            self._peak(self.peak_per_host, lambda j: j.source_hostname)
+            self._peak(self.peak_per_store, lambda j: j.store)
+
+    def leave(self, job):
+        with self.lock:
+            self.running.remove(job)
+
+
+class TestScheduler(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        self.tracker = ConcurrencyTracker()
+
+    def test_limits(self):
+        jobs = [FakeJob('job%d' % i, 'host%d' % (i % 3), 'store%d' % (i % 2), self.tracker) for i in range(12)]
+        scheduler = Scheduler(jobs, max_jobs=4, max_jobs_per_host=1, max_jobs_per_store=2)
+        scheduler.run()
+
+        self.assertEqual(len(scheduler.results), 12)
+        self.assertTrue(os.path.exists(os.path.join(self.state_dir, 'schedule-report.txt')))
+        self.assertTrue(self.tracker.peak_total <= 4)
+        self.assertEqual(max(self.tracker.peak_per_host.values()), 1)
+        self.assertTrue(max(self.tracker.peak_per_store.values()) <= 2)
+
+    def test_unlimited(self):
+        jobs = [FakeJob('job%d' % i, 'host', 'store', self.tracker) for i in range(5)]
+        scheduler = Scheduler(jobs, max_jobs=0, max_jobs_per_host=0, max_jobs_per_store=0)
+        scheduler.run()
+
+        self.assertEqual(self.tracker.peak_total, 5)
+
+    def test_deferred_maintenance(self):
+        jobs = [FakeMaintenanceJob('job%d' % i, 'host%d' % i, 'store', self.tracker) for i in range(3)]
+        scheduler = Scheduler(jobs, max_jobs=2, max_jobs_per_host=1, max_jobs_per_store=0,
+            defer_maintenance=True, max_maintenance_jobs=1)
+        scheduler.run()
+
+        for job in jobs:
+            self.assertTrue(job.defer_maintenance)
+            self.assertTrue(job.maintained)
+        self.assertEqual(scheduler.maintenance_results, {'job0': True, 'job1': True, 'job2': True})
+
+    def test_history_ordering(self):
+        history = {
+            'short': [{'duration': 10, 'success': True}, {'duration': 1, 'success': False}],
+            'long': [{'duration': 100, 'success': True}, {'duration': 120, 'success': True}],
+            'medium': [{'duration': 50, 'success': True}],
+        }
+        labels = ['short', 'medium', 'long', 'new']
+        durations = expected_durations(labels, history)
+        self.assertEqual(durations, {'short': 10, 'medium': 50, 'long': 110, 'new': 110})
+
+        jobs = [FakeJob(label, 'host-' + label, 'store', self.tracker) for label in labels]
+        scheduler = Scheduler(jobs, max_jobs=2, max_jobs_per_host=1, max_jobs_per_store=0)
+        ordered = sorted(jobs, key=lambda job: -durations[job.label])
+        self.assertEqual([job.label for job in ordered], ['long', 'new', 'medium', 'short'])
+        self.assertEqual(scheduler._simulate(ordered, durations),
+            {'long': 110, 'new': 110, 'medium': 160, 'short': 120})
+
+    def test_stores_looked_up_once(self):
+        lookups = []
+
+        class CountingJob(FakeJob):
+            def _get_backup_store(self):
+                lookups.append(self.label)
+                return FakeJob._get_backup_store(self)
+
+        jobs = [CountingJob('job%d' % i, 'host', 'store', self.tracker) for i in range(4)]
+        scheduler = Scheduler(jobs, max_jobs=1, max_jobs_per_host=0, max_jobs_per_store=1)
+        scheduler.run()
+        self.assertEqual(len(scheduler.results), 4)
+        self.assertEqual(sorted(lookups), ['job0', 'job1', 'job2', 'job3'])
+
+    def test_cancel_and_prioritise(self):
+        jobs = [FakeJob('job%d' % i, 'host', 'store', self.tracker) for i in range(4)]
+        scheduler = Scheduler(jobs, max_jobs=1, max_jobs_per_host=0, max_jobs_per_store=0, order_by_history=False)
+        scheduler._queue = list(jobs)
+
+        self.assertTrue(scheduler.prioritise('job2'))
+        self.assertFalse(scheduler.prioritise('nope'))
+        self.assertEqual(scheduler.cancel('job3'), 'removed from the queue')
+        self.assertEqual(scheduler.cancel('nope'), None)
+        self.assertEqual([status['label'] for status in scheduler.status()], ['job2', 'job0', 'job1'])
+        self.assertFalse(scheduler.results['job3'][2])
+
+
+class TestLoadJobs(TempConfigTestCase):
+    SCRIPTS = {
+        'a_good': 'ARIBackup("good", "db1").run_backup()\n',
+        'b_syntax_error': 'ARIBackup("syntax_error", "db1".run_backup()\n',
+        'c_raises': 'ARIBackup("raises", "db1")\nraise ValueError("no such host")\n',
+        'd_exits': 'sys.exit(3)\n',
+        # Scripts written to run on their own often exit with the job's
+        # result, which is None while we load them.
+        'e_exits_after_job': 'sys.exit(not ARIBackup("exits_after_job", "db1").run_backup())\n',
+    }
+
+    def test_broken_scripts(self):
+        jobs_dir = os.path.join(self.work_dir, 'jobs.d')
+        os.mkdir(jobs_dir)
+        for name, body in self.SCRIPTS.items():
+            path = os.path.join(jobs_dir, name)
+            with open(path, 'w') as script:
+                script.write('#!/usr/bin/env python\nimport sys\nfrom ari_backup import ARIBackup\n' + body)
+            os.chmod(path, 0755)
+
+        jobs = load_jobs(list_job_paths(jobs_dir))
+        self.assertEqual([(job.label, isinstance(job, BrokenJob)) for job in jobs], [
+            ('good', False), ('b_syntax_error', True), ('c_raises', True), ('d_exits', True),
+            ('exits_after_job', False)])
+        self.assertTrue(jobs[1].error.startswith('SyntaxError: '), jobs[1].error)
+        self.assertEqual(jobs[2].error, 'ValueError: no such host')
+
+        # The broken scripts are counted as failed jobs.
+        scheduler = Scheduler([job for job in jobs if isinstance(job, BrokenJob)], order_by_history=False)
+        scheduler.run()
+        self.assertEqual(sorted(scheduler.results), ['b_syntax_error', 'c_raises', 'd_exits'])
+        self.assertFalse([result for result in scheduler.results.values() if result[2]])
+
+
+class InterruptingJob(FakeJob):
+    '''Runs until it's cancelled, interrupting the main thread if asked to'''
+    def __init__(self, label, interrupt, tracker):
+        FakeJob.__init__(self, label, 'host-' + label, 'store', tracker)
+        self.interrupt = interrupt
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        return True
+
+    def run_backup(self):
+        self.tracker.enter(self)
+        if self.interrupt:
+            # Give the other job a moment to start.
+            time.sleep(0.2)
+            thread.interrupt_main()
+        self.cancelled.wait(10)
+        self.tracker.leave(self)
+        return False
+
+
+class TestSchedulerInterrupt(TempConfigTestCase):
+    def test_interrupt_cancels_running_jobs(self):
+        jobs = [InterruptingJob('waits', False, ConcurrencyTracker()), InterruptingJob('interrupts', True,
+            ConcurrencyTracker())]
+        scheduler = Scheduler(jobs, max_jobs=2, max_jobs_per_host=0, max_jobs_per_store=0, order_by_history=False)
+        start = time.time()
+        scheduler.run()
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(scheduler.interrupted)
+        for job in jobs:
+            self.assertTrue(job.cancelled.is_set())
+        self.assertEqual(sorted(scheduler.results), ['interrupts', 'waits'])
+
+
+class TestExternalJob(TempConfigTestCase):
+    def test_gets_no_other_fds(self):
+        fds_path = os.path.join(self.work_dir, 'fds')
+        job_path = os.path.join(self.work_dir, 'job')
+        with open(job_path, 'w') as job_file:
+            job_file.write('#!/bin/sh\nls /proc/$$/fd > {fds}\n'.format(fds=fds_path))
+        os.chmod(job_path, 0755)
+
+        # Another job's pipe, open while this one starts
+        read_fd, write_fd = os.pipe()
+        try:
+            self.assertTrue(ExternalJob(job_path).run_backup())
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        with open(fds_path) as fds_file:
+            fds = fds_file.read().split()
+        self.assertFalse(str(read_fd) in fds or str(write_fd) in fds, fds)
+
+
+class SleepingBackup(ARIBackup):
+    def __init__(self):
+        ARIBackup.__init__(self, 'sleeper', 'localhost')
+        self.error_case = None
+        # why the backup itself failed, if it did
+        self.failure = None
+        self.post_job_hook_list.append((self._record_error_case, {}))
+
+    def _run_backup(self):
+        try:
+            self._run_command('sleep 30')
+        except Exception, e:
+            self.failure = str(e)
+            raise
+
+    def _record_error_case(self, error_case):
+        self.error_case = error_case
+
+
+class TestCancel(TempConfigTestCase):
+    def test_cancel_runs_post_hooks(self):
+        job = SleepingBackup()
+        self.assertFalse(job.cancel())
+
+        results = []
+        worker = threading.Thread(target=lambda: results.append(job.run_backup()))
+        start = time.time()
+        worker.start()
+        while not job._commands and time.time() - start < 5:
+            time.sleep(0.05)
+        self.assertTrue(job.cancel())
+        worker.join()
+
+        self.assertEqual(results, [False])
+        self.assertEqual(job.failure, 'backup job cancelled')
+        self.assertTrue(job.error_case)
+        self.assertTrue(time.time() - start < 10)
+
+
+class TestTimeouts(TempConfigTestCase):
+    def test_timeout_runs_post_hooks(self):
+        job = SleepingBackup()
+        job.command_timeout = 1
+        start = time.time()
+        self.assertFalse(job.run_backup())
+        self.assertTrue('timed out after 1s' in job.failure, job.failure)
+        self.assertTrue(job.error_case)
+        self.assertTrue(time.time() - start < 10)
+
+    def test_stall_and_kill(self):
+        # The shell and its sleep ignore SIGTERM, so they have to be killed.
+        command = StreamingCommand(['sh', '-c', 'trap "" TERM; sleep 30'], Logger('test'),
+            stall_timeout=1)
+        command.kill_grace = 1
+        start = time.time()
+        self.assertEqual(command.run(), -signal.SIGKILL)
+        self.assertTrue(command.timed_out.startswith('stalled'))
+        self.assertTrue(time.time() - start < 10)
+
+    def test_silent_busy_child_is_not_stalled(self):
+        # The shell does nothing itself while its child reads quietly for
+        # three seconds; the child's I/O has to count.
+        busy = ('import time\nstart = time.time()\nzero = open("/dev/zero")\n'
+            'while time.time() - start < 3:\n    zero.read(65536)\n    time.sleep(0.01)\n')
+        command = StreamingCommand(['sh', '-c', '{python} -c \'{busy}\'; true'.format(
+            python=sys.executable, busy=busy)], Logger('test'), stall_timeout=1)
+        self.assertEqual(command.run(), 0)
+        self.assertEqual(command.timed_out, None)
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.lines = []
+
+    def isEnabledFor(self, level):
+        return True
+
+    def log(self, level, line):
+        self.lines.append(line)
+
+
+class TestStreamingCommand(TempConfigTestCase):
+    def test_tails(self):
+        self.write_conf(command_output_tail_lines=5)
+        settings.reload()
+        command = StreamingCommand(['sh', '-c', 'for i in 1 2 3 4 5 6 7 8; do echo out$i; echo err$i >&2; done'],
+            Logger('test'), capture_output=False)
+        self.assertEqual(command.run(), 0)
+        # The error report gets the last lines of both, the caller the last
+        # lines of each on their own.
+        self.assertEqual(len(command.get_tail().splitlines()), 5)
+        self.assertEqual(command.get_output(), ('out4\nout5\nout6\nout7\nout8', 'err4\nerr5\nerr6\nerr7\nerr8'))
+
+    def test_rate_limited_logging(self):
+        logger = RecordingLogger()
+        line_logger = LineLogger(logger, logging.DEBUG, 5)
+        for i in range(20):
+            line_logger.log(str(i))
+        line_logger.close()
+        self.assertEqual(logger.lines, ['0', '1', '2', '3', '4', '(15 lines of output not logged)'])
+
+    def test_output_is_not_a_stall(self):
+        command = StreamingCommand(['sh', '-c', 'for i in 1 2 3 4 5 6; do echo $i; sleep 0.4; done'], Logger('test'),
+            stall_timeout=1)
+        self.assertEqual(command.run(), 0)
+        self.assertEqual(command.timed_out, None)
+
+
+class TestHookGroup(TempConfigTestCase):
+    def test_runs_concurrently(self):
+        lock = threading.Lock()
+        running = []
+        peak = [0]
+        calls = []
+
+        def hook(name, error_case):
+            calls.append((name, error_case))
+            with lock:
+                running.append(name)
+                peak[0] = max(peak[0], len(running))
+            time.sleep(0.2)
+            with lock:
+                running.remove(name)
+
+        group = HookGroup([(hook, {'name': 'a'}), (hook, {'name': 'b'}),
+            [(hook, {'name': 'c1'}), (hook, {'name': 'c2'})]], max_concurrency=3)
+        group(error_case=True)
+        self.assertEqual(sorted(calls), [('a', True), ('b', True), ('c1', True), ('c2', True)])
+        self.assertEqual(peak[0], 3)
+
+    def test_failure_stops_the_group(self):
+        calls = []
+
+        def hook(name):
+            calls.append(name)
+            if name == 'bad':
+                raise Exception('hook failed')
+
+        group = HookGroup([(hook, {'name': 'bad'}), (hook, {'name': 'never'})], max_concurrency=1)
+        self.assertRaises(Exception, group)
+        self.assertEqual(calls, ['bad'])
+
+    def test_default_concurrency(self):
+        self.write_conf(max_concurrent_hooks=1)
+        settings.reload()
+        lock = threading.Lock()
+        running = []
+        peak = [0]
+
+        def hook():
+            with lock:
+                running.append(True)
+                peak[0] = max(peak[0], len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+        HookGroup([(hook, {}), (hook, {}), (hook, {})])()
+        self.assertEqual(peak[0], 1)
+
+
+class TestHookGroupInJob(TempConfigTestCase):
+    def test_failure_runs_error_case_hooks(self):
+        job = SleepingBackup()
+        job.pre_job_hook_list.append((HookGroup([(job._run_command, {'command': 'false'})], name='group'), {}))
+        self.assertFalse(job.run_backup())
+        self.assertTrue(job.error_case)
+        # The group failed and the backup never started.
+        self.assertEqual([(phase['name'], phase['ok']) for phase in job.metrics.phases][:2],
+            [('pre:_run_command', False), ('pre:group', False)])
+        self.assertEqual(job.failure, None)
+
+
+class TestSSHConnectionPool(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        # A stand-in for ssh that logs its arguments, and the fds a master
+        # starts with, and fails to start masters if we ask it to.
+        self.ssh_log_path = os.path.join(self.work_dir, 'ssh.log')
+        self.master_fds_path = os.path.join(self.work_dir, 'master-fds')
+        self.ssh_path = os.path.join(self.work_dir, 'ssh')
+        with open(self.ssh_path, 'w') as ssh_file:
+            ssh_file.write('#!/bin/sh\necho "$@" >> {log}\n'
+                'case " $* " in *" -M "*) ls /proc/$$/fd > {fds}; exit ${{MASTER_EXIT:-0}};; esac\n'.format(
+                    log=self.ssh_log_path, fds=self.master_fds_path))
+        os.chmod(self.ssh_path, 0755)
+        self.write_conf(ssh_path=self.ssh_path)
+        settings.reload()
+
+    def tearDown(self):
+        os.environ.pop('MASTER_EXIT', None)
+        TempConfigTestCase.tearDown(self)
+
+    def get_ssh_log(self):
+        with open(self.ssh_log_path) as ssh_log:
+            return ssh_log.read().splitlines()
+
+    def test_masters_and_close(self):
+        pool = ssh.SSHConnectionPool(RecordingLog())
+        self.assertTrue(pool in ssh._open_pools)
+        args = pool.ssh_args('root', 'db1')
+        self.assertEqual(pool.ssh_args('root', 'db1'), args)
+        control_path = args[args.index('-o') + 1][len('ControlPath='):]
+        self.assertEqual(args, [self.ssh_path, '-o', 'ControlPath=' + control_path, '-o', 'ControlMaster=no',
+            'root@db1'])
+        # One master, however many commands.
+        self.assertEqual(len(self.get_ssh_log()), 1)
+        self.assertTrue(self.get_ssh_log()[0].startswith('-M -N -f -o ControlPath=' + control_path))
+
+        pool.close()
+        self.assertEqual(self.get_ssh_log()[1], '-o ControlPath={path} -O exit root@db1'.format(path=control_path))
+        self.assertFalse(os.path.exists(os.path.dirname(control_path)))
+        self.assertFalse(pool in ssh._open_pools)
+        self.assertRaises(Exception, pool.ssh_args, 'root', 'db1')
+        # Closing again does nothing.
+        pool.close()
+        self.assertEqual(len(self.get_ssh_log()), 2)
+
+    def test_master_gets_no_other_fds(self):
+        # The master outlives us, so it mustn't hold other commands' pipes
+        # open.
+        read_fd, write_fd = os.pipe()
+        try:
+            pool = ssh.SSHConnectionPool(RecordingLog())
+            pool.ssh_args('root', 'db1')
+            pool.close()
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        with open(self.master_fds_path) as master_fds:
+            fds = master_fds.read().split()
+        self.assertFalse(str(read_fd) in fds or str(write_fd) in fds, fds)
+
+    def test_master_failure(self):
+        os.environ['MASTER_EXIT'] = '255'
+        log = RecordingLog()
+        pool = ssh.SSHConnectionPool(log)
+        # We fall back to a connection per command, and only try the master
+        # once.
+        self.assertEqual(pool.ssh_args('root', 'db1'), [self.ssh_path, 'root@db1'])
+        self.assertEqual(pool.ssh_args('root', 'db1'), [self.ssh_path, 'root@db1'])
+        self.assertEqual(len(self.get_ssh_log()), 1)
+        self.assertEqual(len(log.warnings), 1)
+        pool.close()
+        self.assertEqual(len(self.get_ssh_log()), 1)
+
+    def test_unused_pools_are_not_kept(self):
+        # The daemon makes a pool every run, so we mustn't hold on to them.
+        open_count = len(ssh._open_pools)
+        pool = ssh.SSHConnectionPool(RecordingLog())
+        self.assertEqual(len(ssh._open_pools), open_count + 1)
+        pool_ref = weakref.ref(pool)
+        del pool
+        self.assertEqual(pool_ref(), None)
+        self.assertEqual(len(ssh._open_pools), open_count)
+
+
+class TestRemoteSchema(TempConfigTestCase):
+    def test_bandwidth_limit_skips_multiplexing(self):
+        self.write_conf(trickle_path='/usr/bin/trickle', ssh_path='ssh')
+        settings.reload()
+        backup = ARIBackup('test', source_hostname='db1')
+        backup.bandwidth_limit = 100
+        schema = backup._get_remote_schema()
+        # trickle can only limit a connection of ssh's own, not one a master
+        # carries.
+        self.assertTrue(schema.startswith('/usr/bin/trickle -s -d 100 -u 100 ssh -o ControlPath=none '), schema)
+        self.assertTrue(schema.endswith(' %s rdiff-backup --server'), schema)
+
+    def test_compression_skips_multiplexing(self):
+        self.write_conf(io_priority={'default': {'nice': 10}}, ssh_path='ssh')
+        settings.reload()
+        backup = ARIBackup('test', source_hostname='db1')
+        backup.metrics.compression = True
+        # -C only counts on the connection that carries the bytes.
+        schema = backup._get_remote_schema()
+        self.assertTrue(schema.startswith('ssh -o ControlPath=none -C %s nice'), schema)
+
+    def test_adaptive_compression_is_opt_in(self):
+        # Left to itself, the job keeps to the compression options it has.
+        backup = ARIBackup('test', source_hostname='db1')
+        self.assertEqual(backup._choose_compression(), None)
+        self.write_conf(adaptive_compression=True)
+        settings.reload()
+        self.assertEqual(backup._choose_compression(), False)
+
+
+class TestRecentOutput(TempConfigTestCase):
+    def test_housekeeping_is_not_recent_output(self):
+        backup = LVMBackup('test', 'localhost')
+        backup._run_command('echo transferring')
+        backup._run_command('echo checking snapshots', recent_output=False)
+        self.assertEqual(backup.get_recent_output(), 'transferring')
+
+    def test_snapshot_monitor(self):
+        backup = LVMBackup('test', 'localhost')
+        backup.lv_snapshots = [backup._new_snapshot(('vg0/root', '/'))]
+        backup.lv_snapshots[0]['created'] = True
+        calls = []
+
+        def run_command(command, host, **kwargs):
+            calls.append(kwargs.get('recent_output', True))
+            return '', ''
+
+        backup._run_command = run_command
+        backup._sample_snapshots()
+        self.assertEqual(calls, [False])
+
+
+class TestSnapshotBatch(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        self.backup = LVMBackup('test', 'localhost')
+        self.backup.lv_list = [('vg0/root', '/'), ('vg0/var', '/var')]
+        self.backup.lv_snapshots = [self.backup._new_snapshot(volume) for volume in self.backup.lv_list]
+
+    def get_states(self):
+        return [(snapshot['created'], snapshot['mount_point_created'], snapshot['mounted'])
+            for snapshot in self.backup.lv_snapshots]
+
+    def test_all_steps(self):
+        self.backup._run_snapshot_batch([(0, 'create', 'true'), (1, 'create', 'true'), (0, 'mkdir', 'true'),
+            (0, 'check_mount', 'true'), (0, 'mount', 'true')])
+        self.assertEqual(self.get_states(), [(True, True, True), (True, False, False)])
+        self.assertTrue(self.backup.lv_snapshots[0]['created_time'])
+
+        self.backup._run_snapshot_batch([(0, 'umount', 'true'), (0, 'rmdir', 'true'), (0, 'lvremove', 'true')])
+        self.assertEqual(self.get_states(), [(False, False, False), (True, False, False)])
+
+    def test_failed_step(self):
+        try:
+            self.backup._run_snapshot_batch([(0, 'create', 'true'), (1, 'create', 'true'), (0, 'mkdir', 'true'),
+                (0, 'mount', '(exit 32)'), (1, 'mkdir', 'true')])
+            self.fail('the batch should fail')
+        except Exception, e:
+            self.assertEqual(str(e), '[localhost] the mount step for vg0/root{suffix} failed with exit code 32'.format(
+                suffix=settings.snapshot_suffix))
+        # The steps before the one that failed count, and none after it ran.
+        self.assertEqual(self.get_states(), [(True, True, False), (True, False, False)])
+
+    def test_failed_script(self):
+        # However the script is stopped, teardown has to know what it did.
+        self.backup.command_timeout = 1
+        try:
+            self.backup._run_snapshot_batch([(0, 'create', 'true'), (1, 'create', 'true'), (0, 'mkdir', 'sleep 30'),
+                (0, 'mount', 'true')])
+            self.fail('the batch should fail')
+        except Exception, e:
+            self.assertTrue('timed out after 1s' in str(e), str(e))
+        self.assertEqual(self.get_states(), [(True, False, False), (True, False, False)])
+
+    def test_teardown_steps(self):
+        steps = []
+        self.backup._run_snapshot_batch = steps.extend
+        self.backup.lv_snapshots[0].update({'created': True, 'mount_point_created': True, 'mounted': True})
+        self.backup.lv_snapshots[1].update({'created': True})
+        self.backup._umount_and_delete_snapshots_batched()
+        self.assertEqual([(index, step) for index, step, command in steps],
+            [(0, 'umount'), (0, 'rmdir'), (0, 'lvremove'), (1, 'lvremove')])
+
+
+class FakeTransferLVMBackup(LVMBackup):
+    '''Records the rdiff-backup runs instead of running them'''
+    def __init__(self, *args):
+        LVMBackup.__init__(self, *args)
+        self.transfers = []
+        self.failing_repository = None
+
+    def _rdiff_backup(self, source_path, repository_path, include_dir_list, exclude_dir_list):
+        self.transfers.append(repository_path)
+        time.sleep(0.05)
+        if repository_path == self.failing_repository:
+            raise Exception('rdiff-backup exited with 1')
+        return {'bytes_changed': 10, 'elapsed_seconds': 1.5}
+
+
+class TestLVStreams(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        self.backup = FakeTransferLVMBackup('test', 'db1')
+        self.backup.lv_streams = 2
+        self.backup.lv_list = [('vg0/root', '/'), ('vg0/var', '/var'), ('vg0/home', '/home'), ('vg0/srv', '/srv')]
+        self.backup.lv_snapshots = [self.backup._new_snapshot(volume) for volume in self.backup.lv_list]
+        self.backup.include_dir_list = ['/etc', '/var', '/home/alice']
+        self.backup.exclude_dir_list = ['/var/cache', '/home/alice/tmp', '/tmp']
+
+    def test_plan(self):
+        base = self.backup.snapshot_mount_point_base_path
+        plan = [(snapshot['origin_lv_path'], [path[len(base):] for path in include_dir_list],
+            [path[len(base):] for path in exclude_dir_list])
+            for snapshot, include_dir_list, exclude_dir_list in self.backup._plan_lv_streams()]
+        # Each LV gets what falls inside it, and leaves out the LVs mounted
+        # inside it. Nothing is included from /srv, so it gets no stream.
+        self.assertEqual(plan, [
+            ('vg0/root', ['/etc'], ['/tmp', '/var', '/home', '/srv']),
+            ('vg0/var', ['/var'], ['/var/cache']),
+            ('vg0/home', ['/home/alice'], ['/home/alice/tmp']),
+        ])
+
+        self.backup.include_dir_list = ['/']
+        plan = [(snapshot['origin_lv_path'], include_dir_list)
+            for snapshot, include_dir_list, exclude_dir_list in self.backup._plan_lv_streams()]
+        self.assertEqual(plan, [('vg0/root', [base + '/']), ('vg0/var', [base + '/var']),
+            ('vg0/home', [base + '/home']), ('vg0/srv', [base + '/srv'])])
+
+    def test_one_stream_fails(self):
+        self.backup.failing_repository = self.backup._get_lv_repository_path('vg0/var')
+        try:
+            self.backup._run_lv_streams()
+            self.fail('the backup should fail')
+        except Exception, e:
+            self.assertEqual(str(e), 'backups of 1 LVs failed: vg0/var{suffix}: rdiff-backup exited with 1'.format(
+                suffix=settings.snapshot_suffix))
+
+        # The other streams still ran, and their transfers are counted.
+        self.assertEqual(sorted(self.backup.transfers), sorted([self.backup._get_lv_repository_path(lv_path)
+            for lv_path in ('vg0/root', 'vg0/var', 'vg0/home')]))
+        transfer = self.backup.metrics.transfer
+        self.assertEqual(transfer['bytes_changed'], 20)
+        self.assertEqual(sorted(transfer['streams']), ['vg0/home' + settings.snapshot_suffix,
+            'vg0/root' + settings.snapshot_suffix])
+
+
+class TestDumps(TempConfigTestCase):
+    def test_parse_timespec(self):
+        self.assertEqual(parse_timespec('10B'), ('count', 10))
+        self.assertEqual(parse_timespec('2W3D', now=1000000), ('time', 1000000 - 17 * 24 * 60 * 60))
+        self.assertEqual(parse_timespec('1Y1M', now=10 ** 8), ('time', 10 ** 8 - 395 * 24 * 60 * 60))
+        self.assertEqual(parse_timespec('1000'), ('time', 1000))
+        self.assertRaises(ValueError, parse_timespec, '3 days')
+
+    def test_find_expired_dumps(self):
+        day = 24 * 60 * 60
+        now = 100 * day
+        filenames = [get_dump_filename('db', now - days * day) for days in (1, 5, 40)]
+        filenames += [get_dump_filename('old', now - 90 * day), 'unrelated', 'db.tmp']
+        self.assertEqual(find_expired_dumps(filenames, '30D', now), [filenames[2]])
+        # The newest dump of each name stays, however old.
+        self.assertEqual(find_expired_dumps(filenames, '1D', now), sorted(filenames[1:3]))
+        self.assertEqual(find_expired_dumps(filenames, '1B', now), sorted(filenames[1:3]))
+
+    def test_capture_dump(self):
+        job = ARIBackup('dumper', 'localhost')
+        dump_dir = job._get_dump_dir()
+        self.assertEqual(dump_dir, os.path.join(self.store_path, '.dumps', 'dumper'))
+
+        job._capture_dump('zeros', 'head -c 1000000 /dev/zero')
+        filenames = os.listdir(dump_dir)
+        self.assertEqual(len(filenames), 1)
+        self.assertTrue(filenames[0].startswith('zeros.') and filenames[0].endswith('.gz'))
+        with closing(gzip.open(os.path.join(dump_dir, filenames[0]))) as dump_file:
+            self.assertEqual(dump_file.read(), '\0' * 1000000)
+
+        # A failed dump leaves nothing behind.
+        with self.assertRaises(Exception) as context:
+            job._capture_dump('failed', 'sh -c "echo partial; exit 1"')
+        self.assertTrue('terminated with errors' in str(context.exception), str(context.exception))
+        self.assertEqual(os.listdir(dump_dir), filenames)
+
+
+class TestDaemon(unittest.TestCase):
+    def test_next_run_time(self):
+        run_times = parse_run_times(['22:30', '01:00'])
+        now = datetime.datetime(2013, 1, 1, 12, 0)
+        self.assertEqual(next_run_time(run_times, now), datetime.datetime(2013, 1, 1, 22, 30))
+        now = datetime.datetime(2013, 1, 1, 22, 30)
+        self.assertEqual(next_run_time(run_times, now), datetime.datetime(2013, 1, 2, 1, 0))
+        self.assertRaises(Exception, parse_run_times, ['1am'])
+
+
+class TestDaemonControl(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        self.socket_path = os.path.join(self.work_dir, 'daemon.sock')
+        self.jobs_dir = os.path.join(self.work_dir, 'jobs.d')
+        os.mkdir(self.jobs_dir)
+
+    def test_socket(self):
+        daemon = Daemon(self.jobs_dir, self.socket_path)
+        server = ControlServer(self.socket_path, daemon)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        try:
+            self.assertEqual(os.stat(self.socket_path).st_mode & 0077, 0)
+            # A second daemon mustn't take the socket from a live one.
+            self.assertRaises(Exception, ControlServer, self.socket_path, daemon)
+            self.assertTrue(send_request(self.socket_path, {'command': 'status'})['ok'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
+
+        # The dead daemon's socket is still there, and is ours to take.
+        self.assertTrue(os.path.exists(self.socket_path))
+        ControlServer(self.socket_path, daemon).server_close()
+
+    def test_sigterm_cancels_jobs(self):
+        marker_path = os.path.join(self.work_dir, 'cancelled')
+        job_path = os.path.join(self.jobs_dir, 'sleeper')
+        with open(job_path, 'w') as job_file:
+            job_file.write("#!/bin/sh\ntrap 'echo cancelled > {marker}; kill $!; exit 1' TERM\nsleep 30 &\nwait\n".format(
+                marker=marker_path))
+        os.chmod(job_path, 0755)
+
+        def stop_daemon():
+            while not os.path.exists(self.socket_path):
+                time.sleep(0.05)
+            send_request(self.socket_path, {'command': 'run'})
+            while not send_request(self.socket_path, {'command': 'status'})['jobs']:
+                time.sleep(0.05)
+            # Give the job's shell time to set its trap.
+            time.sleep(0.2)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        stopper = threading.Thread(target=stop_daemon)
+        stopper.daemon = True
+        stopper.start()
+        start = time.time()
+        Daemon(self.jobs_dir, self.socket_path).serve_forever()
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue(os.path.exists(marker_path))
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+
+class TestFilelist(unittest.TestCase):
+    def test_compile_selection(self):
+        includes, excludes = compile_selection(
+            ['/etc', '/etc/', '/etc/apache2', '/var/log', '/home', '/srv/www'],
+            ['/var', '/tmp', '/home/*/.cache', '/home/bob/.cache/x', '/home/bob//tmp/', '/srv', '/srv/www/cache'])
+        # /var and /srv stop us reaching /var/log and /srv/www, after which
+        # they and /tmp don't overlap anything we include.
+        self.assertEqual(includes, ['/etc', '/home'])
+        self.assertEqual(excludes, ['/home/*/.cache', '/home/bob/.cache/x', '/home/bob/tmp'])
+        includes, excludes = compile_selection(['/var/log'], ['/var'])
+        self.assertEqual((includes, excludes), ([], []))
+        includes, excludes = compile_selection(['/var/log'], ['/', '/var/log/x'])
+        self.assertEqual((includes, excludes), ([], []))
+        includes, excludes = compile_selection(['/var/log/apache2'], ['/var/log', '/var/lib'])
+        self.assertEqual((includes, excludes), ([], []))
+        includes, excludes = compile_selection(['/var/log/apache2', '/srv'], ['/var'])
+        self.assertEqual((includes, excludes), (['/srv'], []))
+        self.assertEqual(format_filelist(['/etc'], ['/etc/ssl']), '- /etc/ssl\n+ /etc\n')
+
+    def test_unknown_includes_keep_excludes(self):
+        self.assertEqual(compile_selection(['/'], ['/tmp'], include_filelists=True), (['/'], ['/tmp']))
+        self.assertEqual(compile_selection(['/home/*'], ['/tmp', '/**/.cache']), (['/home/*'], ['/tmp', '/**/.cache']))
+
+
+class TestFilelistCache(TempConfigTestCase):
+    def test_concurrent_writers(self):
+        # Jobs with the same rules that start together all miss the cache and
+        # write the same files at once.
+        errors = []
+
+        def writer():
+            try:
+                for i in range(50):
+                    path, stats = get_compiled_filelist(['/etc'], ['/etc/{i}'.format(i=i)])
+                    with open(path) as filelist:
+                        self.assertEqual(filelist.read(), '- /etc/{i}\n+ /etc\n'.format(i=i))
+                    self.assertEqual(stats['output_rules'], 2)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        names = os.listdir(get_cache_dir())
+        self.assertEqual([name for name in names if name.endswith('.tmp')], [])
+        self.assertEqual(len(names), 100)
+
+
+class TestStores(unittest.TestCase):
+    def test_choose_store(self):
+        stores = ['/a', '/b', '/c']
+        free_bytes = {'/a': 100, '/b': 300, '/c': 300}
+        self.assertEqual(choose_store(stores, free_bytes, {}), '/b')
+        self.assertEqual(choose_store(stores, free_bytes, {'/b': 1}), '/c')
+        self.assertEqual(choose_store(stores, free_bytes, {'/b': 2, '/c': 2}), '/a')
+
+
+class TestStorePlacement(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        self.store_paths = [os.path.join(self.work_dir, name) for name in ('store1', 'store2')]
+        for store_path in self.store_paths:
+            os.mkdir(store_path)
+        # A stand-in for rsync that copies with cp, since all we ask of it is
+        # to copy a directory's contents.
+        rsync_path = os.path.join(self.work_dir, 'rsync')
+        with open(rsync_path, 'w') as rsync_file:
+            rsync_file.write('#!/bin/sh\nfor arg; do source=$destination; destination=$arg; done\n'
+                'mkdir -p "$destination" && cp -a "$source." "$destination"\n')
+        os.chmod(rsync_path, 0755)
+        self.write_conf(backup_store_paths=self.store_paths, rsync_path=rsync_path)
+        settings.reload()
+
+    def test_get_store(self):
+        store_path = stores.get_store('new')
+        self.assertTrue(store_path in self.store_paths)
+        self.assertEqual(stores.load_store_map(), {'new': store_path})
+        self.assertEqual(stores.get_store('new'), store_path)
+
+        # A label goes where its repository already is.
+        os.mkdir(os.path.join(self.store_paths[1], 'existing'))
+        self.assertEqual(stores.get_store('existing'), self.store_paths[1])
+        self.assertEqual(stores.load_store_map(), {'new': store_path, 'existing': self.store_paths[1]})
+
+        # It's never quietly placed again somewhere else.
+        self.write_conf(backup_store_paths=[self.store_paths[0], os.path.join(self.work_dir, 'store3')])
+        settings.reload()
+        self.assertRaises(Exception, stores.get_store, 'existing')
+
+    def test_write_counts(self):
+        store_path = self.store_paths[0]
+        before = stores._active_writes.get(store_path, 0)
+        stores.begin_write(store_path)
+        stores.begin_write(store_path)
+        self.assertEqual(stores._active_writes[store_path], before + 2)
+        stores.end_write(store_path)
+        stores.end_write(store_path)
+        self.assertEqual(stores._active_writes[store_path], before)
+
+    def make_repository(self, store_path, label):
+        repository_path = os.path.join(store_path, label)
+        os.makedirs(os.path.join(repository_path, 'rdiff-backup-data'))
+        with open(os.path.join(repository_path, 'file'), 'w') as data_file:
+            data_file.write('data')
+        dump_dir = os.path.join(store_path, '.dumps', label)
+        os.makedirs(dump_dir)
+        with open(os.path.join(dump_dir, 'db.2013-01-01T00:00:00.gz'), 'w') as dump_file:
+            dump_file.write('dump')
+
+    def test_move_repository(self):
+        old_store, new_store = self.store_paths
+        self.make_repository(old_store, 'db1')
+        self.assertEqual(stores.get_store('db1'), old_store)
+
+        stores.move_repository('db1', new_store)
+        self.assertEqual(stores.get_store('db1'), new_store)
+        with open(os.path.join(new_store, 'db1', 'file')) as data_file:
+            self.assertEqual(data_file.read(), 'data')
+        self.assertTrue(os.path.isdir(os.path.join(new_store, 'db1', 'rdiff-backup-data')))
+        self.assertTrue(os.path.exists(os.path.join(new_store, '.dumps', 'db1', 'db.2013-01-01T00:00:00.gz')))
+        # The old copy is removed, and nothing else on the store.
+        self.assertFalse(os.path.exists(os.path.join(old_store, 'db1')))
+        self.assertFalse(os.path.exists(os.path.join(old_store, '.dumps', 'db1')))
+        self.assertTrue(os.path.isdir(old_store))
+
+        # Moving it back, keeping the source
+        stores.move_repository('db1', old_store, keep_source=True)
+        self.assertEqual(stores.get_store('db1'), old_store)
+        self.assertTrue(os.path.exists(os.path.join(old_store, 'db1', 'file')))
+        self.assertTrue(os.path.exists(os.path.join(new_store, 'db1', 'file')))
+
+    def test_move_refusals(self):
+        old_store, new_store = self.store_paths
+        self.make_repository(old_store, 'db1')
+        self.assertRaises(Exception, stores.move_repository, 'db1', os.path.join(self.work_dir, 'elsewhere'))
+        # Something is already where it would go.
+        os.mkdir(os.path.join(new_store, 'db1'))
+        self.assertRaises(Exception, stores.move_repository, 'db1', new_store)
+        self.assertEqual(stores.get_store('db1'), old_store)
+        self.assertTrue(os.path.exists(os.path.join(old_store, 'db1', 'file')))
+        # Nor while its job is running
+        os.rmdir(os.path.join(new_store, 'db1'))
+        lock_file = stores.lock_label('db1')
+        try:
+            self.assertRaises(Exception, stores.move_repository, 'db1', new_store)
+        finally:
+            lock_file.close()
+        self.assertEqual(stores.get_store('db1'), old_store)
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.repository = os.path.join(self.work_dir, 'job')
+        os.makedirs(os.path.join(self.repository, 'rdiff-backup-data'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def add_session(self, start_time, increment_size):
+        path = os.path.join(self.repository, 'rdiff-backup-data', 'session_statistics.{time}.data'.format(
+            time=start_time))
+        with open(path, 'w') as statistics_file:
+            statistics_file.write('StartTime {time}.00 (whenever)\nSourceFiles 10\nIncrementFileSize {size}\n'
+                'Errors 0\n'.format(time=start_time, size=increment_size))
+        return path
+
+    def test_update_and_plan(self):
+        with closing(catalog.connect(os.path.join(self.work_dir, 'catalog.sqlite'))) as connection:
+            old_session = self.add_session(1000, 10)
+            self.add_session(2000, 20)
+            self.assertEqual(catalog.update_repository(connection, 'job', self.repository), (2, 0))
+            self.add_session(3000, 30)
+            catalog.record_run(connection, 'job', 2900, 3100, False)
+            self.assertEqual(catalog.update_repository(connection, 'job', self.repository), (1, 0))
+
+            self.assertEqual(catalog.list_labels(connection), [('job', 3, 1000, 3000, 60)])
+            self.assertEqual([row[4] for row in catalog.list_sessions(connection, 'job')], [None, None, 0])
+            plan = catalog.plan_restore(connection, 'job', 2500)
+            self.assertEqual((plan[0]['session_time'], plan[0]['increments'], plan[0]['increment_bytes']),
+                (2000, 1, 30))
+            self.assertEqual(catalog.plan_restore(connection, 'job', 500), [])
+
+            os.remove(old_session)
+            self.assertEqual(catalog.update_repository(connection, 'job', self.repository), (0, 1))
+
+
+class TestZFSCatalog(TempConfigTestCase):
+    def update_catalog(self):
+        backup = ZFSLVMBackup('zfs', 'db1', '/srv/backups/db1', 'localhost', 'tank/backups/db1', 30)
+        backup.logger = RecordingLog()
+        backup._update_catalog()
+        return backup.logger.warnings
+
+    def test_no_repository(self):
+        store_paths = [os.path.join(self.work_dir, name) for name in ('store1', 'store2')]
+        for store_path in store_paths:
+            os.mkdir(store_path)
+        self.write_conf(backup_store_paths=store_paths)
+        settings.reload()
+        self.assertEqual(self.update_catalog(), [])
+        # The label wasn't placed on an rdiff-backup store.
+        self.assertFalse(os.path.exists(os.path.join(self.state_dir, 'stores.json')))
+
+    def test_no_stores(self):
+        # A deployment with only ZFS jobs needs no rdiff-backup store.
+        self.write_conf(backup_store_path=None)
+        settings.reload()
+        self.assertEqual(self.update_catalog(), [])
+
+
+class TestZFSSnapshotExpiry(unittest.TestCase):
+    def test_ranges_and_batches(self):
+        snapshots = ['pool/a@ari-backup-1', 'pool/a@ari-backup-2', 'pool/a@ari-backup-3',
+                     'pool/a@manual', 'pool/a@ari-backup-4', 'pool/a/b@ari-backup-1',
+                     'pool/a@ari-backup-5']
+        expired = ['pool/a@ari-backup-1', 'pool/a@ari-backup-2', 'pool/a@ari-backup-3',
+                   'pool/a@ari-backup-4', 'pool/a/b@ari-backup-1']
+
+        self.assertEqual(plan_zfs_snapshot_destroys(snapshots, expired),
+            ['pool/a@ari-backup-1%ari-backup-3,ari-backup-4', 'pool/a/b@ari-backup-1'])
+        self.assertEqual(plan_zfs_snapshot_destroys(snapshots, expired, max_specs=1),
+            ['pool/a@ari-backup-1%ari-backup-3', 'pool/a@ari-backup-4', 'pool/a/b@ari-backup-1'])
+
+    def test_nothing_expired(self):
+        self.assertEqual(plan_zfs_snapshot_destroys(['pool/a@ari-backup-1'], []), [])
+
+    def test_newest_is_kept(self):
+        snapshots = [('pool/a@ari-backup-1', 100), ('pool/a@ari-backup-2', 200), ('pool/a@manual', 300),
+                     ('pool/a/b@ari-backup-1', 100)]
+        self.assertEqual(find_expired_snapshots(snapshots, 1000, 'ari-backup-'), ['pool/a@ari-backup-1'])
+        self.assertEqual(find_expired_snapshots(snapshots, 150, 'ari-backup-'), ['pool/a@ari-backup-1'])
+        self.assertEqual(find_expired_snapshots(snapshots, 50, 'ari-backup-'), [])
+
+    def test_replication_base_is_kept(self):
+        snapshots = [('pool/a@ari-backup-1', 100), ('pool/a@ari-backup-2', 200), ('pool/a@ari-backup-3', 300)]
+        self.assertEqual(find_expired_snapshots(snapshots, 1000, 'ari-backup-', ['pool/a@ari-backup-1']),
+            ['pool/a@ari-backup-2'])
+
+    def test_rsync_changed_anything(self):
+        self.assertTrue(rsync_changed_anything({}))
+        self.assertTrue(rsync_changed_anything(parse_rsync_statistics(RSYNC_STATISTICS)))
+        self.assertFalse(rsync_changed_anything(parse_rsync_statistics('Number of files: 3,085\n'
+            'Number of created files: 0\nNumber of deleted files: 0\nNumber of regular files transferred: 0\n')))
+        self.assertTrue(rsync_changed_anything(parse_rsync_statistics(
+            'Number of files: 3,085\nNumber of created files: 1 (dir: 1)\nNumber of deleted files: 0\n')))
+        # rsync before 3.1 doesn't count deletions, so its statistics can't
+        # tell us nothing changed.
+        self.assertTrue(rsync_changed_anything(parse_rsync_statistics(
+            'Number of files: 3085\nNumber of files transferred: 0\n')))
+
+    def rsync_transfer(self, output):
+        rsync_output = RsyncOutput()
+        # in pieces, as it arrives
+        for i in range(0, len(output), 7):
+            rsync_output.write(output[i:i + 7])
+        rsync_output.close()
+        transfer = parse_rsync_statistics(rsync_output.getvalue())
+        transfer['items_changed'] = rsync_output.items_changed
+        return transfer
+
+    def test_rsync_itemized_changes(self):
+        # rsync 3.0 statistics, which say nothing was transferred either way
+        stats = 'Number of files: 3085\nNumber of files transferred: 0\nTotal file size: 1234 bytes\n'
+        transfer = self.rsync_transfer(stats)
+        self.assertEqual(transfer['items_changed'], 0)
+        self.assertEqual(transfer['files_scanned'], 3085)
+        self.assertFalse(rsync_changed_anything(transfer))
+
+        transfer = self.rsync_transfer('*deleting   var/old.log\n.d..t...... var/\n' + stats)
+        self.assertEqual(transfer['items_changed'], 2)
+        self.assertEqual(transfer['files_scanned'], 3085)
+        self.assertTrue(rsync_changed_anything(transfer))
+
+        # Only permissions and ownership changed.
+        transfer = self.rsync_transfer('.f...po.... etc/shadow\n' + stats)
+        self.assertEqual(transfer['items_changed'], 1)
+        self.assertTrue(rsync_changed_anything(transfer))
+
+
+class TestFakeSSH(unittest.TestCase):
+    def run_ssh(self, *options):
+        fake_command = os.path.join(os.path.dirname(__file__), 'fakes', 'fake_command')
+        env = dict(os.environ, ARI_FAKE_NAME='ssh', ARI_FAKE_SSH_HANDSHAKE='1')
+        start = time.time()
+        self.assertEqual(subprocess.call([sys.executable, fake_command] + list(options) + ['root@db1', 'true'],
+            env=env), 0)
+        return time.time() - start
+
+    def test_handshakes(self):
+        # The benchmark has to charge a handshake to connections that
+        # explicitly don't use a master.
+        self.assertTrue(self.run_ssh('-o', 'ControlPath=/tmp/master', '-o', 'ControlMaster=no') < 1)
+        self.assertTrue(self.run_ssh('-o', 'ControlPath=none', '-C') >= 1)
+        self.assertTrue(self.run_ssh('-S', 'none') >= 1)
+
+
+class TestZFSReplication(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        # Stand in for zfs with the benchmark's fake.
+        bin_dir = os.path.join(self.work_dir, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'zfs'), 'w') as wrapper:
+            wrapper.write('#!/bin/sh\nARI_FAKE_NAME=zfs exec {python} {fake_command} "$@"\n'.format(
+                python=sys.executable, fake_command=os.path.join(os.path.dirname(__file__), 'fakes', 'fake_command')))
+        os.chmod(os.path.join(bin_dir, 'zfs'), 0755)
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_script(self, script):
+        process = subprocess.Popen(['sh', '-s'], stdin=subprocess.PIPE, env=self.env)
+        process.communicate(script)
+        return process.returncode
+
+    def test_file_target(self):
+        target = 'file:' + os.path.join(self.work_dir, 'replica')
+        self.assertEqual(self.run_script(build_replication_script(
+            'pool/a@ari-backup-1', 'pool/a@ari-backup-2', target)), 0)
+        with open(os.path.join(self.work_dir, 'replica', 'pool_a@ari-backup-2.from-ari-backup-1.zfs')) as stream:
+            self.assertEqual(stream.read(), 'fake zfs stream: -i pool/a@ari-backup-1 pool/a@ari-backup-2\n')
+
+    def test_dataset_target(self):
+        self.assertEqual(self.run_script(build_replication_script(None, 'pool/a@ari-backup-1', 'backup/a')), 0)
+
+    def test_state(self):
+        path = os.path.join(self.work_dir, 'state', 'zfs-replication.json')
+        self.assertEqual(load_replication_state(path), {})
+        record_replication('pool/a', 'backup/a', 'pool/a@ari-backup-1', path)
+        record_replication('pool/a', 'backup/a', 'pool/a@ari-backup-2', path)
+        self.assertEqual(load_replication_state(path), {'pool/a -> backup/a': 'pool/a@ari-backup-2'})
+
+
+RDIFF_BACKUP_STATISTICS = '''--------------[ Session statistics ]--------------
+StartTime 1357016400.00 (Tue Jan  1 00:00:00 2013)
+ElapsedTime 10.50 (10.50 seconds)
+SourceFiles 2133
+SourceFileSize 123456789 (118 MB)
+NewFiles 3
+NewFileSize 4000 (3.91 KB)
+DeletedFiles 1
+ChangedFiles 10
+ChangedSourceSize 500000 (488 KB)
+TotalDestinationSizeChange -124000 (-121 KB)
+Errors 0
+--------------------------------------------------
+'''
+
+RSYNC_STATISTICS = '''
+Number of files: 3,085 (reg: 2,812, dir: 273)
+Number of created files: 2 (reg: 2)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 7
+Total file size: 1,234,567,890 bytes
+Total transferred file size: 45,678 bytes
+Literal data: 12,345 bytes
+Matched data: 33,333 bytes
+Total bytes sent: 20,001
+Total bytes received: 1,234
+
+sent 20,001 bytes  received 1,234 bytes  3,035.71 bytes/sec
+'''
+
+
+class TestMetrics(unittest.TestCase):
+    def test_rdiff_backup_statistics(self):
+        transfer = parse_rdiff_backup_statistics(RDIFF_BACKUP_STATISTICS)
+        self.assertEqual(transfer['files_scanned'], 2133)
+        self.assertEqual(transfer['files_changed'], 14)
+        self.assertEqual(transfer['bytes_changed'], 504000)
+        self.assertEqual(transfer['destination_size_change'], -124000)
+        self.assertEqual(transfer['rdiff_backup']['ElapsedTime'], 10.5)
+
+    def test_rsync_statistics(self):
+        transfer = parse_rsync_statistics(RSYNC_STATISTICS)
+        self.assertEqual(transfer['files_scanned'], 3085)
+        self.assertEqual(transfer['files_changed'], 8)
+        self.assertEqual(transfer['bytes_changed'], 45678)
+        self.assertEqual(transfer['bytes_sent'], 20001)
+        self.assertEqual(transfer['rsync']['literal_data'], 12345)
+        self.assertEqual(transfer['compression_ratio'], 0.62)
+
+    def test_no_statistics(self):
+        self.assertEqual(parse_rdiff_backup_statistics('some error\n'), {})
+        self.assertEqual(parse_rsync_statistics('some error\n'), {})
+
+
+class TestMetricsLog(TempConfigTestCase):
+    def setUp(self):
+        TempConfigTestCase.setUp(self)
+        self.old_max_metrics_bytes = metrics.MAX_METRICS_BYTES
+        metrics.MAX_METRICS_BYTES = 2000
+        self.write_conf()
+        settings.reload()
+
+    def tearDown(self):
+        metrics.MAX_METRICS_BYTES = self.old_max_metrics_bytes
+        TempConfigTestCase.tearDown(self)
+
+    def write_record(self, label, number):
+        job = FakeJob(label, 'host', None, None)
+        job_metrics = JobMetrics(job)
+        job_metrics.start = number
+        job_metrics.finish = number + 60
+        job_metrics.success = True
+        job_metrics.write()
+
+    def test_rotation(self):
+        path = metrics.get_metrics_path()
+        rotated_path = metrics.get_rotated_path(path)
+        self.write_record('rare', 0)
+        number = 1
+        while not os.path.exists(rotated_path):
+            self.write_record('frequent', number)
+            number += 1
+        self.write_record('frequent', number)
+        # What was rotated away is still read.
+        history = load_history(recent_runs=3)
+        self.assertEqual([record['start'] for record in history['rare']], [0])
+        self.assertEqual([record['start'] for record in history['frequent']], [number - 2, number - 1, number])
+
+        for number in range(number + 1, 100):
+            self.write_record('frequent', number)
+        # Neither file grows much past the limit, and only one old one is kept.
+        self.assertTrue(os.path.getsize(path) < 2000 + 1000)
+        self.assertTrue(os.path.getsize(rotated_path) < 2000 + 1000)
+        self.assertEqual(sorted(os.listdir(self.state_dir)), ['metrics.jsonl', 'metrics.jsonl.1'])
+        history = load_history(recent_runs=1000)
+        self.assertFalse('rare' in history)
+        self.assertEqual([record['start'] for record in history['frequent']][-3:], [97, 98, 99])
+        self.assertTrue(len(history['frequent']) < 50)
+
+
+def compression_record(compression, seconds, bytes_changed=1024 ** 3, success=True):
+    return {'compression': compression, 'success': success, 'transfer': {'bytes_changed': bytes_changed},
+        'phases': [{'name': 'pre:hook', 'seconds': 100}, {'name': 'backup', 'seconds': seconds}]}
+
+
+class TestCompression(unittest.TestCase):
+    def test_measures_both_ways_first(self):
+        self.assertFalse(choose_compression([], False)[0])
+        records = [compression_record(False, 100), compression_record(False, 100)]
+        self.assertTrue(choose_compression(records, False)[0])
+        # Failed and small runs don't count.
+        records += [compression_record(True, 10, success=False), compression_record(True, 10, bytes_changed=1024)]
+        self.assertTrue(choose_compression(records, False)[0])
+
+    def test_picks_the_faster_way(self):
+        records = [compression_record(False, 100), compression_record(True, 50),
+            compression_record(False, 120), compression_record(True, 60)]
+        self.assertTrue(choose_compression(records, False)[0])
+        records += [compression_record(True, 500)] * 3
+        self.assertFalse(choose_compression(records, False)[0])
+
+
+class TestBandwidthBudget(unittest.TestCase):
+    def run_jobs(self, total, max_jobs, job_count, seed):
+        # Start and finish job_count jobs in a random order, as the scheduler
+        # would, checking the shares as we go.
+        rand = random.Random(seed)
+        budget = BandwidthBudget(total, max_jobs)
+        queued = job_count
+        running = {}
+        while queued or running:
+            full = max_jobs and len(running) >= max_jobs
+            if queued and not full and (not running or rand.random() < 0.6):
+                queued -= 1
+                label = 'job{number}'.format(number=job_count - queued)
+                share = budget.acquire(label, queued)
+                if queued:
+                    expected = len(running) + 1 + queued
+                    if max_jobs:
+                        expected = min(expected, max_jobs)
+                    self.assertEqual(share, total // expected)
+                else:
+                    # The last job to start takes whatever is left.
+                    self.assertEqual(share, total - sum(running.values()))
+                # Jobs started earlier expected at least as many others.
+                for other_share in running.values():
+                    self.assertTrue(other_share <= share)
+                running[label] = share
+                self.assertTrue(sum(running.values()) <= total)
+            else:
+                label = rand.choice(sorted(running))
+                del running[label]
+                budget.release(label)
+        return budget
+
+    def test_shares(self):
+        for seed in range(20):
+            for max_jobs in (0, 1, 2, 4):
+                self.run_jobs(1000, max_jobs, 7, seed)
+                self.run_jobs(100, max_jobs, 3, seed)
+
+    def test_even_split(self):
+        budget = BandwidthBudget(1000, 4)
+        # Four slots to fill, so every job gets a quarter.
+        self.assertEqual([budget.acquire(label, 5 - i) for i, label in enumerate('abcd')], [250] * 4)
+        budget.release('a')
+        budget.release('b')
+        budget.release('c')
+        # Two jobs left to start and one still running, so a third.
+        self.assertEqual(budget.acquire('e', 1), 333)
+        # The last one gets the rest, not just a third.
+        self.assertEqual(budget.acquire('f', 0), 417)
+        budget.release('d')
+        budget.release('e')
+        budget.release('f')
+        # A job on its own gets it all.
+        self.assertEqual(budget.acquire('g', 0), 1000)
+
+    def test_share_is_never_zero(self):
+        budget = BandwidthBudget(1000, 0)
+        self.assertEqual(budget.acquire('a', 0), 1000)
+        # Out of the scheduler's order there's nothing left, but a share of
+        # 0 would be no limit at all.
+        self.assertEqual(budget.acquire('b', 0), 1)
+
+
+GIB = 1024 ** 3
+
+
+class TestSnapshotSizing(unittest.TestCase):
+    def test_parse_lvs(self):
+        volumes = parse_lvs(
+            '  vg0,root,10737418240,\n'
+            '  vg0,root-ari_backup,1073741824,42.50\n')
+        self.assertEqual(volumes['vg0/root'], (10 * GIB, None))
+        self.assertEqual(volumes['vg0/root-ari_backup'], (GIB, 42.5))
+
+    def test_no_history(self):
+        self.assertEqual(choose_snapshot_size(10 * GIB, []), GIB)
+        # never bigger than the origin
+        self.assertEqual(choose_snapshot_size(512 * 1024 ** 2, []), 512 * 1024 ** 2)
+
+    def test_from_history(self):
+        records = [{'peak_used': 2 * GIB, 'duration': 3600}, {'peak_used': GIB, 'duration': 600}]
+        self.assertEqual(choose_snapshot_size(100 * GIB, records), 3 * GIB)
+        # The faster run filled 1GiB in 10 minutes, so a 2 hour run needs 12.
+        self.assertEqual(choose_snapshot_size(100 * GIB, records, 7200), 18 * GIB)
+        self.assertEqual(choose_snapshot_size(100 * GIB, [{'peak_used': 0, 'duration': 60}]),
+            MIN_SNAPSHOT_SIZE)
+
+
 if __name__ == '__main__':
     unittest.main()